@@ -32,15 +32,19 @@ popd
 
 pushd build
 
+# The onefile bootloader unpacks everything it carries on every start. The
+# tools go in one archive instead, unpacked once per build hash into a
+# persistent cache by import_media.unpack_tools().
+tar -C tools -cJf tools.tar.xz magick identify ffmpeg ffprobe openssl
+sha256sum tools.tar.xz server.py import_media.py | sha256sum | cut -c1-16 \
+  > build_hash.txt
+
 pyinstaller \
   --name xtube \
   --onefile \
   --add-data ui:ui \
-  --add-binary tools/magick:. \
-  --add-binary tools/identify:. \
-  --add-binary tools/ffmpeg:. \
-  --add-binary tools/ffprobe:. \
-  --add-binary tools/openssl:. \
+  --add-data tools.tar.xz:. \
+  --add-data build_hash.txt:. \
   --noconfirm \
   server.py
 
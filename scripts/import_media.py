@@ -17,6 +17,30 @@ from enum import Enum
 import html
 import sys
 import mimetypes
+import contextlib
+import time
+import io
+import tarfile
+from collections import deque
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import hmac
+import gzip
+import zlib
+import ctypes
+import ctypes.util
+import struct
+import http.client
+import urllib.parse
+import socket
+import posixpath
+import fnmatch
+import math
+
+
+# Runs of CJK ideographs, kana and hangul
+CJK_RUN = '[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+'
 
 
 def random_string(length: int, charset: str = 'nlu'):
@@ -43,6 +67,49 @@ def du_dir(dir: Path):
     return total
 
 
+def segment_times(duration: float, hls_time: float, init_time: float = None):
+    """Segment start times, short leading segments doubling up to hls_time"""
+    times = [0]
+    length = min(init_time or hls_time, hls_time)
+    while times[-1] + length < duration:
+        times.append(times[-1] + length)
+        length = min(length * 2, hls_time)
+    return times
+
+
+# MIME types worth compressing, others are tried only if unknown
+COMPRESSIBLE_MIME_TYPES = re.compile(
+    r'text/|application/(json|xml|javascript|x-yaml|yaml|x-sh|sql|'
+    r'x-ndjson|.*\+xml|.*\+json)')
+OPAQUE_MIME_TYPES = (None, 'application/octet-stream')
+
+
+def is_compressible(file: Path, mime_type: str = None,
+                    sample_size: int = 256 * 1024, max_ratio: float = 0.9):
+    """Guesses from the MIME type and a sample whether gzip pays off"""
+    if mime_type not in OPAQUE_MIME_TYPES and \
+            not COMPRESSIBLE_MIME_TYPES.match(mime_type):
+        return False
+    if file.stat().st_size < 1024:
+        return False
+    with open(file, 'rb') as f:
+        sample = f.read(sample_size)
+    return len(zlib.compress(sample, 6)) <= len(sample) * max_ratio
+
+
+def gzip_file(file: Path, output: Path):
+    with open(file, 'rb') as fin, gzip.open(output, 'wb', 6) as fout:
+        shutil.copyfileobj(fin, fout, 1024*1024)
+
+
+def calculate_md5(file_path: Path) -> str:
+    hasher = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
 def is_valid_key(key: str):
     # For now, only 128 bit key in hex format is supported
     return re.match("[0-9a-fA-F]{32}$", key)
@@ -64,26 +131,116 @@ def zip_directory(dir: Path, file: Path):
             zipf.write(f, arcname=f.relative_to(dir))
 
 
+class InsufficientSpace(Exception):
+    pass
+
+
+def ensure_free_space(dir: Path, needed: int, reserve: int = None):
+    """Admission control, raises if dir's filesystem can't take needed bytes"""
+    if reserve is None:
+        reserve = int(os.environ.get('MIN_FREE_SPACE', 1 << 30))
+    free = shutil.disk_usage(dir).free
+    if free - reserve < needed:
+        raise InsufficientSpace(
+            f"Need {needed} bytes in {dir}, only {free - reserve} available")
+
+
+FICLONE = 0x40049409
+
+
+def place_file(src: Path, dst: Path, move: bool = False):
+    """Puts src at dst as cheaply as the filesystem allows
+
+    Rename if src may be consumed, otherwise reflink, otherwise
+    copy_file_range, otherwise a plain copy.
+    """
+    if move:
+        try:
+            os.replace(src, dst)
+            return
+        except OSError:
+            pass  # Most likely cross-device
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+        try:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(
+                    fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+        except (OSError, AttributeError):
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1024*1024)
+
+
+# Lock file -> asyncio.Lock, waiters of this process queue there rather
+# than each parking a worker thread on the flock
+file_locks = {}
+
+
+@contextlib.asynccontextmanager
+async def file_lock(path: Path):
+    """Exclusive flock on path, also against other processes. Not
+    reentrant.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    process_lock = file_locks.setdefault(str(path.resolve()), asyncio.Lock())
+    async with process_lock:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+
 class Tmp:
-    def __init__(self):
+    def __init__(self, root: Path = None):
+        # Staging dir, defaults to the system temp dir. Put it on the same
+        # filesystem as the data dir so that results can be renamed in place.
+        self.root = root
         self.files = []
         self.dirs = []
 
+    def staging_dir(self):
+        if self.root:
+            self.root.mkdir(parents=True, exist_ok=True)
+        return self.root
+
     def file(self, suffix: str = None):
-        file = tempfile.NamedTemporaryFile(suffix=suffix)
-        self.files.append(file)
-        return Path(file.name)
+        fd, name = tempfile.mkstemp(suffix=suffix, dir=self.staging_dir())
+        os.close(fd)
+        self.files.append(Path(name))
+        return Path(name)
 
     def dir(self):
-        dir = tempfile.TemporaryDirectory()
+        dir = Path(tempfile.mkdtemp(dir=self.staging_dir()))
+        self.dirs.append(dir)
+        return dir
+
+    def adopt(self, dir: Path):
+        """Takes over an existing dir, it is removed on cleanup"""
         self.dirs.append(dir)
-        return Path(dir.name)
+        return dir
+
+    def owns(self, path: Path):
+        return path in self.files or any(d in path.parents for d in self.dirs)
 
     def cleanup(self):
         for file in self.files:
-            file.close()
+            file.unlink(missing_ok=True)
         for dir in self.dirs:
-            dir.cleanup()
+            shutil.rmtree(dir, ignore_errors=True)
 
     def __enter__(self):
         return self
@@ -320,6 +477,187 @@ class EPUB3:
 
         return None, None
 
+    def extract_text(file: Path):
+        """Extracts the plain text of all (X)HTML documents in an EPUB file"""
+        texts = []
+        with zipfile.ZipFile(file) as z:
+            for name in z.namelist():
+                if name.endswith(('.xhtml', '.html', '.htm')):
+                    content = z.read(name).decode('utf-8', errors='ignore')
+                    content = re.sub(r'<[^>]+>', ' ', content)
+                    texts.append(html.unescape(content))
+        return '\n'.join(texts)
+
+    text_types = ('application/xhtml+xml', 'text/html', 'text/css',
+                  'application/x-dtbncx+xml', 'image/svg+xml')
+    ref_pattern = re.compile(
+        r'''(?:href|src|poster)\s*=\s*["']([^"'#?]+)'''
+        r'''|url\(\s*["']?([^"')#?]+)'''
+        r'''|@import\s+["']([^"'#?]+)''')
+
+    @staticmethod
+    def read_manifest(z: zipfile.ZipFile):
+        """Returns (opf path, {path: item attrib}, reachable paths)"""
+        ns = '{http://www.idpf.org/2007/opf}'
+        container = ET.fromstring(z.read('META-INF/container.xml'))
+        opf_path = container.find(
+            './/{urn:oasis:names:tc:opendocument:xmlns:container}rootfile'
+        ).attrib['full-path']
+        opf_dir = posixpath.dirname(opf_path)
+        opf = ET.fromstring(z.read(opf_path))
+
+        def resolve(base_dir: str, href: str):
+            href = urllib.parse.unquote(href.strip())
+            return posixpath.normpath(posixpath.join(base_dir, href))
+
+        items, ids = {}, {}
+        for item in opf.iter(f'{ns}item'):
+            path = resolve(opf_dir, item.attrib['href'])
+            items[path] = item.attrib
+            ids[item.attrib.get('id')] = path
+
+        # Everything the reading system may open by itself
+        roots = {ids.get(ref.attrib.get('idref'))
+                 for ref in opf.iter(f'{ns}itemref')}
+        roots |= {path for path, item in items.items()
+                  if item.get('properties')}
+        roots |= {ids.get(item.get('fallback')) for item in items.values()}
+        if (spine := opf.find(f'{ns}spine')) is not None:
+            roots.add(ids.get(spine.attrib.get('toc')))
+        for meta in opf.iter(f'{ns}meta'):
+            if meta.attrib.get('name') == 'cover':
+                roots.add(ids.get(meta.attrib.get('content')))
+        for ref in opf.iter(f'{ns}reference'):
+            roots.add(resolve(opf_dir, ref.attrib.get('href', '')
+                              .split('#')[0]))
+
+        reachable = set()
+        pending = [path for path in roots if path in items]
+        while pending:
+            path = pending.pop()
+            if path in reachable:
+                continue
+            reachable.add(path)
+            if items[path].get('media-type') not in EPUB3.text_types:
+                continue
+            content = z.read(path).decode('utf-8', errors='ignore')
+            for match in EPUB3.ref_pattern.finditer(content):
+                href = next(group for group in match.groups() if group)
+                if re.match(r'[a-z][a-z0-9+.-]*:', href, re.I):
+                    continue  # External, data: and the like
+                ref = resolve(posixpath.dirname(path), href)
+                if ref in items and ref not in reachable:
+                    pending.append(ref)
+
+        return opf_path, items, reachable
+
+    @staticmethod
+    def rewrite_refs(content: str, doc_path: str, renames: dict):
+        doc_dir = posixpath.dirname(doc_path)
+        for old, new in renames.items():
+            old_rel = posixpath.relpath(old, doc_dir)
+            new_rel = posixpath.relpath(new, doc_dir)
+            for old_ref, new_ref in ((old_rel, new_rel), (
+                    urllib.parse.quote(old_rel), urllib.parse.quote(new_rel))):
+                pattern = r'''(?<=["'(\s])%s(?=["')#?\s])''' % \
+                    re.escape(old_ref)
+                content = re.sub(pattern, lambda _: new_ref, content)
+        return content
+
+    @staticmethod
+    def rewrite_opf(content: str, opf_path: str, dropped: set,
+                    renames: dict):
+        opf_dir = posixpath.dirname(opf_path)
+
+        def fix_item(match: re.Match):
+            tag = match.group(0)
+            href = re.search(r'''\shref\s*=\s*(["'])(.*?)\1''', tag)
+            if not href:
+                return tag
+            path = posixpath.normpath(posixpath.join(
+                opf_dir, urllib.parse.unquote(href.group(2))))
+            if path in dropped:
+                return ''
+            if path in renames:
+                new_href = urllib.parse.quote(
+                    posixpath.relpath(renames[path], opf_dir))
+                tag = tag.replace(href.group(0), f' href="{new_href}"')
+                tag = re.sub(r'''media-type\s*=\s*(["']).*?\1''',
+                             'media-type="image/webp"', tag)
+            return tag
+
+        return re.sub(r'\s*<item\b[^>]*?(?:/>|>\s*</item>)', fix_item, content)
+
+    @staticmethod
+    async def optimize(
+        file: Path,
+        output: Path,
+        tmp: Tmp,
+        resize: str = '1600x2400>',
+        quality: int = 80,
+        min_image_size: int = 64 * 1024,
+    ):
+        """Rewrites an EPUB one entry at a time: oversized PNG/JPEG images
+        become WebP at most resize, text is deflated at the highest level,
+        manifest items nothing refers to are dropped and mimetype goes
+        first, uncompressed. Returns what was done and the bytes saved.
+        """
+        with zipfile.ZipFile(file) as z:
+            opf_path, items, reachable = EPUB3.read_manifest(z)
+            names = set(z.namelist())
+
+            dropped = set(items) - reachable
+            renames = {}
+            for path in reachable:
+                if items[path].get('media-type') not in ('image/png',
+                                                         'image/jpeg'):
+                    continue
+                new_path = str(Path(path).with_suffix('.webp'))
+                if z.getinfo(path).file_size >= min_image_size and \
+                        new_path not in names:
+                    renames[path] = new_path
+            text_docs = {path for path in reachable
+                         if items[path].get('media-type') in EPUB3.text_types}
+
+            with zipfile.ZipFile(output, 'w') as out:
+                out.writestr('mimetype', 'application/epub+zip',
+                             compress_type=zipfile.ZIP_STORED)
+                for info in z.infolist():
+                    name = info.filename
+                    if name == 'mimetype' or info.is_dir() or name in dropped:
+                        continue
+
+                    if name == opf_path or name in text_docs:
+                        content = z.read(name).decode('utf-8')
+                        if name == opf_path:
+                            content = EPUB3.rewrite_opf(
+                                content, opf_path, dropped, renames)
+                        content = EPUB3.rewrite_refs(content, name, renames)
+                        out.writestr(name, content, zipfile.ZIP_DEFLATED, 9)
+                    elif name in renames:
+                        src = tmp.file(suffix=Path(name).suffix)
+                        dst = tmp.file(suffix='.webp')
+                        with z.open(info) as f_in, open(src, 'wb') as f_out:
+                            shutil.copyfileobj(f_in, f_out)
+                        await Cmd.convert_image(
+                            src, dst, resize=resize, quality=quality)
+                        # Already compressed
+                        out.write(dst, renames[name], zipfile.ZIP_STORED)
+                        src.unlink()
+                        dst.unlink()
+                    else:
+                        # Copied as is, e.g. fonts, which may be obfuscated
+                        copy = zipfile.ZipInfo(name, info.date_time)
+                        copy.compress_type = info.compress_type
+                        with z.open(info) as f_in, out.open(copy, 'w') as f_out:
+                            shutil.copyfileobj(f_in, f_out)
+
+        return {
+            'images': len(renames),
+            'dropped': len(dropped),
+            'saved': file.stat().st_size - output.stat().st_size,
+        }
+
     def parse_chapters(content: str, max_ctl: int):
         lines = content.splitlines()
         lines = [line.strip() for line in lines]
@@ -344,30 +682,225 @@ class EPUB3:
         return chapters
 
 
+class GovernorBusy(Exception):
+    pass
+
+
+class Governor:
+    """Caps concurrent external tools per tool name and tracks queue depth"""
+
+    def __init__(self, limits: dict[str, int], max_queue: int = 0):
+        self.limits = limits
+        self.max_queue = max_queue
+        self.semaphores = {}
+        self.waiting = {}
+        self.running = {}
+
+    @staticmethod
+    def default_limits():
+        cpus = os.cpu_count() or 1
+        limits = {
+            # libx264 is already multi-threaded, so a few encoders fill the box
+            'ffmpeg': max(1, cpus // 4),
+            'magick': max(1, cpus // 2),
+            '*': cpus,
+        }
+        # e.g. CMD_LIMITS="ffmpeg=2,magick=4"
+        for item in os.environ.get('CMD_LIMITS', '').split(','):
+            if '=' in item:
+                tool, limit = item.split('=', 1)
+                limits[tool.strip()] = max(1, int(limit))
+        return limits
+
+    def queue_depth(self, tool: str = None):
+        if tool:
+            return self.waiting.get(tool, 0)
+        return sum(self.waiting.values())
+
+    def stats(self):
+        return {
+            tool: {
+                'limit': self.limits.get(tool, self.limits['*']),
+                'running': self.running[tool],
+                'waiting': self.waiting[tool],
+            }
+            for tool in self.semaphores
+        }
+
+    def admit(self):
+        """Raises GovernorBusy if the queues are too long for new work
+
+        Checked once where a request comes in, not per command, so work
+        already admitted (and the catalog writes that end it) always runs.
+        """
+        if self.max_queue and self.queue_depth() >= self.max_queue:
+            raise GovernorBusy(
+                f"Too many queued commands ({self.queue_depth()})")
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tool: str):
+        if tool not in self.semaphores:
+            limit = self.limits.get(tool, self.limits['*'])
+            self.semaphores[tool] = asyncio.Semaphore(limit)
+            self.waiting[tool] = 0
+            self.running[tool] = 0
+
+        semaphore = self.semaphores[tool]
+        self.waiting[tool] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting[tool] -= 1
+
+        self.running[tool] += 1
+        try:
+            yield
+        finally:
+            self.running[tool] -= 1
+            semaphore.release()
+
+
+def unpack_tools(bundle_dir: Path):
+    """The dir of the bundled tools, unpacked once per build
+
+    Frozen builds carry the tools as tools.tar.xz with build_hash.txt, see
+    build-linux.sh. They go to XTUBE_CACHE_DIR (default: ~/.cache/xtube)
+    /tools-<hash> and are reused on every later start, tools of other
+    builds are removed. Older builds had them in the bundle itself.
+    """
+    archive = bundle_dir / 'tools.tar.xz'
+    if not archive.is_file():
+        return bundle_dir
+
+    build_hash = (bundle_dir / 'build_hash.txt').read_text().strip()
+    cache_dir = Path(os.environ.get('XTUBE_CACHE_DIR') or
+                     Path.home() / '.cache' / 'xtube')
+    tools_dir = cache_dir / f'tools-{build_hash}'
+    if tools_dir.is_dir():
+        return tools_dir
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    work_dir = Path(tempfile.mkdtemp(prefix='.tools-', dir=cache_dir))
+    with tarfile.open(archive) as tar:
+        tar.extractall(work_dir, filter='tar')
+    try:
+        os.replace(work_dir, tools_dir)
+    except OSError:
+        shutil.rmtree(work_dir)  # Another process was faster
+
+    for path in cache_dir.glob('tools-*'):
+        if path != tools_dir:
+            shutil.rmtree(path, ignore_errors=True)
+    return tools_dir
+
+
 class Cmd:
     env = os.environ.copy()
 
     # pyinstaller specific
     if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
-        env['PATH'] = f"{sys._MEIPASS}:{env['PATH']}"
+        env['PATH'] = f"{unpack_tools(Path(sys._MEIPASS))}:{env['PATH']}"
+
+    governor = Governor(
+        Governor.default_limits(),
+        max_queue=int(os.environ.get('CMD_MAX_QUEUE', 0)),
+    )
+    # Seconds, 0 means no timeout
+    timeout = float(os.environ.get('CMD_TIMEOUT', 0))
+    # Background priority for the heavy tools, empty to disable. Catalog
+    # openssl and md5sum keep normal priority so they don't starve behind them.
+    nice = os.environ.get('CMD_NICE', '10')
+    # Best-effort at the lowest level, the idle class (3) is opt-in as it
+    # can stall imports indefinitely on a busy disk
+    ionice = os.environ.get('CMD_IONICE', '2')
+    ionice_level = os.environ.get('CMD_IONICE_LEVEL', '7')
+    background_tools = {'ffmpeg', 'magick'}
 
     @staticmethod
-    async def run(cmd: list, capture=False, **kwargs):
-        if capture:
+    def priority_prefix(tool: str):
+        prefix = []
+        if tool not in Cmd.background_tools:
+            return prefix
+        # Both exec the command, so the pid stays the same for kill()
+        if Cmd.nice and shutil.which('nice'):
+            prefix.extend(['nice', '-n', Cmd.nice])
+        if Cmd.ionice and shutil.which('ionice'):
+            prefix.extend(['ionice', '-c', Cmd.ionice])
+            # Only the realtime and best-effort classes have levels
+            if Cmd.ionice in ('1', '2') and Cmd.ionice_level:
+                prefix.extend(['-n', Cmd.ionice_level])
+        return prefix
+
+    @staticmethod
+    async def run(cmd: list, capture=False, timeout: float = None, **kwargs):
+        tool = Path(cmd[0]).name
+        timeout = timeout or Cmd.timeout or None
+        pipe = asyncio.subprocess.PIPE if capture else None
+
+        async with Cmd.governor.slot(tool):
             process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
+                *Cmd.priority_prefix(tool), *cmd,
+                stdout=pipe,
+                stderr=pipe,
                 env=Cmd.env,
                 **kwargs,
             )
-            stdout, stderr = await process.communicate()
-            if process.returncode != 0:
-                raise Exception(f"Command failed: {stderr.decode()}")
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    process.communicate(), timeout)
+            except BaseException:
+                # Timed out or cancelled, don't leave the child running
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+
+        if process.returncode != 0:
+            detail = stderr.decode() if capture else \
+                f"{tool} exited with {process.returncode}"
+            raise Exception(f"Command failed: {detail}")
+        if capture:
             return stdout.decode()
-        else:
-            process = await asyncio.create_subprocess_exec(*cmd, env=Cmd.env, **kwargs)
-            await process.wait()
+
+    @staticmethod
+    async def run_pipeline(cmds: list[list]):
+        """Runs cmds with each one's stdout piped into the next one's stdin"""
+        tool = Path(cmds[0][0]).name
+        processes = []
+
+        async with Cmd.governor.slot(tool):
+            try:
+                stdin = None
+                for index, cmd in enumerate(cmds):
+                    read_fd, write_fd = os.pipe() \
+                        if index < len(cmds) - 1 else (None, None)
+                    try:
+                        processes.append(await asyncio.create_subprocess_exec(
+                            *Cmd.priority_prefix(Path(cmd[0]).name), *cmd,
+                            stdin=stdin,
+                            stdout=write_fd,
+                            env=Cmd.env,
+                        ))
+                    finally:
+                        # The children hold their own copies
+                        if stdin is not None:
+                            os.close(stdin)
+                        if write_fd is not None:
+                            os.close(write_fd)
+                    stdin = read_fd
+
+                codes = await asyncio.gather(*(p.wait() for p in processes))
+            except BaseException:
+                for process in processes:
+                    if process.returncode is None:
+                        process.kill()
+                        await process.wait()
+                raise
+
+        for cmd, code in zip(cmds, codes):
+            if code != 0:
+                raise Exception(
+                    f"Command failed: {Path(cmd[0]).name} exited with {code}")
 
     @staticmethod
     async def image_to_thumbnail(
@@ -422,6 +955,23 @@ class Cmd:
         await Cmd.run(['openssl', 'enc', '-d', '-aes-128-cbc',
                        '-in', file, '-out', output, '-K', key, '-iv', iv])
 
+    @staticmethod
+    async def reencrypt_file(
+        file: Path,
+        output: Path,
+        key: str,
+        iv: str,
+        new_key: str,
+        new_iv: str,
+    ):
+        # Streams decrypt into encrypt, the plaintext never touches disk
+        await Cmd.run_pipeline([
+            ['openssl', 'enc', '-d', '-aes-128-cbc',
+             '-in', file, '-K', key, '-iv', iv],
+            ['openssl', 'enc', '-aes-128-cbc', '-salt',
+             '-out', output, '-K', new_key, '-iv', new_iv],
+        ])
+
     @staticmethod
     async def get_md5(fileOrDir: Path):
         # if fileOrDir.is_file():
@@ -433,13 +983,6 @@ class Cmd:
         #         capture=True, cwd=fileOrDir,
         #     )
         #     return result
-        def calculate_md5(file_path: Path) -> str:
-            hasher = hashlib.md5()
-            with open(file_path, 'rb') as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hasher.update(chunk)
-            return hasher.hexdigest()
-
         if fileOrDir.is_file():
             return calculate_md5(fileOrDir)
         elif fileOrDir.is_dir():
@@ -467,18 +1010,27 @@ class Cmd:
     @staticmethod
     async def get_video_format(file: Path):
         result = await Cmd.run(['ffprobe', '-v', 'quiet', '-show_format',
-                                '-print_format', 'json', file], capture=True)
+                                '-show_streams', '-print_format', 'json',
+                                file], capture=True)
         return json.loads(result)
 
     @staticmethod
-    async def get_video_screenshot(file: Path, output: Path):
-        await Cmd.run([
-            'ffmpeg', '-y',
-            '-i', file,
-            '-vf', 'thumbnail',
-            '-frames:v', '1',
-            output,
-        ])
+    async def get_video_screenshot(
+        file: Path,
+        output: Path,
+        seek: float = None,
+        size: str = None,
+    ):
+        cmd = ['ffmpeg', '-y']
+        if seek:
+            # Input seeking jumps to the nearest keyframe, no decoding up to it
+            cmd.extend(['-noaccurate_seek', '-ss', str(seek)])
+        cmd.extend(['-i', file, '-frames:v', '1'])
+        if size:
+            w, h = size.split('x')
+            cmd.extend([
+                '-vf', f'scale={w}:{h}:force_original_aspect_ratio=decrease'])
+        await Cmd.run(cmd + [output])
 
     @staticmethod
     async def video_to_m3u8(
@@ -487,28 +1039,77 @@ class Cmd:
         bitrate: str,
         hls_time: int,
         key_info_file: Path = None,
+        storyboard: dict = None,
+        hls_type: str = 'mpegts',
+        keyframe_times: list[float] = None,
+        preset: str = None,
     ):
+        """bitrate is either a bitrate like 2000k or a quality like crf=23"""
         seg_dir = output.parent / 'seg'
         seg_dir.mkdir(parents=True)
-        cmd = [
-            'ffmpeg',
-            '-i', file,
-            '-c:v', 'libx264',
-            '-b:v', bitrate,
+        cmd = ['ffmpeg', '-i', file]
+        suffix = 'm4s' if hls_type == 'fmp4' else 'ts'
+
+        if storyboard:
+            # Sprite sheets come from the same decode as the transcode
+            sb = storyboard
+            cmd.extend([
+                '-filter_complex',
+                f"[0:v]split=2[v][s];[s]fps=1/{sb['interval']},"
+                f"scale={sb['width']}:{sb['height']},"
+                f"tile={sb['columns']}x{sb['rows']}[sb]",
+                '-map', '[sb]', '-c:v', 'libwebp', '-quality', '60',
+                '-fps_mode', 'passthrough', sb['dir'] / '%03d.webp',
+                '-map', '[v]', '-map', '0:a?',
+            ])
+
+        cmd.extend(['-c:v', 'libx264', *EncodingProfile.rate_args(bitrate)])
+        if preset:
+            cmd.extend(['-preset', preset])
+        cmd.extend([
             '-c:a', 'aac',
             '-b:a', '128k',
+        ])
+
+        if keyframe_times:
+            # Keyframes only at the segment boundaries, the muxer cuts at
+            # every one of them since hls_time is at most the shortest gap
+            cmd.extend([
+                '-force_key_frames',
+                ','.join(f'{t:.3f}' for t in keyframe_times),
+                '-g', '1000000',
+                '-sc_threshold', '0',
+            ])
+            gaps = [b - a for a, b in zip(keyframe_times, keyframe_times[1:])]
+            hls_time = min(gaps + [hls_time])
+
+        cmd.extend([
             '-f', 'hls',
             '-hls_time', str(hls_time),
             '-hls_playlist_type', 'vod',
             '-hls_list_size', '0',
             '-hls_flags', 'independent_segments',
+            '-hls_segment_type', hls_type,
             '-hls_base_url', 'seg/',
-            '-hls_segment_filename', seg_dir / '%03d.ts',
-        ]
+            '-hls_segment_filename', seg_dir / f'%03d.{suffix}',
+        ])
+        if hls_type == 'fmp4':
+            cmd.extend(['-hls_fmp4_init_filename', 'init.mp4'])
         if key_info_file:
             cmd.extend(['-hls_key_info_file', key_info_file])
         await Cmd.run(cmd + [output])
 
+        if hls_type == 'fmp4':
+            # Put the init segment where the playlist says it is, ffmpeg
+            # versions disagree on whether the base url applies to it
+            text = output.read_text()
+            if m := re.search(r'#EXT-X-MAP:URI="([^"]+)"', text):
+                target = output.parent / m[1]
+                for candidate in (output.parent / 'init.mp4',
+                                  seg_dir / 'init.mp4'):
+                    if not target.exists() and candidate.exists():
+                        os.replace(candidate, target)
+
     @staticmethod
     async def get_image_creation_time(file: Path):
         result = await Cmd.run(
@@ -600,7 +1201,7 @@ class YAML:
     @staticmethod
     def dumps(records: dict | list[dict]):
         '''Simple dumper for dumping a dict or a list of dict'''
-        if isinstance(records, dict):
+        if isinstance(records, Mapping):
             lines = []
 
             for key, value in records.items():
@@ -622,6 +1223,617 @@ class YAML:
         return '\n'.join(lines)
 
 
+class RateLimiter:
+    """Bounds the throughput of all callers together to rate units/second"""
+
+    def __init__(self, rate: float = None):
+        self.rate = rate
+        self.next = 0
+
+    async def consume(self, amount: int):
+        if not self.rate:
+            await asyncio.sleep(0)
+            return
+        # Reserve the next slot, then wait for it to begin
+        now = time.monotonic()
+        start = max(self.next, now)
+        self.next = start + amount / self.rate
+        await asyncio.sleep(start - now)
+
+
+async def refresh_md5sum(resource_dir: Path):
+    """Rewrites md5sum.txt after a resource changed, returns the new size"""
+    md5_file = resource_dir / 'md5sum.txt'
+    md5_file.unlink(missing_ok=True)
+    md5 = await Cmd.get_md5(resource_dir)
+    md5_file.write_text(md5)
+    return du_dir(resource_dir)
+
+
+def replace_resource_file(src: Path, dst: Path):
+    """Renames src over dst, a file at the top of its resource dir, and
+    rewrites only its line in md5sum.txt. Returns the change in the size of
+    the resource dir.
+
+    src must be on the same filesystem, next to dst is best.
+    """
+    md5_file = dst.parent / 'md5sum.txt'
+    name = f"./{dst.name}"
+    line = f"{calculate_md5(src)}  {name}"
+
+    lines = md5_file.read_text().splitlines() if md5_file.is_file() else []
+    delta = src.stat().st_size - (dst.stat().st_size if dst.exists() else 0)
+    delta -= md5_file.stat().st_size if md5_file.is_file() else 0
+
+    index = next((i for i, l in enumerate(lines)
+                  if l.split('  ', 1)[-1] == name), None)
+    if index is None:
+        lines.append(line)
+    else:
+        lines[index] = line
+
+    os.replace(src, dst)
+    md5_file.write_text("\n".join(lines))
+    return delta + md5_file.stat().st_size
+
+
+class SearchIndex:
+    """Sharded inverted index of the library, encrypted with the library key
+
+    Terms are stored as keyed hashes whose first byte names the shard, so a
+    client hashes its query terms with the key (HMAC-SHA256, first 16 hex
+    digits) and fetches only the shards it needs. index/manifest.yaml maps
+    each shard to the IV of its current file, index/<shard>-<iv[:12]>.yaml.enc.
+    Shards are written under new names and the manifest is replaced after
+    them, so readers always find the shards of the manifest they read.
+    Replaced shards are removed retire_after seconds later.
+
+    index/docs/<uid>.yaml.enc is the forward index of one record (field to
+    term ids), encrypted with the library IV. An update reads and writes
+    only those of the records it changes, and the shards their terms are
+    in. Fields are 'meta' (title, description, ...) and 'body' (note and
+    book text), so they can be updated independently. Writers hold an flock
+    on index/.lock, see locked().
+    """
+
+    retire_after = 300
+
+    def __init__(self, key: str, iv: str, tmp: Tmp, root_dir: Path = None):
+        self.key = key
+        self.iv = iv
+        self.tmp = tmp
+        self.root_dir = root_dir or Path('.')
+        self.dir = self.root_dir / 'index'
+        self.manifest_file = self.dir / 'manifest.yaml'
+        self.docs_dir = self.dir / 'docs'
+        self.lock_file = self.dir / '.lock'
+        self.retired_file = self.dir / '.retired.yaml'
+
+    @staticmethod
+    def tokenize(text: str):
+        terms = set()
+        for word in re.findall(r'\w+', text.lower()):
+            # No spaces between CJK words, index character bigrams instead
+            for run in re.findall(CJK_RUN, word):
+                if len(run) == 1:
+                    terms.add(run)
+                terms.update(run[i:i+2] for i in range(len(run) - 1))
+            for part in re.split(CJK_RUN, word):
+                if len(part) > 1:
+                    terms.add(part)
+        return terms
+
+    def term_id(self, term: str):
+        return hmac.new(bytes.fromhex(self.key), term.encode(),
+                        hashlib.sha256).hexdigest()[:16]
+
+    def term_ids(self, text: str):
+        return {self.term_id(term) for term in SearchIndex.tokenize(text)}
+
+    def locked(self):
+        """Excludes other writers, also those in other processes"""
+        return file_lock(self.lock_file)
+
+    def shard_file(self, shard: str, iv: str):
+        return self.dir / f'{shard}-{iv[:12]}.yaml.enc'
+
+    def load_manifest(self):
+        if self.manifest_file.is_file():
+            return YAML.loads(self.manifest_file.read_text()) or {}
+        return {}
+
+    async def read(self, file: Path, iv: str):
+        pt_path = self.tmp.file()
+        await Cmd.decrypt_file(file, pt_path, self.key, iv)
+        return YAML.loads(pt_path.read_text())
+
+    async def read_doc(self, uid: str):
+        file = self.docs_dir / f'{uid}.yaml.enc'
+        if not file.is_file():
+            return {}
+        return {entry['field']: set(entry['terms'].split())
+                for entry in await self.read(file, self.iv)}
+
+    async def write_doc(self, uid: str, doc: dict[str, set]):
+        file = self.docs_dir / f'{uid}.yaml.enc'
+        if not doc:
+            file.unlink(missing_ok=True)
+            return
+        pt_path = self.tmp.file()
+        pt_path.write_text(YAML.dumps([
+            {'field': field, 'terms': ' '.join(sorted(terms))}
+            for field, terms in doc.items()
+        ]))
+        ct_path = self.tmp.file()
+        await Cmd.encrypt_file(pt_path, ct_path, self.key, self.iv)
+        self.docs_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.docs_dir / f'.{uid}.tmp'
+        place_file(ct_path, tmp_file, move=True)
+        os.replace(tmp_file, file)
+
+    async def write_shard(self, shard: str, entries: list[dict]):
+        """Writes a new file for the shard, returns its IV"""
+        iv = random_string(32, 'h')
+        pt_path = self.tmp.file()
+        pt_path.write_text(YAML.dumps(entries))
+        ct_path = self.tmp.file()
+        await Cmd.encrypt_file(pt_path, ct_path, self.key, iv)
+        place_file(ct_path, self.shard_file(shard, iv), move=True)
+        return iv
+
+    def retire(self, files: list[Path]):
+        """Removes files replaced retire_after seconds ago, and schedules
+        these
+        """
+        now = time.time()
+        retired = YAML.loads(self.retired_file.read_text()) \
+            if self.retired_file.is_file() else []
+        kept = []
+        for entry in retired:
+            if now - float(entry['time']) > self.retire_after:
+                (self.dir / entry['file']).unlink(missing_ok=True)
+            else:
+                kept.append(entry)
+        kept += [{'file': file.name, 'time': int(now)} for file in files]
+
+        tmp_file = self.retired_file.with_suffix('.tmp')
+        tmp_file.write_text(YAML.dumps(kept))
+        os.replace(tmp_file, self.retired_file)
+
+    async def update(self, changes: dict[tuple[str, str], str | None]):
+        """Sets the text of (uid, field) pairs, None removes the field"""
+        async with self.locked():
+            await self.apply(changes)
+
+    async def apply(self, changes: dict[tuple[str, str], str | None],
+                    reset: bool = False):
+        """update() under locked(), reset starts from an empty index"""
+        self.dir.mkdir(parents=True, exist_ok=True)
+        old_manifest = self.load_manifest()
+        manifest = {} if reset else dict(old_manifest)
+
+        fields = {}
+        for (uid, field), text in changes.items():
+            fields.setdefault(uid, {})[field] = text
+
+        # shard -> [(term id, uid, added)]
+        ops = {}
+        docs = {}
+        for uid, texts in fields.items():
+            doc = {} if reset else await self.read_doc(uid)
+            before = set().union(*doc.values())
+            for field, text in texts.items():
+                if text is None:
+                    doc.pop(field, None)
+                else:
+                    doc[field] = self.term_ids(text)
+            after = set().union(*doc.values())
+            for id in after - before:
+                ops.setdefault(id[:2], []).append((id, uid, True))
+            for id in before - after:
+                ops.setdefault(id[:2], []).append((id, uid, False))
+            docs[uid] = doc
+
+        for shard, shard_ops in ops.items():
+            postings = {}
+            if shard in manifest:
+                file = self.shard_file(shard, manifest[shard])
+                for entry in await self.read(file, manifest[shard]):
+                    postings[entry['term']] = set(entry['uids'].split())
+            for id, uid, added in shard_ops:
+                if added:
+                    postings.setdefault(id, set()).add(uid)
+                else:
+                    postings.get(id, set()).discard(uid)
+            manifest[shard] = await self.write_shard(shard, [
+                {'term': id, 'uids': ' '.join(sorted(members))}
+                for id, members in sorted(postings.items()) if members
+            ])
+
+        tmp_file = self.dir / '.manifest.yaml.tmp'
+        tmp_file.write_text(YAML.dumps(manifest))
+        os.replace(tmp_file, self.manifest_file)
+        current = {self.shard_file(shard, iv) for shard, iv in manifest.items()}
+        if reset:
+            # Also what a crash or an older layout left behind
+            replaced = set(self.dir.glob('*.yaml.enc'))
+        else:
+            replaced = {self.shard_file(shard, iv)
+                        for shard, iv in old_manifest.items()}
+        self.retire(sorted(replaced - current))
+
+        # Once the postings have them. After a crash before this, postings
+        # of the previous text may linger until a reindex.
+        for uid, doc in docs.items():
+            await self.write_doc(uid, doc)
+
+    @staticmethod
+    def meta_text(record: dict):
+        fields = ('title', 'description', 'author', 'original_name')
+        return '\n'.join(str(record[f]) for f in fields if record.get(f))
+
+    async def index(self, record: dict, body: str = None):
+        await self.update({
+            (record['uid'], 'meta'): SearchIndex.meta_text(record),
+            (record['uid'], 'body'): body,
+        })
+
+    async def remove(self, uids: list[str]):
+        await self.update({
+            (uid, field): None for uid in uids for field in ('meta', 'body')
+        })
+
+    async def read_body(self, record: dict):
+        """Recovers the indexable body text of a stored record"""
+        if record.get('kind') not in ('note', 'book'):
+            return None
+
+        file = self.root_dir / record['file']
+        if record.get('encrypted'):
+            pt_path = self.tmp.file(suffix=Path(record['file']).stem)
+            await Cmd.decrypt_file(file, pt_path, self.key, record['iv'])
+            file = pt_path
+
+        if record.get('compression') == 'gzip':
+            gz_path = file
+            file = self.tmp.file()
+            with gzip.open(gz_path, 'rb') as fin, open(file, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+
+        if record['kind'] == 'note':
+            return file.read_text(errors='ignore')
+        return EPUB3.extract_text(file)
+
+    async def search(self, query: str):
+        """uids whose fields together contain every term of query"""
+        ids = self.term_ids(query)
+        manifest = self.load_manifest()
+        if not ids or not manifest:
+            return []
+
+        matches = None
+        for shard in sorted({id[:2] for id in ids}):
+            if shard not in manifest:
+                return []
+            postings = {
+                entry['term']: set(entry['uids'].split())
+                for entry in await self.read(
+                    self.shard_file(shard, manifest[shard]), manifest[shard])
+            }
+            for id in ids:
+                if id[:2] == shard:
+                    uids = postings.get(id, set())
+                    matches = uids if matches is None else matches & uids
+        return sorted(matches)
+
+    async def rebuild(self, records: list[dict]):
+        changes = {}
+        for record in records:
+            changes[record['uid'], 'meta'] = SearchIndex.meta_text(record)
+            changes[record['uid'], 'body'] = await self.read_body(record)
+
+        async with self.locked():
+            # Shards of the old index are retired by apply()
+            shutil.rmtree(self.docs_dir, ignore_errors=True)
+            await self.apply(changes, reset=True)
+
+
+class Trash:
+    """Tombstones of removed records under root_dir/.trash/<uid>
+
+    Each holds the encrypted record, the moved resource dir and, once the
+    catalog no longer lists the record, the deletion time. A removal can be
+    undone until the tombstone is collected.
+    """
+
+    def __init__(self, root_dir: Path):
+        self.dir = root_dir / '.trash'
+
+    def deleted_at(self, tombstone: Path):
+        """Deletion time, None while the removal is pending (see DB.remove)"""
+        info_file = tombstone / 'tombstone.yaml'
+        if info_file.is_file():
+            return YAML.loads(info_file.read_text())['deleted']
+        return None
+
+    def mark_deleted(self, uid: str):
+        (self.dir / uid / 'tombstone.yaml').write_text(YAML.dumps({
+            'deleted': datetime.now().timestamp(),
+        }))
+
+    def pending(self):
+        if not self.dir.is_dir():
+            return []
+        return [tombstone.name for tombstone in self.dir.iterdir()
+                if self.deleted_at(tombstone) is None]
+
+    @staticmethod
+    def contents(tombstone: Path):
+        """Files with their sizes and dirs, deepest first"""
+        files, dirs = [], []
+        for root, dir_names, file_names in os.walk(tombstone, topdown=False):
+            for name in file_names:
+                path = Path(root) / name
+                files.append((path, path.lstat().st_size))
+            dirs.extend(Path(root) / name for name in dir_names)
+        return files, dirs + [tombstone]
+
+    async def collect(self, max_age: float = 0, rate: int = None):
+        """Deletes tombstones older than max_age seconds
+
+        rate bounds the deletion in bytes per second, so reclaiming thousands
+        of segments doesn't starve other disk I/O. Pending tombstones are
+        left to DB.settle_trash().
+        """
+        if not self.dir.is_dir():
+            return []
+
+        collected = []
+        now = datetime.now().timestamp()
+        limiter = RateLimiter(rate)
+
+        for tombstone in await asyncio.to_thread(list, self.dir.iterdir()):
+            deleted = await asyncio.to_thread(self.deleted_at, tombstone)
+            if deleted is None or now - deleted < max_age:
+                continue
+
+            files, dirs = await asyncio.to_thread(self.contents, tombstone)
+            for path, size in files:
+                await limiter.consume(size)
+                await asyncio.to_thread(path.unlink)
+            for dir in dirs:
+                await asyncio.to_thread(os.rmdir, dir)
+            collected.append(tombstone.name)
+
+        return collected
+
+
+class Record(MutableMapping):
+    """A catalog record that behaves like the dict it's loaded from
+
+    Known fields live in slots, of the base class or of the subclass for the
+    record's kind, and anything else in a dict of extras created on demand.
+    That saves the per-record dict and key strings, a few hundred bytes per
+    record in a large catalog. Paths are kept as str, short repeated values
+    are interned. Iteration follows the schema order, then the extras.
+    """
+
+    fields = (
+        'uid', 'original_name', 'original_size', 'original_hash', 'title',
+        'description', 'encrypted', 'iv', 'creation_time', 'kind',
+        'mime_type', 'thumbnail', 'compression', 'file', 'hash', 'size',
+    )
+    __slots__ = fields + ('extra',)
+    field_set = frozenset(fields)
+    interned = frozenset(('kind', 'mime_type', 'compression', 'language'))
+    kinds = {}  # kind -> subclass
+
+    def __init_subclass__(cls, kind: str, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.fields = Record.fields + cls.__slots__
+        cls.field_set = frozenset(cls.fields)
+        Record.kinds[kind] = cls
+
+    def __init__(self, items: Mapping = ()):
+        self.extra = None
+        for key, value in dict(items).items():
+            self[key] = value
+
+    @staticmethod
+    def from_dict(record: Mapping):
+        return Record.kinds.get(record.get('kind'), Record)(record)
+
+    def __getitem__(self, key: str):
+        if key in self.field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key: str, value):
+        if isinstance(value, Path):
+            value = str(value)
+        if key in self.field_set:
+            if key in self.interned and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key: str):
+        if key in self.field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        for key in self.fields:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def copy(self):
+        return type(self)(self)
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            missing = object()
+            return all(
+                getattr(self, key, missing) == getattr(other, key, missing)
+                for key in self.fields) and \
+                (self.extra or None) == (other.extra or None)
+        return super().__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)!r})'
+
+
+class VideoRecord(Record, kind='video'):
+    __slots__ = ('duration', 'storyboard', 'encoding')
+
+
+class BookRecord(Record, kind='book'):
+    __slots__ = ('author', 'language', 'optimization', 'optimization_saved')
+
+
+class GalleryRecord(Record, kind='gallery'):
+    __slots__ = ('pages',)
+
+
+class ChangeLog:
+    """Catalog changes by generation under root_dir/.changes
+
+    generation.yaml holds the epoch, the current generation and the oldest
+    one clients can still catch up from (base). Every catalog write that
+    changes records bumps the generation and stores the changed records, and
+    {uid, _removed} for removed ones, in <generation>.yaml.enc, encrypted
+    like the catalog. Only the last `limit` generations are kept.
+
+    Readers don't need the key: since() returns the encrypted entries after
+    a client's generation, or None instead if it has to reload the whole
+    catalog. Replacing the catalog wholesale resets the log, which starts a
+    new epoch.
+
+    Writers hold an flock on .changes/lock from reading the catalog to
+    writing it and the append, see locked() and DB. generation.yaml also
+    stamps the catalog it goes
+    with, so a catalog written without its generation (a crash in between)
+    sends clients to a full reload rather than a delta that misses it.
+    """
+
+    limit = 256
+
+    def __init__(self, root_dir: Path):
+        self.dir = root_dir / '.changes'
+        self.state_file = self.dir / 'generation.yaml'
+        self.lock_file = self.dir / 'lock'
+        self.catalog_file = root_dir / 'db.yaml.enc'
+
+    def catalog_stamp(self):
+        try:
+            stat = self.catalog_file.stat()
+        except FileNotFoundError:
+            return None
+        return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+    def locked(self):
+        """Excludes other writers, also those in other processes"""
+        return file_lock(self.lock_file)
+
+    def state(self):
+        if self.state_file.is_file():
+            return YAML.loads(self.state_file.read_text())
+        return {'epoch': None, 'generation': 0, 'base': 0}
+
+    def save_state(self, state: dict):
+        # Readers go by this file, it moves on once the entries are there
+        self.dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.state_file.with_suffix('.tmp')
+        tmp_file.write_text(YAML.dumps(state))
+        os.replace(tmp_file, self.state_file)
+
+    def reset(self):
+        """Starts a new epoch, clients reload the catalog"""
+        # The lock file stays, writers may be waiting on it
+        for path in self.dir.glob('*.yaml.enc'):
+            path.unlink(missing_ok=True)
+        self.save_state({
+            'epoch': random_string(8),
+            'generation': 0,
+            'base': 0,
+            'catalog': self.catalog_stamp(),
+        })
+
+    async def append(self, entries: list[dict], key: str, iv: str, tmp: Tmp):
+        """Logs the entries of a catalog write that just happened, under
+        locked(). No entries only stamps the catalog.
+        """
+        state = self.state()
+        if not state['epoch']:
+            state['epoch'] = random_string(8)
+        generation = state['generation'] + bool(entries)
+
+        self.dir.mkdir(parents=True, exist_ok=True)
+        if entries:
+            pt_path = tmp.file()
+            pt_path.write_text(YAML.dumps(entries))
+            await Cmd.encrypt_file(
+                pt_path, self.dir / f'{generation}.yaml.enc', key, iv)
+
+        base = max(state['base'], generation - self.limit)
+        for old in range(state['base'] + 1, base + 1):
+            (self.dir / f'{old}.yaml.enc').unlink(missing_ok=True)
+
+        self.save_state({
+            'epoch': state['epoch'],
+            'generation': generation,
+            'base': base,
+            'catalog': self.catalog_stamp(),
+        })
+
+    def since(self, epoch: str, generation: int):
+        """The current epoch and generation, with the encrypted entries of
+        each generation after the given one as 'changes'. That's None if the
+        log doesn't reach back that far or is of another epoch.
+        """
+        state = self.state()
+        if epoch != state['epoch'] or \
+                not state['base'] <= generation <= state['generation'] or \
+                state.get('catalog') != self.catalog_stamp():
+            return {**state, 'changes': None}
+
+        changes = []
+        for n in range(generation + 1, state['generation'] + 1):
+            try:
+                changes.append((self.dir / f'{n}.yaml.enc').read_bytes())
+            except FileNotFoundError:
+                changes = None  # Trimmed meanwhile
+                break
+        return {**state, 'changes': changes}
+
+
 class DB:
     def __init__(self, key: str, tmp: Tmp, root_dir: Path = None):
         self.key = key
@@ -630,6 +1842,8 @@ class DB:
 
         self.db_file = self.root_dir / 'db.yaml.enc'
         self.media_dir = self.root_dir / 'media'
+        self.trash = Trash(self.root_dir)
+        self.changes = ChangeLog(self.root_dir)
 
         key_info_file = self.root_dir / 'key_info.yaml'
         key_hash = hashlib.sha256(bytes.fromhex(self.key)).hexdigest()[:6]
@@ -648,24 +1862,50 @@ class DB:
             key_info_file.write_text(yaml)
 
         self.iv = info["iv"]
+        self.index = SearchIndex(self.key, self.iv, self.tmp, self.root_dir)
 
     async def __aenter__(self):
-        self.pt_path = self.tmp.file()
-
-        if self.db_file.is_file():
-            await Cmd.decrypt_file(
-                self.db_file, self.pt_path, self.key, self.iv)
-            yaml = self.pt_path.read_text()
-            self.db = YAML.loads(yaml)
-        else:
-            self.db = []
-
+        # Held until __aexit__, so concurrent writers, also in other
+        # processes, don't write back stale copies over each other. Only
+        # taken, then the state set, in case this instance is shared.
+        stack = contextlib.AsyncExitStack()
+        await stack.enter_async_context(self.changes.locked())
+        try:
+            pt_path = self.tmp.file()
+            if self.db_file.is_file():
+                await Cmd.decrypt_file(
+                    self.db_file, pt_path, self.key, self.iv)
+                yaml = pt_path.read_text()
+                db = [Record.from_dict(record) for record in YAML.loads(yaml)]
+            else:
+                db = []
+        except BaseException:
+            await stack.aclose()
+            raise
+
+        self.unlock = stack.aclose
+        self.pt_path = pt_path
+        self.db = db
+        # Copies to tell what changed, records are edited in place
+        self.snapshot = {record['uid']: record.copy() for record in self.db}
         return self.db
 
     async def __aexit__(self, exc_type, exc_value, traceback):
-        yaml = YAML.dumps(self.db)
-        self.pt_path.write_text(yaml)
-        await Cmd.encrypt_file(self.pt_path, self.db_file, self.key, self.iv)
+        try:
+            yaml = YAML.dumps(self.db)
+            self.pt_path.write_text(yaml)
+
+            uids = {record['uid'] for record in self.db}
+            entries = [record for record in self.db
+                       if self.snapshot.get(record['uid']) != record]
+            entries += [{'uid': uid, '_removed': True}
+                        for uid in self.snapshot if uid not in uids]
+
+            await Cmd.encrypt_file(
+                self.pt_path, self.db_file, self.key, self.iv)
+            await self.changes.append(entries, self.key, self.iv, self.tmp)
+        finally:
+            await self.unlock()
         return exc_type is None
 
     def print_record(self, record: dict):
@@ -690,41 +1930,1569 @@ class DB:
     def clear(self):
         if self.db_file.is_file():
             self.db_file.unlink()
+        self.changes.reset()
         if self.media_dir.is_dir():
             shutil.rmtree(self.media_dir)
 
     async def remove(self, uid_list: list[str]):
+        await self.settle_trash()
+        buried = []
+        try:
+            async with self as db:
+                uid_set = set(uid_list)
+                all_uid_set = {record['uid'] for record in db}
+
+                to_remove = uid_set.intersection(all_uid_set)
+                not_found = uid_set - all_uid_set
+
+                # Into the trash before the catalog drops them, a crash in
+                # between leaves pending tombstones for settle_trash()
+                removed = [r for r in db if r['uid'] in to_remove]
+                for record in removed:
+                    buried.append(record['uid'])
+                    await self.bury(record)
+                db[:] = [r for r in db if r['uid'] not in to_remove]
+        except BaseException:
+            for uid in buried:
+                self.unbury(uid)
+            raise
+
+        # Space is reclaimed later by Trash.collect()
+        for uid in buried:
+            self.trash.mark_deleted(uid)
+        if removed:
+            await self.index.remove([r['uid'] for r in removed])
+
+        if to_remove:
+            print(f"Removed: {' '.join(to_remove)}")
+        if not_found:
+            print(f"Not found: {' '.join(not_found)}")
+        return {'removed': sorted(to_remove), 'not_found': sorted(not_found)}
+
+    async def bury(self, record: dict):
+        tombstone = self.trash.dir / record['uid']
+        tombstone.mkdir(parents=True, exist_ok=True)
+
+        # Keep the record for restore, encrypted like the catalog
+        pt_path = self.tmp.file()
+        pt_path.write_text(YAML.dumps(record))
+        await Cmd.encrypt_file(
+            pt_path, tombstone / 'record.yaml.enc', self.key, self.iv)
+
+        resource_dir = self.media_dir / record['uid']
+        if resource_dir.is_dir():
+            os.replace(resource_dir, tombstone / 'media')
+
+    def unbury(self, uid: str):
+        """Undoes a bury whose record the catalog still lists"""
+        tombstone = self.trash.dir / uid
+        if (tombstone / 'media').is_dir():
+            os.replace(tombstone / 'media', self.media_dir / uid)
+        shutil.rmtree(tombstone, ignore_errors=True)
+
+    async def settle_trash(self):
+        """Finishes removals interrupted between bury and the catalog write"""
+        pending = self.trash.pending()
+        if not pending:
+            return
         async with self as db:
-            uid_set = set(uid_list)
-            all_uid_set = {record['uid'] for record in db}
-
-            to_remove = uid_set.intersection(all_uid_set)
-            not_found = uid_set - all_uid_set
+            uids = {record['uid'] for record in db}
+        for uid in pending:
+            if uid in uids:
+                self.unbury(uid)
+            else:
+                self.trash.mark_deleted(uid)
 
-            db[:] = [r for r in db if r['uid'] not in to_remove]
+    async def restore(self, uid_list: list[str]):
+        await self.settle_trash()
+        restored = []
 
-            for uid in to_remove:
-                resource_dir = self.media_dir / uid
-                if resource_dir.is_dir():
-                    shutil.rmtree(resource_dir)
+        records = []
+        async with self as db:
+            live = {record['uid'] for record in db}
+            for uid in dict.fromkeys(uid_list):
+                tombstone = self.trash.dir / uid
+                record_file = tombstone / 'record.yaml.enc'
+                if uid in live:
+                    print(f"Already in the catalog: {uid}")
+                    continue
+                if not re.match('[0-9A-Za-z]+$', uid) or \
+                        not record_file.is_file():
+                    print(f"Not in trash: {uid}")
+                    continue
 
-            if to_remove:
-                print(f"Removed: {' '.join(to_remove)}")
-            if not_found:
-                print(f"Not found: {' '.join(not_found)}")
+                pt_path = self.tmp.file()
+                await Cmd.decrypt_file(record_file, pt_path, self.key, self.iv)
+
+                if (tombstone / 'media').is_dir():
+                    os.replace(tombstone / 'media', self.media_dir / uid)
+                record = YAML.loads(pt_path.read_text())
+                db.append(record)
+                records.append(record)
+                restored.append(uid)
+
+        # Only once the catalog lists them again
+        for uid in restored:
+            shutil.rmtree(self.trash.dir / uid)
+        for record in records:
+            await self.index.index(record, await self.index.read_body(record))
+        if restored:
+            print(f"Restored: {' '.join(restored)}")
+        return restored
 
     async def append(self, record: dict):
         async with self as db:
             db.append(record)
 
+    async def add(self, records: list[dict], texts: list[str] = None):
+        """Appends records with a single catalog write, then indexes them"""
+        async with self as db:
+            db.extend(records)
+
+        # The records are committed, don't fail the import over the index.
+        # Missing postings are recovered by reindex, postings of records
+        # that were never added wouldn't be.
+        texts = texts or [None] * len(records)
+        changes = {}
+        for record, text in zip(records, texts):
+            changes[record['uid'], 'meta'] = SearchIndex.meta_text(record)
+            changes[record['uid'], 'body'] = text
+        try:
+            await self.index.update(changes)
+        except Exception as e:
+            print(f"Indexing failed, run reindex: {e}", file=sys.stderr)
+
     async def load(self, file: Path):
-        await Cmd.encrypt_file(file, self.db_file, self.key, self.iv)
+        async with self.changes.locked():
+            await Cmd.encrypt_file(file, self.db_file, self.key, self.iv)
+            self.changes.reset()
 
     async def save(self, file: str):
         await Cmd.decrypt_file(self.db_file, file, self.key, self.iv)
 
 
+class Scrubber:
+    """Verifies resource dirs against their md5sum.txt and the catalog
+
+    Progress is checkpointed to root_dir/.scrub, so an interrupted scan
+    resumes where it stopped. In incremental mode, resources whose files
+    are unchanged (by mtime and size) since they last passed are skipped.
+
+    Quarantine moves corrupted resources to root_dir/.quarantine and marks
+    their records 'quarantined' (with the problems) in the same catalog
+    write, clients and publish leave those out. A quarantined record whose
+    resource is put back is checked again and unmarked if it passes.
+    """
+
+    checkpoint_interval = 100
+    # uids per list in progress(), the report returned by scrub() has all
+    progress_limit = 100
+
+    def __init__(
+        self,
+        db: DB,
+        workers: int = 4,
+        rate: int = None,
+        incremental: bool = False,
+        quarantine: bool = False,
+        repair: bool = False,
+        orphan_age: float = 3600,
+    ):
+        self.db = db
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.incremental = incremental
+        self.quarantine = quarantine
+        self.repair = repair
+        # Younger dirs without a record may belong to a running import
+        self.orphan_age = orphan_age
+
+        self.state_dir = db.root_dir / '.scrub'
+        self.state_file = self.state_dir / 'state.yaml'
+        self.run_file = self.state_dir / 'run.yaml'
+        self.quarantine_dir = db.root_dir / '.quarantine'
+
+        self.report = {
+            'ok': [],
+            'skipped': [],
+            'corrupted': [],
+            'missing': [],
+            'orphaned': [],
+            'quarantined': [],
+        }
+        self.total = 0
+
+    @staticmethod
+    def signature(resource_dir: Path):
+        size, mtime = 0, 0
+        for path in resource_dir.rglob('*'):
+            stat = path.stat()
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+        return size, mtime
+
+    def load_state(self):
+        state = {}
+        if self.state_file.is_file():
+            for entry in YAML.loads(self.state_file.read_text()):
+                state[entry['uid']] = entry
+
+        run = YAML.loads(self.run_file.read_text()) \
+            if self.run_file.is_file() else {}
+        if run and not run['finished']:
+            return state, run['run']
+
+        run_id = random_string(8)
+        self.save_state(state, run_id)
+        return state, run_id
+
+    def save_state(self, state: dict, run_id: str, finished: bool = False):
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.state_file.with_suffix('.tmp')
+        tmp_file.write_text(YAML.dumps(list(state.values())))
+        os.replace(tmp_file, self.state_file)
+        self.run_file.write_text(YAML.dumps({
+            'run': run_id,
+            'finished': finished,
+        }))
+
+    async def hash_file(self, path: Path):
+        await self.limiter.consume(path.stat().st_size)
+        return await asyncio.to_thread(calculate_md5, path)
+
+    async def verify(self, record: dict):
+        """Returns a list of problems, empty if the resource is intact"""
+        resource_dir = self.db.media_dir / record['uid']
+        md5_file = resource_dir / 'md5sum.txt'
+        if not md5_file.is_file():
+            return ['md5sum.txt missing']
+
+        problems = []
+        for line in md5_file.read_text().splitlines():
+            if not line.strip():
+                continue
+            expected, name = line.split(None, 1)
+            path = resource_dir / name
+            if not path.is_file():
+                problems.append(f'{name} missing')
+            elif await self.hash_file(path) != expected:
+                problems.append(f'{name} corrupted')
+
+        size = du_dir(resource_dir)
+        if record.get('size') is not None and size != record['size']:
+            problems.append(f"size {size} != {record['size']}")
+
+        return problems
+
+    async def isolate(self, resource_dir: Path):
+        self.quarantine_dir.mkdir(parents=True, exist_ok=True)
+        target = self.quarantine_dir / resource_dir.name
+        if target.exists():
+            # Quarantined before, put back and gone bad again
+            target = target.with_name(f'{target.name}.{random_string(6)}')
+        os.replace(resource_dir, target)
+
+    async def scrub(self):
+        async with self.db as db:
+            uids = {r['uid'] for r in db}
+            # Known bad, unless the resource was put back
+            records = [r for r in db if not r.get('quarantined') or
+                       (self.db.media_dir / r['uid']).is_dir()]
+
+        state, run_id = self.load_state()
+        self.total = len(records)
+        # uid -> problems, moved and marked with one catalog write
+        to_isolate = {}
+        recovered = []
+
+        semaphore = asyncio.Semaphore(self.workers)
+        since_checkpoint = 0
+
+        async def check(record: dict):
+            nonlocal since_checkpoint
+            uid = record['uid']
+            resource_dir = self.db.media_dir / uid
+            last = state.get(uid)
+
+            if not resource_dir.is_dir():
+                self.report['missing'].append(uid)
+                return
+
+            async with semaphore:
+                size, mtime = await asyncio.to_thread(
+                    Scrubber.signature, resource_dir)
+                unchanged = last and last['size'] == size and \
+                    last['mtime'] == mtime and last['status'] == 'ok'
+
+                if last and last['run'] == run_id or \
+                        self.incremental and unchanged:
+                    # Done earlier in this run or nothing changed since
+                    status = last['status']
+                    self.report['skipped'].append(uid)
+                    if status == 'ok':
+                        return
+                    problems = [last['problems']]
+                else:
+                    problems = await self.verify(record)
+                    status = 'corrupted' if problems else 'ok'
+                    state[uid] = {
+                        'uid': uid,
+                        'run': run_id,
+                        'status': status,
+                        'problems': '; '.join(problems),
+                        'size': size,
+                        'mtime': mtime,
+                        'checked': datetime.now().astimezone().isoformat(),
+                    }
+
+                    since_checkpoint += 1
+                    if since_checkpoint >= self.checkpoint_interval:
+                        self.save_state(state, run_id)
+                        since_checkpoint = 0
+
+            if status == 'ok':
+                self.report['ok'].append(uid)
+                if record.get('quarantined'):
+                    recovered.append(uid)
+            else:
+                self.report['corrupted'].append(
+                    {'uid': uid, 'problems': problems})
+                if self.quarantine:
+                    to_isolate[uid] = '; '.join(problems)
+
+        await asyncio.gather(*(check(r) for r in records))
+
+        if to_isolate or recovered:
+            async with self.db as db:
+                for record in db:
+                    uid = record['uid']
+                    resource_dir = self.db.media_dir / uid
+                    if uid in recovered:
+                        record.pop('quarantined', None)
+                    elif uid in to_isolate and resource_dir.is_dir():
+                        await self.isolate(resource_dir)
+                        record['quarantined'] = to_isolate[uid]
+                        self.report['quarantined'].append(uid)
+
+        now = datetime.now().timestamp()
+        if self.db.media_dir.is_dir():
+            for resource_dir in self.db.media_dir.iterdir():
+                if resource_dir.name in uids or \
+                        now - resource_dir.stat().st_mtime < self.orphan_age:
+                    continue
+                self.report['orphaned'].append(resource_dir.name)
+                if self.quarantine:
+                    await self.isolate(resource_dir)
+
+        if self.repair and self.report['missing']:
+            await self.db.remove(self.report['missing'])
+
+        # Forget records that are gone
+        state = {uid: entry for uid, entry in state.items() if uid in uids}
+        self.save_state(state, run_id, finished=True)
+        return self.report
+
+    def progress(self):
+        """Counts, with the last progress_limit entries of each list"""
+        return {
+            'total': self.total,
+            'checked': len(self.report['ok']) +
+            len(self.report['corrupted']) + len(self.report['missing']),
+            'counts': {name: len(entries)
+                       for name, entries in self.report.items()},
+            **{name: entries[-self.progress_limit:]
+               for name, entries in self.report.items()},
+        }
+
+
+class Rekeyer:
+    """Re-encrypts the whole library from the db's key to new_key
+
+    Every resource is rebuilt under root_dir/.rekey/<uid> with fresh IVs and
+    then swapped in, so a crash leaves each resource either old or new.
+    Progress is checkpointed, a resource is marked swapped before the swap
+    begins, and the catalog and key_info.yaml switch over at the very end.
+    Don't run it while the server is writing to the library.
+    """
+
+    def __init__(self, db: DB, new_key: str, workers: int = 4):
+        self.db = db
+        self.new_key = new_key
+        self.workers = workers
+
+        self.work_dir = db.root_dir / '.rekey'
+        self.state_file = self.work_dir / 'state.yaml'
+        self.progress_file = self.work_dir / 'progress.yaml'
+
+    @staticmethod
+    def is_encrypted(path: Path, resource_dir: Path):
+        rel = path.relative_to(resource_dir)
+        # HLS segments are encrypted via the key info file, the fMP4 init
+        # segment precedes the key in the playlist and stays plain
+        return path.suffix == '.enc' or \
+            rel.parts[0] == 'seg' and path.name != 'init.mp4'
+
+    @staticmethod
+    def committing(root_dir: Path):
+        """Whether a rekey got as far as switching to the new key"""
+        state_file = root_dir / '.rekey' / 'state.yaml'
+        return state_file.is_file() and \
+            YAML.loads(state_file.read_text())['phase'] == 'commit'
+
+    def load_progress(self, records: list[dict]):
+        key_hash = hashlib.sha256(bytes.fromhex(self.new_key)).hexdigest()[:6]
+
+        if self.state_file.is_file():
+            state = YAML.loads(self.state_file.read_text())
+            if state['key_hash'] != key_hash:
+                raise ValueError("Another rekey to a different key is pending")
+            progress = {entry['uid']: entry for entry in
+                        YAML.loads(self.progress_file.read_text())}
+        else:
+            self.work_dir.mkdir(parents=True, exist_ok=True)
+            state = {'key_hash': key_hash, 'phase': 'resources'}
+            progress = {
+                r['uid']: {
+                    'uid': r['uid'],
+                    'iv': random_string(32, 'h'),
+                    'done': False,
+                }
+                for r in records if r.get('encrypted')
+            }
+            self.save_progress(progress)
+            self.state_file.write_text(YAML.dumps(state))
+
+        return state, progress
+
+    def save_progress(self, progress: dict):
+        tmp_file = self.progress_file.with_suffix('.tmp')
+        tmp_file.write_text(YAML.dumps(list(progress.values())))
+        os.replace(tmp_file, self.progress_file)
+
+    async def rekey_resource(self, record: dict, new_iv: str):
+        uid = record['uid']
+        resource_dir = self.db.media_dir / uid
+        new_dir = self.work_dir / uid
+        old_dir = self.work_dir / f'{uid}.old'
+
+        # Old content moved aside by an interrupted run
+        if not resource_dir.exists() and old_dir.is_dir():
+            os.replace(old_dir, resource_dir)
+
+        if not resource_dir.is_dir():
+            print(f"Missing, skipped: {uid}")
+            return False
+
+        if new_dir.exists():
+            shutil.rmtree(new_dir)
+
+        for path in sorted(resource_dir.rglob('*')):
+            target = new_dir / path.relative_to(resource_dir)
+            if path.is_dir() or path.name == 'md5sum.txt':
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+
+            if self.is_encrypted(path, resource_dir):
+                await Cmd.reencrypt_file(
+                    path, target, self.db.key, record['iv'],
+                    self.new_key, new_iv)
+            elif path.suffix == '.m3u8':
+                target.write_text(re.sub(
+                    r'IV=0x[0-9a-fA-F]+', f'IV=0x{new_iv}', path.read_text()))
+            else:
+                place_file(path, target)
+
+        md5 = await Cmd.get_md5(new_dir)
+        (new_dir / 'md5sum.txt').write_text(md5)
+        return True
+
+    def swap(self, uid: str):
+        """Moves the rebuilt resource in, resumable at any point"""
+        resource_dir = self.db.media_dir / uid
+        new_dir = self.work_dir / uid
+        old_dir = self.work_dir / f'{uid}.old'
+
+        if new_dir.is_dir():
+            if resource_dir.is_dir():
+                os.replace(resource_dir, old_dir)
+            os.replace(new_dir, resource_dir)
+        if old_dir.exists():
+            shutil.rmtree(old_dir)
+
+    async def commit(self, records: list[dict], progress: dict):
+        new_iv = random_string(32, 'h')
+        key_info_file = self.work_dir / 'key_info.yaml'
+        db_file = self.work_dir / 'db.yaml.enc'
+
+        for record in records:
+            if record['uid'] in progress:
+                record['iv'] = progress[record['uid']]['iv']
+
+        key_info_file.write_text(YAML.dumps({
+            'key_hash': hashlib.sha256(
+                bytes.fromhex(self.new_key)).hexdigest()[:6],
+            'iv': new_iv,
+        }))
+        pt_path = self.db.tmp.file()
+        pt_path.write_text(YAML.dumps(records))
+        await Cmd.encrypt_file(pt_path, db_file, self.new_key, new_iv)
+
+        self.state_file.write_text(YAML.dumps({
+            **YAML.loads(self.state_file.read_text()),
+            'phase': 'commit',
+        }))
+        await self.switch()
+
+    async def switch(self):
+        """Moves the new catalog and key in, then rebuilds the index
+
+        The work dir, with the commit phase, stays until the index is done.
+        """
+        async with self.db.changes.locked():
+            for name in ('db.yaml.enc', 'key_info.yaml'):
+                if (self.work_dir / name).is_file():
+                    os.replace(self.work_dir / name, self.db.root_dir / name)
+            # Logged under the old key
+            self.db.changes.reset()
+
+        # Term ids are keyed hashes, the index can't be converted
+        new_db = DB(self.new_key, self.db.tmp, self.db.root_dir)
+        async with new_db as db:
+            records = list(db)
+        await new_db.index.rebuild(records)
+        shutil.rmtree(self.work_dir)
+
+    async def rekey(self):
+        if self.db.trash.dir.is_dir() and any(self.db.trash.dir.iterdir()):
+            raise ValueError("Empty the trash before rekeying")
+
+        if self.committing(self.db.root_dir):
+            # Crashed while switching over, the new catalog is ready
+            await self.switch()
+            return
+
+        async with self.db as db:
+            records = [dict(r) for r in db]
+
+        state, progress = self.load_progress(records)
+        by_uid = {r['uid']: r for r in records}
+        semaphore = asyncio.Semaphore(self.workers)
+        lock = asyncio.Lock()
+
+        async def checkpoint(entry: dict, **changes):
+            async with lock:
+                entry.update(changes)
+                self.save_progress(progress)
+
+        async def rekey_one(entry: dict):
+            if entry['done'] or entry['uid'] not in by_uid:
+                return
+            # Swapped content is under the new key already, re-encrypting
+            # it from the old one would fail for good
+            if not entry.get('swapped'):
+                async with semaphore:
+                    built = await self.rekey_resource(
+                        by_uid[entry['uid']], entry['iv'])
+                if built:
+                    await checkpoint(entry, swapped=True)
+            if entry.get('swapped'):
+                self.swap(entry['uid'])
+            async with lock:
+                entry['done'] = True
+                self.save_progress(progress)
+                done = sum(e['done'] for e in progress.values())
+                print(f"Rekeyed {done}/{len(progress)}: {entry['uid']}")
+
+        await asyncio.gather(*(rekey_one(e) for e in progress.values()))
+        await self.commit(records, progress)
+
+
+class Regenerator:
+    """Rebuilds derivatives of existing records with the current options
+
+    'thumbnail' rebuilds thumbnails from the media itself where the kind has
+    one, else from the title. Thumbnails users picked are kept unless
+    replace_custom_thumbnails is set. 'file'
+    rebuilds the main derivative: HLS and storyboard, WebP images, gallery
+    pages, or just re-encrypts (and compresses) books, notes and files.
+    Originals aren't kept, so the stored media is decrypted back into a
+    source, e.g. a video from its segments.
+
+    Like Rekeyer, each resource is rebuilt under root_dir/.regen and
+    progress is checkpointed so an interrupted run resumes. Rebuilt
+    resources wait there and are swapped in batch_size at a time, within the
+    catalog write that updates their records, so records and files only
+    disagree for the few renames of a batch. The journal marks a batch
+    swapped before it starts, a resumed run finishes it.
+    """
+
+    derivatives = ('thumbnail', 'file')
+    # Resources swapped in per catalog write
+    batch_size = 100
+    # Record fields each derivative owns
+    fields = {
+        'thumbnail': ('thumbnail', 'custom_thumbnail'),
+        'file': ('file', 'mime_type', 'compression', 'duration', 'storyboard',
+                 'encoding', 'pages', 'optimization', 'optimization_saved'),
+    }
+
+    def __init__(
+        self,
+        db: DB,
+        derivatives: list[str],
+        kinds: list[str] = None,
+        uids: list[str] = None,
+        where: list[str] = None,
+        workers: int = 4,
+        replace_custom_thumbnails: bool = False,
+        **options,
+    ):
+        self.db = db
+        self.derivative_list = sorted(set(derivatives))
+        self.replace_custom_thumbnails = replace_custom_thumbnails
+        self.kinds = kinds
+        self.uids = uids
+        self.where = [condition.split('=', 1) for condition in where or []]
+        self.workers = workers
+        self.options = {k: v for k, v in options.items() if v is not None}
+
+        for derivative in self.derivative_list:
+            if derivative not in self.derivatives:
+                raise ValueError(f"Unknown derivative: {derivative}")
+
+        self.work_dir = db.root_dir / '.regen'
+        self.state_file = self.work_dir / 'state.yaml'
+        self.progress_file = self.work_dir / 'progress.yaml'
+        self.results_dir = self.work_dir / 'results'
+        self.total = self.done = 0
+        self.failed = []
+
+    def derivatives_of(self, record: dict):
+        """What is rebuilt for the record"""
+        return [d for d in self.derivative_list
+                if d != 'thumbnail' or self.replace_custom_thumbnails or
+                not record.get('custom_thumbnail')]
+
+    def selects(self, record: dict):
+        if not self.derivatives_of(record):
+            return False
+        if self.kinds and record['kind'] not in self.kinds:
+            return False
+        if self.uids and record['uid'] not in self.uids:
+            return False
+        return all(fnmatch.fnmatchcase(str(record.get(field, '')), pattern)
+                   for field, pattern in self.where)
+
+    def load_progress(self, records: list[dict]):
+        # Font paths and the like are fine to compare as strings
+        state = {
+            'derivatives': ','.join(self.derivative_list),
+            **{k: str(v) for k, v in self.options.items()},
+        }
+        if self.replace_custom_thumbnails:
+            state['replace_custom_thumbnails'] = 'True'
+
+        if self.state_file.is_file():
+            if YAML.loads(self.state_file.read_text()) != state:
+                raise ValueError(
+                    "A regeneration with other settings is pending, rerun it "
+                    f"or remove {self.work_dir}")
+            progress = {entry['uid']: entry for entry in
+                        YAML.loads(self.progress_file.read_text())}
+        else:
+            self.results_dir.mkdir(parents=True, exist_ok=True)
+            progress = {r['uid']: {'uid': r['uid'], 'done': False}
+                        for r in records if self.selects(r)}
+            self.save_progress(progress)
+            self.state_file.write_text(YAML.dumps(state))
+
+        return progress
+
+    def save_progress(self, progress: dict):
+        tmp_file = self.progress_file.with_suffix('.tmp')
+        tmp_file.write_text(YAML.dumps(list(progress.values())))
+        os.replace(tmp_file, self.progress_file)
+
+    async def decrypt(self, record: dict, path: Path, output: Path):
+        if record.get('encrypted'):
+            await Cmd.decrypt_file(path, output, self.db.key, record['iv'])
+        else:
+            place_file(path, output)
+
+    async def extract_source(self, record: dict, tmp: Tmp):
+        """Turns the stored media back into something importable"""
+        root_dir = self.db.root_dir
+        kind = record['kind']
+
+        if kind == 'video':
+            playlist = root_dir / record['file']
+            lines = playlist.read_text().splitlines()
+            init = next((re.search(r'URI="([^"]+)"', line).group(1)
+                         for line in lines if line.startswith('#EXT-X-MAP')),
+                        None)
+            segments = [line for line in lines
+                        if line and not line.startswith('#')]
+
+            # A thumbnail only needs the part around its seek point
+            if 'file' not in self.derivative_list:
+                seek = min((record.get('duration') or 0) * 0.1, 60)
+                durations = [float(re.match(r'#EXTINF:([\d.]+)', line)[1])
+                             for line in lines if line.startswith('#EXTINF')]
+                elapsed = 0
+                for count, duration in enumerate(durations, 1):
+                    elapsed += duration
+                    if elapsed > seek + 1:
+                        segments = segments[:count]
+                        break
+
+            source = tmp.file(suffix='.mp4' if init else '.ts')
+            with open(source, 'wb') as f_out:
+                if init:
+                    # The init segment isn't encrypted
+                    with open(playlist.parent / init, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out)
+                for segment in segments:
+                    pt_path = tmp.file()
+                    await self.decrypt(
+                        record, playlist.parent / segment, pt_path)
+                    with open(pt_path, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out)
+                    pt_path.unlink()
+            return source
+
+        if kind == 'gallery':
+            index_path = tmp.file()
+            await self.decrypt(record, root_dir / record['file'], index_path)
+            pages_dir = tmp.dir()
+            for page in YAML.loads(index_path.read_text()):
+                await self.decrypt(record, root_dir / page['file'],
+                                   pages_dir / f"{page['page']:04d}.webp")
+            return pages_dir
+
+        # Books are stored as .epub, images as .webp, keep the suffix
+        name = record['original_name'] if kind == 'file' else \
+            Path(record['file']).name.removesuffix('.enc').removesuffix('.gz')
+        source = tmp.dir() / name
+        await self.decrypt(record, root_dir / record['file'], source)
+        if record.get('compression') == 'gzip':
+            gz_path = source.rename(tmp.file(suffix='.gz'))
+            with gzip.open(gz_path, 'rb') as f_in, open(source, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        return source
+
+    async def regenerate_resource(self, record: dict):
+        uid = record['uid']
+        resource_dir = self.db.media_dir / uid
+        new_dir = self.work_dir / 'media' / uid
+        old_dir = self.work_dir / f'{uid}.old'
+        result_file = self.results_dir / f'{uid}.yaml'
+        derivatives = self.derivatives_of(record)
+
+        # Old content moved aside by an interrupted run
+        if not resource_dir.exists() and old_dir.is_dir():
+            os.replace(old_dir, resource_dir)
+
+        if not resource_dir.is_dir():
+            print(f"Missing, skipped: {uid}")
+            return False
+        if new_dir.exists():
+            shutil.rmtree(new_dir)
+
+        tmp = Tmp(self.db.tmp.root)
+        try:
+            source = await self.extract_source(record, tmp)
+            importer = importer_classes[record['kind']](
+                file=source,
+                key=self.db.key,
+                tmp=tmp,
+                title=record['title'],
+                description=record['description'],
+                root_dir=self.db.root_dir,
+                no_encryption=not record.get('encrypted'),
+                **self.options,
+            )
+            # Build into the work dir as the same resource, paths in the
+            # record stay relative to what becomes root_dir/media/<uid>
+            importer.resource_dir.rmdir()
+            importer.uid = importer.record['uid'] = uid
+            importer.root_dir = self.work_dir
+            importer.resource_dir = new_dir
+            new_dir.mkdir(parents=True)
+            if record.get('encrypted'):
+                importer.iv = importer.record['iv'] = record['iv']
+
+            await importer.run_stages([
+                {'thumbnail': 'create_thumbnail', 'file': 'process_file'}[d]
+                for d in derivatives])
+        finally:
+            tmp.cleanup()
+
+        # Carry over what isn't rebuilt
+        for path in resource_dir.rglob('*'):
+            rel = path.relative_to(resource_dir)
+            is_thumbnail = len(rel.parts) == 1 and \
+                path.name.startswith('thumbnail.')
+            owner = 'thumbnail' if is_thumbnail else 'file'
+            if path.is_dir() or path.name == 'md5sum.txt' or \
+                    owner in derivatives:
+                continue
+            (new_dir / rel).parent.mkdir(parents=True, exist_ok=True)
+            place_file(path, new_dir / rel)
+
+        md5 = await Cmd.get_md5(new_dir)
+        (new_dir / 'md5sum.txt').write_text(md5)
+
+        result = {'size': du_dir(new_dir)}
+        for derivative in derivatives:
+            for field in self.fields[derivative]:
+                result[field] = importer.record.get(field)
+        result_file.write_text(YAML.dumps(result))
+        return True
+
+    def swap(self, uid: str):
+        """Moves the rebuilt resource in, resumable at any point. The old
+        one stays in the work dir until cleanup(), out of the catalog write.
+        """
+        resource_dir = self.db.media_dir / uid
+        new_dir = self.work_dir / 'media' / uid
+        old_dir = self.work_dir / f'{uid}.old'
+
+        if new_dir.is_dir():
+            if resource_dir.is_dir():
+                if old_dir.exists():
+                    shutil.rmtree(old_dir)
+                os.replace(resource_dir, old_dir)
+            os.replace(new_dir, resource_dir)
+
+    def cleanup(self, uid: str):
+        shutil.rmtree(self.work_dir / f'{uid}.old', ignore_errors=True)
+        shutil.rmtree(self.work_dir / 'media' / uid, ignore_errors=True)
+
+    async def commit(self, uids: list[str]):
+        """Swaps the rebuilt resources in and updates their records from
+        the results, with one catalog write
+        """
+        results = {
+            uid: YAML.loads((self.results_dir / f'{uid}.yaml').read_text())
+            for uid in uids
+        }
+        async with self.db as db:
+            for record in db:
+                result = results.get(record['uid'])
+                if result is None:
+                    continue
+                self.swap(record['uid'])
+                for field, value in result.items():
+                    if value is None:
+                        record.pop(field, None)
+                    else:
+                        record[field] = value
+
+        # The old builds, and rebuilds of records removed meanwhile
+        for uid in uids:
+            self.cleanup(uid)
+
+    async def regenerate(self):
+        async with self.db as db:
+            records = [dict(r) for r in db]
+
+        progress = self.load_progress(records)
+        by_uid = {r['uid']: r for r in records}
+        semaphore = asyncio.Semaphore(self.workers)
+        lock = asyncio.Lock()
+        self.total = len(progress)
+        self.done = sum(entry['done'] for entry in progress.values())
+        failed = self.failed = []
+        # Rebuilt and waiting for their batch, or in the batch an
+        # interrupted run was swapping
+        pending = [uid for uid, entry in progress.items()
+                   if entry.get('swapped') and not entry['done']]
+
+        async def flush():
+            async with lock:
+                uids = pending[:]
+                pending.clear()
+                if not uids:
+                    return
+                for uid in uids:
+                    progress[uid]['swapped'] = True
+                self.save_progress(progress)
+                await self.commit(uids)
+                for uid in uids:
+                    progress[uid]['done'] = True
+                self.save_progress(progress)
+                self.done += len(uids)
+                print(f"Regenerated {self.done}/{self.total}")
+
+        async def regenerate_one(entry: dict):
+            uid = entry['uid']
+            if entry['done'] or entry.get('swapped') or uid not in by_uid:
+                return
+            async with semaphore:
+                try:
+                    built = await self.regenerate_resource(by_uid[uid])
+                except Exception as e:
+                    print(f"Failed to regenerate {uid}: {e}")
+                    failed.append(uid)
+                    return
+            if built:
+                pending.append(uid)
+                if len(pending) >= self.batch_size:
+                    await flush()
+
+        await asyncio.gather(*(regenerate_one(e) for e in progress.values()))
+        await flush()
+        shutil.rmtree(self.work_dir)
+        # The failed ones are left as they were
+        regenerated = [uid for uid, entry in progress.items() if entry['done']]
+        return {'regenerated': regenerated, 'failed': failed}
+
+    def progress(self):
+        return {'total': self.total, 'done': self.done,
+                'failed': len(self.failed)}
+
+
+class Backup:
+    """Streams the library as stored, ciphertext only, into a tar archive
+
+    The archive starts with backup_info.yaml and the manifest (backup.yaml)
+    listing every resource, followed by the catalog, key_info.yaml and the
+    resource dirs, each led by its md5sum.txt so a reader can verify it in
+    one pass. The manifest has the digest of each md5sum.txt, which is
+    checked before the files are checked against it. An incremental backup
+    only carries resources that are new or changed according to a previous
+    manifest.
+    """
+
+    manifest_name = 'backup.yaml'
+    info_name = 'backup_info.yaml'
+    catalog_names = ('db.yaml.enc', 'key_info.yaml')
+    # Larger files are streamed by the writer instead of read ahead
+    read_ahead_size = 4 * 1024 * 1024
+
+    def __init__(self, root_dir: Path, workers: int = 4):
+        self.root_dir = root_dir
+        self.media_dir = root_dir / 'media'
+        self.workers = workers
+
+    def scan(self):
+        manifest = {}
+        if not self.media_dir.is_dir():
+            return manifest
+
+        for resource_dir in sorted(self.media_dir.iterdir()):
+            md5_file = resource_dir / 'md5sum.txt'
+            if not md5_file.is_file():
+                continue  # Import in progress
+            size, mtime = Scrubber.signature(resource_dir)
+            manifest[resource_dir.name] = {
+                'uid': resource_dir.name,
+                'digest': calculate_md5(md5_file),
+                'size': size,
+                'mtime': mtime,
+            }
+        return manifest
+
+    @staticmethod
+    def load_manifest(file: Path):
+        return {e['uid']: e for e in YAML.loads(file.read_text())}
+
+    @staticmethod
+    def read_small(path: Path):
+        if path.stat().st_size <= Backup.read_ahead_size:
+            return path.read_bytes()
+        return None
+
+    def read_ahead(self, paths: list[Path]):
+        """Yields (path, data or None) in order, reading in parallel"""
+        with ThreadPoolExecutor(self.workers) as pool:
+            window = deque()
+            for path in paths:
+                window.append((path, pool.submit(Backup.read_small, path)))
+                if len(window) >= self.workers * 4:
+                    path, future = window.popleft()
+                    yield path, future.result()
+            while window:
+                path, future = window.popleft()
+                yield path, future.result()
+
+    def files(self, uids: list[str]):
+        paths = [self.root_dir / name for name in self.catalog_names
+                 if (self.root_dir / name).is_file()]
+        index_dir = self.root_dir / 'index'
+        if index_dir.is_dir():
+            paths.extend(sorted(
+                p for p in index_dir.rglob('*') if p.is_file() and not any(
+                    part.startswith('.')
+                    for part in p.relative_to(index_dir).parts)))
+        for uid in uids:
+            md5_file = self.media_dir / uid / 'md5sum.txt'
+            paths.append(md5_file)
+            paths.extend(sorted(p for p in md5_file.parent.rglob('*')
+                                if p.is_file() and p != md5_file))
+        return paths
+
+    @staticmethod
+    def add_bytes(tar: tarfile.TarFile, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+
+    def write(self, output: str, since: Path = None, manifest_out: Path = None):
+        manifest = self.scan()
+        base = Backup.load_manifest(since) if since else {}
+        changed = [uid for uid, entry in manifest.items()
+                   if base.get(uid) != entry]
+
+        if output == '-':
+            tar = tarfile.open(fileobj=sys.stdout.buffer, mode='w|')
+        else:
+            tar = tarfile.open(output, mode='w|')
+
+        with tar:
+            manifest_yaml = YAML.dumps(list(manifest.values()))
+            Backup.add_bytes(tar, self.info_name, YAML.dumps({
+                'created': datetime.now().astimezone().isoformat(),
+                'incremental': bool(since),
+                'resources': len(manifest),
+                'included': len(changed),
+            }).encode())
+            Backup.add_bytes(tar, self.manifest_name, manifest_yaml.encode())
+
+            for path, data in self.read_ahead(self.files(changed)):
+                name = path.relative_to(self.root_dir).as_posix()
+                if data is None:
+                    tar.add(path, arcname=name, recursive=False)
+                else:
+                    info = tar.gettarinfo(path, arcname=name)
+                    tar.addfile(info, io.BytesIO(data))
+
+        if manifest_out:
+            manifest_out.write_text(manifest_yaml)
+
+        return {'resources': len(manifest), 'included': len(changed)}
+
+    def restore(self, archive: str, verify_only: bool = False):
+        """Applies one archive, full or incremental, verifying as it goes"""
+        work_dir = self.root_dir / '.restore'
+        report = {'restored': [], 'corrupted': [], 'removed': []}
+        catalog = {}
+        manifest = None
+
+        state = {'uid': None, 'expected': {}, 'actual': {}, 'listed': False}
+
+        def finish_resource():
+            uid = state['uid']
+            if uid is None:
+                return
+            if not state['listed'] or state['expected'] != state['actual']:
+                report['corrupted'].append(uid)
+                shutil.rmtree(work_dir / uid, ignore_errors=True)
+            else:
+                report['restored'].append(uid)
+                if not verify_only:
+                    resource_dir = self.media_dir / uid
+                    if resource_dir.exists():
+                        shutil.rmtree(resource_dir)
+                    self.media_dir.mkdir(parents=True, exist_ok=True)
+                    os.replace(work_dir / uid, resource_dir)
+            state.update(uid=None, expected={}, actual={}, listed=False)
+
+        if archive == '-':
+            tar = tarfile.open(fileobj=sys.stdin.buffer, mode='r|*')
+        else:
+            tar = tarfile.open(archive, mode='r|*')
+
+        with tar:
+            for member in tar:
+                parts = Path(member.name).parts
+                if not member.isfile() or Path(member.name).is_absolute() \
+                        or '..' in parts:
+                    raise ValueError(f"Unexpected member: {member.name}")
+                data = tar.extractfile(member)
+
+                if member.name == self.manifest_name:
+                    manifest = {e['uid']: e for e in
+                                YAML.loads(data.read().decode())}
+                    continue
+                if member.name == self.info_name:
+                    continue
+                if member.name in self.catalog_names or parts[0] == 'index':
+                    catalog[member.name] = data.read()
+                    continue
+                if parts[0] != 'media' or len(parts) < 3:
+                    raise ValueError(f"Unexpected member: {member.name}")
+                if manifest is None:
+                    raise ValueError("Not a backup archive")
+
+                uid, rel = parts[1], Path(*parts[2:]).as_posix()
+                if uid != state['uid']:
+                    finish_resource()
+                    state['uid'] = uid
+
+                target = work_dir / uid / rel
+                target.parent.mkdir(parents=True, exist_ok=True)
+                hasher = hashlib.md5()
+                with open(target, 'wb') as f:
+                    for chunk in iter(lambda: data.read(1024*1024), b""):
+                        hasher.update(chunk)
+                        f.write(chunk)
+
+                if rel == 'md5sum.txt':
+                    # The files are only as good as the list they're
+                    # checked against
+                    state['listed'] = uid in manifest and \
+                        hasher.hexdigest() == manifest[uid]['digest']
+                    for line in target.read_text().splitlines():
+                        if line.strip():
+                            md5, name = line.split(None, 1)
+                            state['expected'][name.removeprefix('./')] = md5
+                else:
+                    state['actual'][rel] = hasher.hexdigest()
+
+            finish_resource()
+
+        if manifest is None:
+            raise ValueError("Not a backup archive")
+
+        if not verify_only:
+            index_dir = self.root_dir / 'index'
+            if any(name.startswith('index/') for name in catalog):
+                shutil.rmtree(index_dir, ignore_errors=True)
+                index_dir.mkdir()
+            for name, data in catalog.items():
+                target = self.root_dir / name
+                target.parent.mkdir(parents=True, exist_ok=True)
+                tmp_file = target.parent / f'.{target.name}.tmp'
+                tmp_file.write_bytes(data)
+                os.replace(tmp_file, target)
+            if 'db.yaml.enc' in catalog:
+                ChangeLog(self.root_dir).reset()
+
+            # Resources removed since the backup was taken
+            if self.media_dir.is_dir():
+                for resource_dir in self.media_dir.iterdir():
+                    if resource_dir.name not in manifest:
+                        shutil.rmtree(resource_dir)
+                        report['removed'].append(resource_dir.name)
+
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return report
+
+
+class Publisher:
+    """Writes the library and the built UI as a static tree to out_dir
+
+    Resource dirs are published as data/media/<uid>.<digest>, named after
+    their md5sum.txt, so every media URL changes with its content and can be
+    cached forever. The catalog is rewritten to those paths, gallery page
+    indexes too. Text assets get precompressed .gz (and .br, if the brotli
+    module is installed) variants next to them. cache.yaml lists every file
+    with its cache policy, _headers applies it on hosts that read that file.
+
+    Publishing again only copies new or changed resources and removes the
+    ones that are gone. Only an empty out_dir or one with the cache.yaml of
+    a previous publish is written to, and only files that cache.yaml lists
+    are removed from it.
+    """
+
+    compressible_suffixes = ('.html', '.js', '.css', '.svg', '.json',
+                             '.webmanifest', '.txt', '.m3u8', '.vtt')
+    # Smaller files aren't worth a second request header
+    min_compress_size = 1024
+    # Only these are fetched without a content hash in their path
+    mutable_names = ('index.html', 'data/db.yaml.enc', 'data/key_info.yaml',
+                     'cache.yaml', '_headers', 'site.webmanifest')
+
+    def __init__(self, db: DB, ui_dir: Path, out_dir: Path, workers: int = 4):
+        self.db = db
+        self.ui_dir = ui_dir
+        self.out_dir = out_dir
+        self.data_dir = out_dir / 'data'
+        self.media_dir = self.data_dir / 'media'
+        self.workers = workers
+
+    async def publish_resource(self, record: Record, name: str):
+        """Copies media/<uid> to data/media/<name>, rewriting page indexes"""
+        uid = record['uid']
+        src_dir = self.db.media_dir / uid
+        work_dir = self.media_dir / f'.{name}'
+        if work_dir.exists():
+            shutil.rmtree(work_dir)
+
+        rewritten = False
+        for path in src_dir.rglob('*'):
+            target = work_dir / path.relative_to(src_dir)
+            if path.is_dir():
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+
+            if not path.name.startswith('pages.yaml'):
+                # Not a hard link, in-place edits would leak into the copy
+                await asyncio.to_thread(place_file, path, target)
+                continue
+
+            pt_path = self.db.tmp.file()
+            if record.get('encrypted'):
+                await Cmd.decrypt_file(path, pt_path, self.db.key,
+                                       record['iv'])
+            else:
+                place_file(path, pt_path)
+            pt_path.write_text(pt_path.read_text().replace(
+                f'media/{uid}/', f'media/{name}/'))
+            if record.get('encrypted'):
+                await Cmd.encrypt_file(pt_path, target, self.db.key,
+                                       record['iv'])
+            else:
+                place_file(pt_path, target, move=True)
+            rewritten = True
+
+        if rewritten:
+            await refresh_md5sum(work_dir)
+        compressed = await asyncio.to_thread(self.compress_tree, work_dir)
+        os.replace(work_dir, self.media_dir / name)
+        return compressed
+
+    def publish_ui(self):
+        if not (self.ui_dir / 'index.html').is_file():
+            raise ValueError(f"No index.html in {self.ui_dir}, build the UI "
+                             "first (yarn build)")
+
+        # What the previous publish put there, nothing else
+        cache_file = self.out_dir / 'cache.yaml'
+        names = {'cache.yaml', '_headers'}
+        if cache_file.is_file():
+            names.update(entry['path'].split('/')[0]
+                         for entry in YAML.loads(cache_file.read_text()))
+        for name in names - {'data'}:
+            path = self.out_dir / name
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                path.unlink(missing_ok=True)
+        for path in self.ui_dir.iterdir():
+            if path.name == 'data':
+                continue
+            if path.is_dir():
+                shutil.copytree(path, self.out_dir / path.name)
+            else:
+                shutil.copy2(path, self.out_dir / path.name)
+
+    def compress(self, path: Path):
+        """Writes the precompressed variants worth keeping, returns how many"""
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+
+        data = path.read_bytes()
+        if len(data) < self.min_compress_size:
+            return 0
+
+        variants = {'.gz': gzip.compress(data, 9, mtime=0)}
+        if brotli:
+            variants['.br'] = brotli.compress(data)
+
+        count = 0
+        for suffix, compressed in variants.items():
+            variant = path.with_name(path.name + suffix)
+            if len(compressed) < len(data):
+                variant.write_bytes(compressed)
+                count += 1
+            else:
+                variant.unlink(missing_ok=True)
+        return count
+
+    def compress_tree(self, dir: Path, skip: Path = None):
+        count = 0
+        for path in list(dir.rglob('*')):
+            if skip and path.is_relative_to(skip):
+                continue
+            if path.suffix in self.compressible_suffixes and path.is_file():
+                count += self.compress(path)
+        return count
+
+    def write_cache_manifest(self):
+        entries = []
+        for path in sorted(self.out_dir.rglob('*')):
+            rel = path.relative_to(self.out_dir).as_posix()
+            if path.is_dir() or rel in ('cache.yaml', '_headers') or \
+                    any(part.startswith('.') for part in Path(rel).parts):
+                continue
+            original = rel.removesuffix('.gz').removesuffix('.br')
+            entries.append({
+                'path': rel,
+                'size': path.stat().st_size,
+                'cache': 'no-cache' if original in self.mutable_names
+                else 'immutable',
+            })
+        (self.out_dir / 'cache.yaml').write_text(YAML.dumps(entries))
+
+        immutable = 'Cache-Control: public, max-age=31536000, immutable'
+        rules = ['/assets/*', f'  {immutable}',
+                 '/data/media/*', f'  {immutable}']
+        for name in self.mutable_names:
+            rules += [f'/{name}', '  Cache-Control: no-cache']
+        (self.out_dir / '_headers').write_text('\n'.join(rules) + '\n')
+
+    def check_out_dir(self):
+        out_dir = self.out_dir.resolve()
+        for dir in (self.db.root_dir.resolve(), self.ui_dir.resolve()):
+            if out_dir == dir or out_dir in dir.parents or \
+                    dir in out_dir.parents:
+                raise ValueError(f"{self.out_dir} overlaps {dir}")
+        if out_dir.is_dir() and any(out_dir.iterdir()) and \
+                not (out_dir / 'cache.yaml').is_file():
+            raise ValueError(f"{self.out_dir} is neither empty nor a previous "
+                             "publish (no cache.yaml)")
+
+    async def publish(self):
+        self.check_out_dir()
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.media_dir.mkdir(parents=True, exist_ok=True)
+        report = {'copied': [], 'kept': [], 'removed': [], 'compressed': 0}
+
+        await asyncio.to_thread(self.publish_ui)
+
+        # Quarantined resources aren't there to publish
+        async with self.db as db:
+            records = [record.copy() for record in db
+                       if not record.get('quarantined')]
+
+        names = {}
+        for record in records:
+            uid = record['uid']
+            md5_file = self.db.media_dir / uid / 'md5sum.txt'
+            digest = await asyncio.to_thread(calculate_md5, md5_file)
+            names[uid] = f'{uid}.{digest[:10]}'
+
+            for field in ('file', 'thumbnail', 'hash', 'storyboard'):
+                if str(record.get(field, '')).startswith(f'media/{uid}/'):
+                    record[field] = record[field].replace(
+                        f'media/{uid}/', f'media/{names[uid]}/', 1)
+
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def publish_resource(record: Record):
+            name = names[record['uid']]
+            if (self.media_dir / name).is_dir():
+                report['kept'].append(record['uid'])
+                return
+            async with semaphore:
+                report['compressed'] += await self.publish_resource(
+                    record, name)
+            report['copied'].append(record['uid'])
+
+        await asyncio.gather(*(publish_resource(r) for r in records))
+
+        for path in self.media_dir.iterdir():
+            if path.name not in names.values():
+                shutil.rmtree(path)
+                report['removed'].append(path.name)
+
+        # The entry points last, so readers never see missing media
+        pt_path = self.db.tmp.file()
+        pt_path.write_text(YAML.dumps(records))
+        await Cmd.encrypt_file(pt_path, self.data_dir / '.db.yaml.enc',
+                               self.db.key, self.db.iv)
+        os.replace(self.data_dir / '.db.yaml.enc',
+                   self.data_dir / 'db.yaml.enc')
+        key_info = YAML.loads(
+            (self.db.root_dir / 'key_info.yaml').read_text())
+        # Tells the UI media URLs are content-addressed
+        key_info['immutable_media'] = True
+        (self.data_dir / 'key_info.yaml').write_text(YAML.dumps(key_info))
+
+        report['compressed'] += await asyncio.to_thread(
+            self.compress_tree, self.out_dir, self.data_dir)
+        await asyncio.to_thread(self.write_cache_manifest)
+
+        return report
+
+
+class EncodingProfile:
+    """x264 settings measured on this machine, picked per video
+
+    calibrate() encodes a short sample of each given video with every preset
+    and rate (a bitrate, or a quality like crf=23), as many at once as the
+    governor runs ffmpeg, and keeps speed, size and SSIM of each in
+    root_dir/.encoding/profile.yaml, along with the targets: a speed in
+    seconds of video per second per job, and a minimum SSIM.
+
+    choose() takes the measurements of the sample closest in complexity to
+    a video, which probe() estimates from a quick ultrafast encode. The
+    speed target goes up with the number of videos waiting for ffmpeg. Of
+    the settings fast enough and good enough, the one with the smallest
+    output wins. If none is good enough, the best of the fast enough ones,
+    and if none is fast enough, the fastest.
+    """
+
+    presets = ('ultrafast', 'superfast', 'veryfast', 'faster', 'fast',
+               'medium', 'slow')
+    rates = ('crf=20', 'crf=23', 'crf=26', 'crf=29', '2000k')
+    probe_time = 5
+
+    def __init__(self, root_dir: Path):
+        self.dir = root_dir / '.encoding'
+        self.profile_file = self.dir / 'profile.yaml'
+        self.targets_file = self.dir / 'targets.yaml'
+
+    @staticmethod
+    def rate_args(rate: str):
+        if rate.startswith('crf='):
+            return ['-crf', rate.removeprefix('crf=')]
+        return ['-b:v', rate]
+
+    @staticmethod
+    async def get_dimensions(file: Path):
+        obj = await Cmd.get_video_format(file)
+        stream = next(s for s in obj['streams']
+                      if s.get('codec_type') == 'video')
+        return (stream['width'], stream['height'],
+                float(obj['format']['duration']))
+
+    @staticmethod
+    async def encode(file: Path, output: Path, seek: float, length: float,
+                     preset: str, rate: str):
+        await Cmd.run([
+            'ffmpeg', '-v', 'error', '-y', '-ss', str(seek), '-t', str(length),
+            '-i', file, '-an', '-c:v', 'libx264', '-preset', preset,
+            *EncodingProfile.rate_args(rate), output,
+        ])
+
+    @staticmethod
+    async def probe(file: Path, tmp: Tmp, width: int, height: int,
+                    duration: float):
+        """Bits per pixel-second of a fast encode from 10% in, busy or noisy
+        video needs more than static screen recordings
+        """
+        seek = duration * 0.1
+        length = max(min(EncodingProfile.probe_time, duration - seek), 0.1)
+        output = tmp.file(suffix='.mp4')
+        await EncodingProfile.encode(file, output, seek, length,
+                                     'ultrafast', 'crf=23')
+        return output.stat().st_size * 8 / (width * height * length)
+
+    async def measure(self, file: Path, tmp: Tmp, seek: float,
+                      length: float, preset: str, rate: str, jobs: int):
+        outputs = [tmp.file(suffix='.mp4') for _ in range(jobs)]
+        start = time.monotonic()
+        await asyncio.gather(*(
+            EncodingProfile.encode(file, output, seek, length, preset, rate)
+            for output in outputs))
+        elapsed = time.monotonic() - start
+
+        stats_file = tmp.file(suffix='.log')
+        await Cmd.run([
+            'ffmpeg', '-v', 'error', '-ss', str(seek), '-t', str(length),
+            '-i', file, '-i', outputs[0],
+            '-lavfi', f'[1:v][0:v]ssim=stats_file={stats_file}',
+            '-f', 'null', '-',
+        ])
+        ssims = [float(m[1]) for m in
+                 re.finditer(r'All:([\d.]+)', stats_file.read_text())]
+
+        return {
+            'seconds': length * jobs / elapsed,
+            'kbps': round(outputs[0].stat().st_size * 8 / length / 1000),
+            'ssim': round(sum(ssims) / len(ssims), 4) if ssims else 0,
+        }
+
+    async def calibrate(
+        self,
+        files: list[Path],
+        tmp: Tmp,
+        sample_time: float = 10,
+        target_speed: float = 1,
+        target_ssim: float = 0.97,
+        presets: list[str] = None,
+        rates: list[str] = None,
+    ):
+        limits = Cmd.governor.limits
+        jobs = limits.get('ffmpeg', limits['*'])
+        rows = []
+
+        for file in files:
+            width, height, duration = \
+                await EncodingProfile.get_dimensions(file)
+            complexity = await EncodingProfile.probe(
+                file, tmp, width, height, duration)
+            seek = duration * 0.1
+            length = max(min(sample_time, duration - seek), 0.1)
+
+            for preset in presets or self.presets:
+                for rate in rates or self.rates:
+                    result = await self.measure(
+                        file, tmp, seek, length, preset, rate, jobs)
+                    # Per pixel, to carry over to other resolutions
+                    row = {
+                        'sample': file.name,
+                        'complexity': round(complexity, 4),
+                        'preset': preset,
+                        'rate': rate,
+                        'pixel_rate': round(
+                            result['seconds'] / jobs * width * height),
+                        'kbps': result['kbps'],
+                        'ssim': result['ssim'],
+                    }
+                    print(f"{file.name}: {preset} {rate}: "
+                          f"{result['seconds'] / jobs:.2f}x, "
+                          f"{row['kbps']}k, ssim {row['ssim']}")
+                    rows.append(row)
+
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.profile_file.write_text(YAML.dumps(rows))
+        self.targets_file.write_text(YAML.dumps({
+            'speed': target_speed,
+            'ssim': target_ssim,
+        }))
+        return rows
+
+    def choose(self, width: int, height: int, complexity: float,
+               queue_depth: int = 0):
+        """The profile row to encode with, None without a profile"""
+        if not self.profile_file.is_file():
+            return None
+        rows = YAML.loads(self.profile_file.read_text())
+        targets = YAML.loads(self.targets_file.read_text())
+        if not rows:
+            return None
+
+        sample = min(rows, key=lambda row: abs(math.log(
+            max(row['complexity'], 1e-6) / max(complexity, 1e-6))))['sample']
+        rows = [row for row in rows if row['sample'] == sample]
+
+        limits = Cmd.governor.limits
+        # Keep up with the backlog, as if the waiting ones ran alongside
+        speed = targets['speed'] * \
+            (1 + queue_depth / limits.get('ffmpeg', limits['*']))
+        fast = [row for row in rows
+                if row['pixel_rate'] / (width * height) >= speed]
+        good = [row for row in fast if row['ssim'] >= targets['ssim']]
+
+        if good:
+            return min(good, key=lambda row: row['kbps'])
+        if fast:
+            return max(fast, key=lambda row: row['ssim'])
+        return max(rows, key=lambda row: row['pixel_rate'])
+
+
 class MediaImporter:
+    # The import stages and the ones each waits for. Stages that don't
+    # depend on each other run concurrently, e.g. a video's thumbnail is
+    # taken while it's transcoded. Subclasses extend this when they add
+    # stages of their own.
+    stages = {
+        'get_info': (),
+        'get_mime_type': (),
+        # The alternative thumbnail may need get_info, e.g. the duration
+        'create_thumbnail': ('get_info',),
+        # Compression depends on the mime type
+        'process_file': ('get_info', 'get_mime_type'),
+        'calc_md5': ('create_thumbnail', 'process_file'),
+    }
+
     def __init__(
         self,
         file: Path,
@@ -736,6 +3504,7 @@ class MediaImporter:
         thumbnail_font: Path = None,
         root_dir: Path = None,
         no_encryption: bool = False,
+        no_compression: bool = False,
         **kwargs,  # Allow additional arguments
     ):
         self.file = file
@@ -747,6 +3516,10 @@ class MediaImporter:
         self.thumbnail_font = thumbnail_font
         self.root_dir = root_dir or Path('.')
         self.no_encryption = no_encryption
+        self.no_compression = no_compression
+
+        # Room for the output next to the original, e.g. while transcoding
+        ensure_free_space(self.root_dir, 2 * self.file.stat().st_size)
 
         self.uid = random_string(9)
         self.resource_dir = self.root_dir / f'media/{self.uid}'
@@ -761,6 +3534,7 @@ class MediaImporter:
             'encrypted': not no_encryption,
         }
         self.db = DB(self.key, tmp, self.root_dir)
+        self.timings = {}  # Seconds per stage
 
         if not self.no_encryption:
             self.iv = random_string(32, 'h')
@@ -779,35 +3553,59 @@ class MediaImporter:
     async def get_alternative_thumbnail(self) -> Path:
         return None
 
+    async def make_alternative_thumbnail(self, output: Path, size: str):
+        """Renders the thumbnail from the media itself, False if it can't"""
+        if alt := await self.get_alternative_thumbnail():
+            await Cmd.image_to_thumbnail(alt, output, size=size)
+            return True
+        return False
+
     async def create_thumbnail(self):
         pt_path = self.tmp.file(suffix=".webp")
         size = '300x200'
 
         if self.thumbnail:
             await Cmd.image_to_thumbnail(self.thumbnail, pt_path, size=size)
-        elif alt := await self.get_alternative_thumbnail():
-            await Cmd.image_to_thumbnail(alt, pt_path, size=size)
-        else:
+            # Kept by regenerate
+            self.record['custom_thumbnail'] = True
+        elif not await self.make_alternative_thumbnail(pt_path, size):
             await Cmd.text_to_thumbnail(self.title, pt_path,
                                         font=self.thumbnail_font, size=size)
 
         if self.no_encryption:
             ct_path = self.resource_dir / 'thumbnail.webp'
-            shutil.copy(pt_path, ct_path)
+            place_file(pt_path, ct_path, move=True)
         else:
             ct_path = self.resource_dir / 'thumbnail.webp.enc'
             await Cmd.encrypt_file(pt_path, ct_path, self.key, self.iv)
 
         self.record['thumbnail'] = ct_path.relative_to(self.root_dir)
 
+    async def compress(self, file: Path, name: str):
+        """Gzips text-like content before encryption, which would make it
+        incompressible. Clients gunzip after decrypting per 'compression'.
+        """
+        mime_type = self.record.get('mime_type')
+        if self.no_encryption or self.no_compression or \
+                not await asyncio.to_thread(is_compressible, file, mime_type):
+            return file, name
+
+        gz_path = self.tmp.file(suffix='.gz')
+        await asyncio.to_thread(gzip_file, file, gz_path)
+        self.record['compression'] = 'gzip'
+        return gz_path, f'{name}.gz'
+
     async def process_file(self, file: Path = None, name: str = 'file'):
+        file, name = await self.compress(file or self.file, name)
+
         if self.no_encryption:
             ct_path = self.resource_dir / name
-            shutil.copy(file or self.file, ct_path)
+            # self.file stays, concurrent stages and calc_md5 still read it
+            place_file(file, ct_path,
+                       move=self.tmp.owns(file) and file != self.file)
         else:
             ct_path = self.resource_dir / f'{name}.enc'
-            await Cmd.encrypt_file(
-                file or self.file, ct_path, self.key, self.iv)
+            await Cmd.encrypt_file(file, ct_path, self.key, self.iv)
 
         self.record['file'] = ct_path.relative_to(self.root_dir)
 
@@ -818,63 +3616,225 @@ class MediaImporter:
         md5 = await Cmd.get_md5(self.resource_dir)
         md5_file = self.resource_dir / 'md5sum.txt'
         md5_file.write_text(md5)
-        self.record['hash'] = md5_file
+        self.record['hash'] = md5_file.relative_to(self.root_dir)
 
     def calc_size(self):
         self.record['size'] = du_dir(self.resource_dir)
 
-    async def consume(self):
+    async def get_text(self) -> str:
+        """The body text to make searchable, if any"""
+        return None
+
+    async def run_stages(self, names: list[str] = None):
+        """Runs the stages (all by default, or names and what they depend
+        on) as soon as the ones they depend on are done, times each into
+        self.timings. On failure the stages still running are cancelled and
+        awaited before the error is raised, so nothing writes into
+        resource_dir afterwards.
+        """
+        names = set(self.stages if names is None else names)
+        for name in reversed(self.stages):
+            if name in names:
+                names.update(self.stages[name])
+        tasks = {}
+
+        async def run(name: str):
+            await asyncio.gather(*(tasks[dep] for dep in self.stages[name]
+                                   if dep in tasks))
+            start = time.monotonic()
+            await getattr(self, name)()
+            self.timings[name] = time.monotonic() - start
+
+        # Declaration order is a topological order
+        for name in self.stages:
+            if name in names:
+                tasks[name] = asyncio.ensure_future(run(name))
+
         try:
-            await self.get_info()
-            await self.get_mime_type()
-            await self.create_thumbnail()
-            await self.process_file()
-            await self.calc_md5()
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+
+    async def consume(self, commit: bool = True):
+        """Imports the file, commit=False leaves adding the record (and
+        self.text) to the caller, e.g. to batch catalog writes
+        """
+        try:
+            await self.run_stages()
             self.calc_size()
             self.db.print_record(self.record)
-            # Put it at last, in case of failure
-            await self.db.append(self.record)
-        except Exception as e:
+            print('Stages: ' + ', '.join(
+                f'{name} {self.timings[name]:.2f}s'
+                for name in self.stages if name in self.timings))
+            self.text = await self.get_text()
+            if commit:
+                # Put it at last, in case of failure
+                await self.db.add([self.record], [self.text])
+        except BaseException as e:
+            # Also on cancellation, e.g. when the client went away
             shutil.rmtree(self.resource_dir)
             raise e
+        return self.record
 
 
 class VideoImporter(MediaImporter):
+    stages = {
+        'get_info': (),
+        'get_mime_type': (),
+        'create_thumbnail': ('get_info',),
+        'tune_encoding': ('get_info',),
+        'process_file': ('get_info', 'get_mime_type', 'tune_encoding'),
+        'calc_md5': ('create_thumbnail', 'process_file'),
+    }
+
     def __init__(
         self,
         *args,
         bitrate: str = None,
         hls_time: int = None,
+        hls_type: str = None,
+        hls_init_time: float = None,
+        storyboard_interval: float = None,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
 
+        # Without an explicit bitrate, the encoding profile decides if any
+        self.tuned = not bitrate
         self.bitrate = bitrate or '2000k'
+        self.preset = None
         self.hls_time = hls_time or 10
+        self.hls_type = hls_type or 'mpegts'
+        # First segment length, 0 for uniform segments
+        self.hls_init_time = 2 if hls_init_time is None else hls_init_time
+        # Seconds between storyboard frames, 0 disables the storyboard
+        self.storyboard_interval = 5 if storyboard_interval is None \
+            else storyboard_interval
+        self.width = self.height = None
 
     async def get_info(self):
         obj = await Cmd.get_video_format(self.file)
 
         self.record['duration'] = float(obj['format']['duration'])
-        self.record['creation_time'] = obj['format']['tags'].get(
+        self.record['creation_time'] = obj['format'].get('tags', {}).get(
             'creation_time',
             timestamp_to_iso_local(self.file.stat().st_ctime),
         )
 
+        stream = next((s for s in obj.get('streams', [])
+                       if s.get('codec_type') == 'video'), {})
+        self.width = stream.get('width')
+        self.height = stream.get('height')
+
     async def get_mime_type(self):
         await super().get_mime_type('video', 'application/vnd.apple.mpegurl')
 
-    async def get_alternative_thumbnail(self):
-        shot_path = self.tmp.file(suffix=".webp")
-        await Cmd.get_video_screenshot(self.file, shot_path)
-        return shot_path
+    async def tune_encoding(self):
+        # The profile belongs to the library, root_dir may be a work dir
+        profile = EncodingProfile(self.db.root_dir)
+        if not self.tuned or not self.width or not self.height or \
+                not profile.profile_file.is_file():
+            return
+
+        complexity = await EncodingProfile.probe(
+            self.file, self.tmp, self.width, self.height,
+            self.record['duration'])
+        row = profile.choose(self.width, self.height, complexity,
+                             Cmd.governor.queue_depth('ffmpeg'))
+        if row is None:
+            return  # Empty or removed meanwhile, the defaults it is
+        self.preset, self.bitrate = row['preset'], row['rate']
+        self.record['encoding'] = f'{self.preset} {self.bitrate}'
+
+    async def make_alternative_thumbnail(self, output: Path, size: str):
+        # A keyframe a bit into the video, the first one is often black
+        duration = self.record.get('duration') or 0
+        await Cmd.get_video_screenshot(
+            self.file, output, seek=min(duration * 0.1, 60), size=size)
+        return True
+
+    def get_storyboard(self, dir: Path):
+        if not self.storyboard_interval or not self.width or not self.height:
+            return None
+
+        width = 160
+        height = round(width * self.height / self.width / 2) * 2
+        return {
+            'dir': dir,
+            'interval': self.storyboard_interval,
+            'width': width,
+            'height': height,
+            'columns': 10,
+            'rows': 10,
+        }
+
+    async def save_storyboard(self, storyboard: dict):
+        """Encrypts the sprite sheets and indexes them in a WebVTT file"""
+        sb = storyboard
+        out_dir = self.resource_dir / 'storyboard'
+        out_dir.mkdir()
+        per_sheet = sb['columns'] * sb['rows']
+        duration = self.record['duration']
+
+        def timestamp(seconds: float):
+            h, rem = divmod(seconds, 3600)
+            m, s = divmod(rem, 60)
+            return f'{int(h):02d}:{int(m):02d}:{s:06.3f}'
+
+        sheets = sorted(sb['dir'].glob('*.webp'))
+        for sheet in sheets:
+            if self.no_encryption:
+                place_file(sheet, out_dir / sheet.name, move=True)
+            else:
+                await Cmd.encrypt_file(
+                    sheet, out_dir / f'{sheet.name}.enc', self.key, self.iv)
+
+        cues = ['WEBVTT', '']
+        frame = 0
+        while frame * sb['interval'] < duration:
+            sheet_index, cell = divmod(frame, per_sheet)
+            if sheet_index >= len(sheets):
+                break
+            row, col = divmod(cell, sb['columns'])
+            name = sheets[sheet_index].name
+            if not self.no_encryption:
+                name += '.enc'
+            start = frame * sb['interval']
+            end = min(start + sb['interval'], duration)
+            cues.append(f'{timestamp(start)} --> {timestamp(end)}')
+            cues.append(f"storyboard/{name}#xywh={col * sb['width']},"
+                        f"{row * sb['height']},{sb['width']},{sb['height']}")
+            cues.append('')
+            frame += 1
+
+        pt_path = self.tmp.file(suffix='.vtt')
+        pt_path.write_text('\n'.join(cues))
+        # The cues give away the duration and the frame geometry
+        if self.no_encryption:
+            vtt_path = self.resource_dir / 'storyboard.vtt'
+            place_file(pt_path, vtt_path, move=True)
+        else:
+            vtt_path = self.resource_dir / 'storyboard.vtt.enc'
+            await Cmd.encrypt_file(pt_path, vtt_path, self.key, self.iv)
+        self.record['storyboard'] = vtt_path.relative_to(self.root_dir)
 
     async def process_file(self):
         m3u8_path = self.resource_dir / 'playlist.m3u8'
+        storyboard = self.get_storyboard(self.tmp.dir())
+        options = {
+            'storyboard': storyboard,
+            'hls_type': self.hls_type,
+            'preset': self.preset,
+            'keyframe_times': segment_times(
+                self.record['duration'], self.hls_time, self.hls_init_time),
+        }
 
         if self.no_encryption:
             await Cmd.video_to_m3u8(self.file, m3u8_path, self.bitrate,
-                                    self.hls_time)
+                                    self.hls_time, **options)
         else:
             key_path = self.tmp.file()
             key_path.write_bytes(bytes.fromhex(self.key))
@@ -883,7 +3843,10 @@ class VideoImporter(MediaImporter):
             key_info_path.write_text(f'key.bin\n{key_path}\n{self.iv}')
 
             await Cmd.video_to_m3u8(self.file, m3u8_path, self.bitrate,
-                                    self.hls_time, key_info_path)
+                                    self.hls_time, key_info_path, **options)
+
+        if storyboard:
+            await self.save_storyboard(storyboard)
 
         self.record['file'] = m3u8_path.relative_to(self.root_dir)
 
@@ -922,6 +3885,148 @@ class ImageImporter(MediaImporter):
         await super().process_file(pt_path, 'image.webp')
 
 
+class GalleryImporter(MediaImporter):
+    """Imports an archive (CBZ/ZIP) or a dir of images as numbered pages
+
+    Each page is converted to WebP with a small thumbnail, both encrypted
+    separately, so readers fetch single pages. The page list goes into
+    pages.yaml(.enc), referenced by record['file'], and record['pages'] is
+    the count.
+    """
+
+    image_suffixes = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp',
+                      '.tif', '.tiff', '.avif', '.jxl')
+
+    def __init__(
+        self,
+        *args,
+        resize: str = None,
+        quality: int = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+
+        self.resize = resize or '2560x2560>'
+        self.quality = quality or 80
+        self.pages = []  # (original name, extracted path)
+
+        if self.file.is_dir():
+            self.record['original_size'] = du_dir(self.file)
+
+    @staticmethod
+    def natural_key(name: str):
+        """Sorts page2 before page10"""
+        return [int(part) if part.isdigit() else part.lower()
+                for part in re.split(r'(\d+)', name)]
+
+    def extract_pages(self):
+        dir = self.tmp.dir()
+        if self.file.is_dir():
+            names = [str(path.relative_to(self.file))
+                     for path in self.file.rglob('*') if path.is_file()]
+        else:
+            z = zipfile.ZipFile(self.file)
+            names = [info.filename for info in z.infolist()
+                     if not info.is_dir()]
+
+        names = sorted((name for name in names
+                        if Path(name).suffix.lower() in self.image_suffixes
+                        and not Path(name).name.startswith('.')),
+                       key=GalleryImporter.natural_key)
+
+        for index, name in enumerate(names):
+            if self.file.is_dir():
+                path = self.file / name
+            else:
+                # Only our own names touch the disk
+                path = dir / f'{index:04d}{Path(name).suffix.lower()}'
+                with z.open(name) as f_in, open(path, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            self.pages.append((name, path))
+
+        if not self.file.is_dir():
+            z.close()
+        if not self.pages:
+            raise ValueError(f"No images in {self.file}")
+
+    async def get_info(self):
+        await super().get_info()
+        await asyncio.to_thread(self.extract_pages)
+
+    async def get_mime_type(self):
+        await super().get_mime_type('gallery', 'image/webp')
+
+    async def get_alternative_thumbnail(self):
+        return self.pages[0][1]
+
+    async def place(self, pt_path: Path, name: str):
+        """Encrypts (or moves) pt_path into the resource dir"""
+        if self.no_encryption:
+            ct_path = self.resource_dir / name
+            place_file(pt_path, ct_path, move=True)
+        else:
+            ct_path = self.resource_dir / f'{name}.enc'
+            await Cmd.encrypt_file(pt_path, ct_path, self.key, self.iv)
+            pt_path.unlink()
+        return ct_path.relative_to(self.root_dir)
+
+    async def process_page(self, index: int, name: str, file: Path):
+        page_path = self.tmp.file(suffix='.webp')
+        thumb_path = self.tmp.file(suffix='.webp')
+
+        # [0]: the first frame of animated or multi-page images
+        size = await Cmd.run([
+            'magick', f'{file}[0]', '-auto-orient', '-resize', self.resize,
+            '-quality', str(self.quality), '-print', '%w %h', page_path,
+        ], capture=True)
+        await Cmd.image_to_thumbnail(page_path, thumb_path, size='200x300')
+
+        width, height = size.split()
+        return {
+            'page': index + 1,
+            'name': name,
+            'width': int(width),
+            'height': int(height),
+            'file': await self.place(page_path, f'pages/{index + 1:04d}.webp'),
+            'thumbnail': await self.place(
+                thumb_path, f'pages/{index + 1:04d}.thumb.webp'),
+        }
+
+    async def process_file(self):
+        (self.resource_dir / 'pages').mkdir()
+
+        # As many pages in flight as magick may run, so a long archive
+        # doesn't fill the governor's queues (and its queue limit)
+        limits = Cmd.governor.limits
+        semaphore = asyncio.Semaphore(limits.get('magick', limits['*']))
+
+        async def process_page(index: int, name: str, file: Path):
+            async with semaphore:
+                return await self.process_page(index, name, file)
+
+        pages = await asyncio.gather(*(
+            process_page(index, name, file)
+            for index, (name, file) in enumerate(self.pages)))
+
+        index_path = self.tmp.file(suffix='.yaml')
+        index_path.write_text(YAML.dumps(pages))
+        self.record['file'] = await self.place(index_path, 'pages.yaml')
+        self.record['pages'] = len(pages)
+
+    async def calc_md5(self):
+        if not self.file.is_dir():
+            return await super().calc_md5()
+
+        # Of the sorted listing of each file's md5, stable across walks
+        listing = sorted((await Cmd.get_md5(self.file)).splitlines())
+        self.record['original_hash'] = hashlib.md5(
+            '\n'.join(listing).encode()).hexdigest()
+
+        md5_file = self.resource_dir / 'md5sum.txt'
+        md5_file.write_text(await Cmd.get_md5(self.resource_dir))
+        self.record['hash'] = md5_file.relative_to(self.root_dir)
+
+
 class BookImporter(MediaImporter):
     def __init__(
         self,
@@ -931,11 +4036,17 @@ class BookImporter(MediaImporter):
         language: str = None,
         toc_title: str = None,
         max_ctl: int = None,
+        optimize: bool = False,
+        resize: str = None,
+        quality: int = None,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
 
         self.encoding = encoding or 'utf-8'
+        self.optimize = optimize
+        self.resize = resize or '1600x2400>'
+        self.quality = quality or 80
         self.author = author or 'Anonymous'
         self.language = language or 'en-US'
         self.toc_title = toc_title or 'Table of Contents'
@@ -952,19 +4063,46 @@ class BookImporter(MediaImporter):
     async def get_alternative_thumbnail(self):
         if not self.thumbnail and self.file.suffix == '.epub':
             data, path = EPUB3.extract_epub_cover(self.file)
-            suffix = Path(path).suffix
             if data:
-                cover_file = self.tmp.file(suffix=suffix)
+                cover_file = self.tmp.file(suffix=Path(path).suffix)
                 cover_file.write_bytes(data)
                 return cover_file
 
+    async def get_text(self):
+        if self.file.suffix == '.epub':
+            return EPUB3.extract_text(self.file)
+        return '\n'.join('\n'.join(chapter) for chapter in self.chapters)
+
+    async def optimize_epub(self):
+        """The optimized copy of the EPUB, the original if that isn't smaller
+        or can't be optimized
+        """
+        output = self.tmp.file(suffix='.epub')
+        try:
+            report = await EPUB3.optimize(
+                self.file, output, self.tmp, self.resize, self.quality)
+        except (zipfile.BadZipFile, ET.ParseError, KeyError,
+                UnicodeDecodeError, AttributeError) as e:
+            print(f"Not optimizing {self.file}: {e!r}")
+            return self.file
+        if report['saved'] <= 0:
+            return self.file
+
+        self.record['optimization'] = (
+            f"{report['images']} images to webp, "
+            f"{report['dropped']} unused items dropped")
+        self.record['optimization_saved'] = report['saved']
+        return output
+
     async def process_file(self):
         if self.file.suffix == '.epub':
-            await super().process_file(self.file, 'book.epub')
+            file = await self.optimize_epub() if self.optimize else self.file
+            await super().process_file(file, 'book.epub')
         else:
             book_path = self.tmp.file(suffix=".epub")
             content = self.file.read_text(encoding=self.encoding)
             chapters = EPUB3.parse_chapters(content, self.max_ctl)
+            self.chapters = chapters
             EPUB3(
                 title=self.title,
                 description=self.description,
@@ -985,11 +4123,546 @@ class NoteImporter(MediaImporter):
     async def process_file(self):
         await super().process_file(name='note.md')
 
+    async def get_text(self):
+        return self.file.read_text(errors='ignore')
+
 
 class FileImporter(MediaImporter):
     pass
 
 
+class Inotify:
+    """Minimal inotify binding, yields (path, is_dir) for new files"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_ISDIR = 0x40000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    event = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add(self, dir: Path):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(dir), self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Can't watch {dir}")
+        self.watches[wd] = dir
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.event.unpack_from(data, offset)
+            offset += self.event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self.watches and name:
+                events.append((self.watches[wd] / os.fsdecode(name),
+                               bool(mask & self.IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def guess_kind(file: Path):
+    mime_type, _ = mimetypes.guess_type(file)
+    mime_type = mime_type or ''
+    if mime_type.startswith('video/'):
+        return MediaKind.video
+    if mime_type.startswith('image/'):
+        return MediaKind.image
+    if mime_type == 'application/epub+zip':
+        return MediaKind.book
+    if mime_type == 'text/markdown':
+        return MediaKind.note
+    if file.suffix.lower() == '.cbz':
+        return MediaKind.gallery
+    return MediaKind.file
+
+
+class Watcher:
+    """Imports files dropped into dirs, long-running
+
+    A file is taken once its size and mtime haven't changed for settle
+    seconds, so slow writers (network shares, scanners) are waited for.
+    Files whose content is already in the library (by original_hash) are
+    skipped. Up to jobs files are imported at once and their records are
+    committed to the catalog in batches every batch_interval seconds.
+    """
+
+    ignored = re.compile(r'^\.|\.(part|tmp|crdownload)$|~$')
+
+    def __init__(
+        self,
+        dirs: list[Path],
+        key: str,
+        tmp: Tmp,
+        root_dir: Path = None,
+        kind: str = None,
+        jobs: int = 2,
+        settle: float = 5,
+        batch_interval: float = 10,
+        rescan_interval: float = 60,
+        done_dir: Path = None,
+        **options,
+    ):
+        self.dirs = dirs
+        self.key = key
+        self.tmp = tmp
+        self.root_dir = root_dir or Path('.')
+        self.kind = kind
+        self.semaphore = asyncio.Semaphore(jobs)
+        self.settle = settle
+        self.batch_interval = batch_interval
+        self.rescan_interval = rescan_interval
+        self.done_dir = done_dir
+        self.options = options
+
+        self.db = DB(key, tmp, self.root_dir)
+        self.hashes = set()
+        # path -> (size, mtime, first seen unchanged)
+        self.pending = {}
+        # path -> (size, mtime) already handled
+        self.seen = {}
+        self.importing = set()
+        self.batch = []
+        self.tasks = set()
+
+    def offer(self, path: Path):
+        if self.ignored.search(path.name) or path in self.importing:
+            return
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if self.seen.get(path) == signature:
+            return
+        last = self.pending.get(path)
+        if not last or last[:2] != signature:
+            self.pending[path] = (*signature, time.monotonic())
+
+    def scan(self, inotify: Inotify = None):
+        for dir in self.dirs:
+            for root, dirs, files in os.walk(dir):
+                root = Path(root)
+                if inotify and root not in inotify.watches.values():
+                    inotify.add(root)
+                for name in files:
+                    self.offer(root / name)
+
+    def take_settled(self):
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime, since) in list(self.pending.items()):
+            self.offer(path)  # Refreshes the signature if it changed
+            if path not in self.pending:
+                continue
+            if self.pending[path][2] == since and now - since >= self.settle:
+                ready.append(path)
+                del self.pending[path]
+        return ready
+
+    async def import_file(self, path: Path):
+        async with self.semaphore:
+            stat = path.stat()
+            self.seen[path] = (stat.st_size, stat.st_mtime_ns)
+
+            md5 = await asyncio.to_thread(calculate_md5, path)
+            if md5 in self.hashes:
+                print(f"Already imported: {path}")
+                return
+            self.hashes.add(md5)
+
+            kind = self.kind or guess_kind(path)
+            tmp = Tmp(self.tmp.root)
+            try:
+                importer = importer_classes[kind](
+                    file=path,
+                    key=self.key,
+                    tmp=tmp,
+                    root_dir=self.root_dir,
+                    **self.options,
+                )
+                record = await importer.consume(commit=False)
+            except Exception as e:
+                self.hashes.discard(md5)
+                print(f"Failed to import {path}: {e}")
+                return
+            finally:
+                tmp.cleanup()
+
+            self.batch.append((record, importer.text, path))
+
+    async def commit(self):
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+
+        records = [record for record, _, _ in batch]
+        try:
+            await self.db.add(records, [text for _, text, _ in batch])
+        except Exception as e:
+            print(f"Failed to commit {len(batch)} records: {e}")
+            for record in records:
+                shutil.rmtree(self.db.media_dir / record['uid'],
+                              ignore_errors=True)
+            for record in records:
+                self.hashes.discard(record['original_hash'])
+            return
+
+        print(f"Committed {len(batch)} records")
+        if self.done_dir:
+            for _, _, path in batch:
+                self.done_dir.mkdir(parents=True, exist_ok=True)
+                shutil.move(path, self.done_dir / path.name)
+
+    def spawn(self, path: Path):
+        self.importing.add(path)
+        task = asyncio.create_task(self.import_file(path))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        task.add_done_callback(lambda _: self.importing.discard(path))
+
+    async def run(self):
+        async with self.db as db:
+            self.hashes = {r['original_hash'] for r in db}
+
+        try:
+            inotify = Inotify()
+        except (OSError, AttributeError):
+            print("inotify unavailable, polling")
+            inotify = None
+
+        self.scan(inotify)
+        last_scan = last_commit = time.monotonic()
+
+        try:
+            while True:
+                await asyncio.sleep(1)
+
+                if inotify:
+                    for path, is_dir in inotify.read():
+                        if is_dir:
+                            inotify.add(path)
+                            self.scan(inotify)
+                        else:
+                            self.offer(path)
+
+                now = time.monotonic()
+                if not inotify or now - last_scan >= self.rescan_interval:
+                    # Also catches what inotify misses, e.g. on network shares
+                    self.scan(inotify)
+                    last_scan = now
+
+                for path in self.take_settled():
+                    self.spawn(path)
+
+                if now - last_commit >= self.batch_interval:
+                    await self.commit()
+                    last_commit = now
+        finally:
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.commit()
+            if inotify:
+                inotify.close()
+
+
+class PushFailed(Exception):
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+
+class Pusher:
+    """Uploads files to a remote xtube server over pooled connections
+
+    Files up to chunk_size go through PUT /api/media, videos and larger
+    files through a resumable upload session with their chunks sent in
+    parallel, whose import runs in the background while the session is
+    polled. Requests are retried with exponential backoff on connection
+    errors, 429 and 5xx (e.g. 503 from the server's queue limit). PUT
+    /api/media isn't idempotent, it's only retried where the server can't
+    have acted on it: it wasn't reached, or it turned it away (429, 503).
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504, 507)
+    # Answered before the server does anything
+    refused_statuses = (429, 503)
+
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        tmp: Tmp,
+        kind: str = None,
+        jobs: int = 4,
+        retries: int = 5,
+        skip_existing: bool = False,
+        chunk_size: int = 32 * 1024 * 1024,
+        **options,
+    ):
+        self.url = urllib.parse.urlsplit(url)
+        self.key = key
+        self.tmp = tmp
+        self.kind = kind
+        self.jobs = jobs
+        self.retries = retries
+        self.skip_existing = skip_existing
+        self.chunk_size = chunk_size
+        self.poll_interval = 5
+        self.options = {k: v for k, v in options.items() if v is not None}
+
+        self.pool = asyncio.Queue()
+        for _ in range(jobs):
+            self.pool.put_nowait(None)  # Connected lazily
+        self.sent = 0
+        self.done = 0
+        self.failed = []
+
+    def connect(self):
+        cls = http.client.HTTPSConnection if self.url.scheme == 'https' \
+            else http.client.HTTPConnection
+        return cls(self.url.hostname, self.url.port, timeout=600)
+
+    def send(self, conn, method: str, path: str, body, headers: dict):
+        conn.request(method, self.url.path.rstrip('/') + path,
+                     body=body, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+
+    async def request(self, method: str, path: str, body=None,
+                      headers: dict = None, body_size: int = 0,
+                      idempotent: bool = True):
+        """body may be a callable returning a fresh body for each attempt"""
+        for attempt in range(self.retries + 1):
+            conn = await self.pool.get()
+            sent = False
+            try:
+                # A pooled connection the server closed fails only once the
+                # request is out, too late for those that aren't idempotent
+                if conn is None or not idempotent:
+                    if conn:
+                        conn.close()
+                    conn = self.connect()
+                    await asyncio.to_thread(conn.connect)
+                sent = True
+                status, data = await asyncio.to_thread(
+                    self.send, conn, method, path,
+                    body() if callable(body) else body, headers or {})
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                conn, status, data = None, None, str(e).encode()
+            finally:
+                self.pool.put_nowait(conn)
+
+            if status is not None and status < 300:
+                self.sent += body_size
+                return data
+            if idempotent:
+                retry = status is None or status in self.retry_statuses
+            else:
+                retry = not sent or status in self.refused_statuses
+            if not retry or attempt == self.retries:
+                raise PushFailed(f"{method} {path}: {status} {data[:200]}",
+                                 status)
+
+            delay = min(2 ** attempt, 60) * random.uniform(0.5, 1.5)
+            await asyncio.sleep(delay)
+
+    async def request_json(self, method: str, path: str, obj: dict):
+        body = json.dumps(obj).encode()
+        data = await self.request(method, path, body, {
+            'Content-Type': 'application/json',
+        })
+        return json.loads(data) if data else None
+
+    @staticmethod
+    def multipart(fields: dict, files: dict[str, Path]):
+        """Returns (content type, size, body factory) streaming the files"""
+        boundary = random_string(32)
+        parts = []
+        for name, value in fields.items():
+            parts.append((f'--{boundary}\r\nContent-Disposition: form-data; '
+                          f'name="{name}"\r\n\r\n{value}\r\n').encode())
+        for name, path in files.items():
+            filename = json.dumps(path.name, ensure_ascii=False)
+            parts.append((f'--{boundary}\r\nContent-Disposition: form-data; '
+                          f'name="{name}"; filename={filename}\r\n'
+                          'Content-Type: application/octet-stream\r\n\r\n'
+                          ).encode())
+            parts.append(path)
+            parts.append(b'\r\n')
+        parts.append(f'--{boundary}--\r\n'.encode())
+
+        size = sum(p.stat().st_size if isinstance(p, Path) else len(p)
+                   for p in parts)
+
+        def body():
+            for part in parts:
+                if isinstance(part, Path):
+                    with open(part, 'rb') as f:
+                        while chunk := f.read(1024 * 1024):
+                            yield chunk
+                else:
+                    yield part
+
+        return f'multipart/form-data; boundary={boundary}', size, body
+
+    async def remote_hashes(self):
+        """original_hash of everything on the server, via the catalog"""
+        try:
+            catalog = await self.request('GET', '/data/db.yaml.enc')
+        except PushFailed as e:
+            if e.status == 404:
+                return set()  # Empty library
+            raise
+        key_info = YAML.loads((await self.request(
+            'GET', '/data/key_info.yaml')).decode())
+
+        ct_path = self.tmp.file()
+        ct_path.write_bytes(catalog)
+        pt_path = self.tmp.file()
+        await Cmd.decrypt_file(ct_path, pt_path, self.key, key_info['iv'])
+        return {r['original_hash'] for r in YAML.loads(pt_path.read_text())}
+
+    async def push_small(self, file: Path, kind: str):
+        files = {'file': file}
+        fields = {'key': self.key, 'kind': kind, **self.options}
+        if 'thumbnail' in fields:
+            files['thumbnail'] = Path(fields.pop('thumbnail'))
+        content_type, size, body = Pusher.multipart(fields, files)
+        await self.request('PUT', '/api/media', body, {
+            'Content-Type': content_type,
+            'Content-Length': str(size),
+        }, body_size=file.stat().st_size, idempotent=False)
+
+    async def push_large(self, file: Path, kind: str):
+        size = file.stat().st_size
+        def sha256_file():
+            with open(file, 'rb') as f:
+                return hashlib.file_digest(f, 'sha256').hexdigest()
+
+        sha256 = await asyncio.to_thread(sha256_file)
+        options = {k: v for k, v in self.options.items() if k != 'thumbnail'}
+        thumbnail = self.options.get('thumbnail')
+        # A retry may leave an unused session behind, it expires
+        session = await self.request_json('POST', '/api/upload', {
+            'key': self.key,
+            'kind': kind,
+            'filename': file.name,
+            'size': size,
+            'sha256': sha256,
+            **options,
+        })
+        chunk_size = min(self.chunk_size, session['max_chunk_size'])
+        semaphore = asyncio.Semaphore(self.jobs)
+
+        async def push_chunk(offset: int):
+            async with semaphore:
+                with open(file, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(chunk_size)
+                digest = hashlib.sha256(data).hexdigest()
+                await self.request(
+                    'PUT',
+                    f"/api/upload/{session['id']}?offset={offset}"
+                    f"&sha256={digest}",
+                    data,
+                    {'Content-Type': 'application/octet-stream'},
+                    body_size=len(data),
+                )
+
+        await asyncio.gather(*(push_chunk(offset)
+                               for offset in range(0, size, chunk_size)))
+        if thumbnail:
+            thumbnail = Path(thumbnail)
+            name = urllib.parse.quote(thumbnail.name)
+            await self.request(
+                'PUT',
+                f"/api/upload/{session['id']}/thumbnail?filename={name}",
+                thumbnail.read_bytes(),
+                {'Content-Type': 'application/octet-stream'},
+            )
+
+        # Imports of large files take longer than any request should, the
+        # server answers 202 and imports in the background
+        status = await self.request_json(
+            'POST', f"/api/upload/{session['id']}/finalize", {'key': self.key})
+        while not status['result']:
+            await asyncio.sleep(self.poll_interval)
+            status = json.loads(await self.request(
+                'GET', f"/api/upload/{session['id']}"))
+        if status['result']['state'] != 'done':
+            raise Exception(f"Import failed: {status['result'].get('error')}")
+
+    async def push_file(self, file: Path, hashes: set, semaphore):
+        async with semaphore:
+            if self.skip_existing:
+                md5 = await asyncio.to_thread(calculate_md5, file)
+                if md5 in hashes:
+                    print(f"Already on server: {file}")
+                    return
+            kind = self.kind or guess_kind(file)
+            try:
+                # Transcoding may outlast the request timeout, a session
+                # imports in the background
+                if file.stat().st_size <= self.chunk_size and \
+                        kind != 'video':
+                    await self.push_small(file, kind)
+                else:
+                    await self.push_large(file, kind)
+                self.done += 1
+                print(f"Pushed: {file}")
+            except Exception as e:
+                self.failed.append(file)
+                print(f"Failed: {file}: {e}")
+
+    async def report(self, start: float, interval: float = 5):
+        while True:
+            await asyncio.sleep(interval)
+            elapsed = time.monotonic() - start
+            print(f"{self.done} files, {self.sent / 2**20:.1f} MiB, "
+                  f"{self.sent / 2**20 / elapsed:.1f} MiB/s")
+
+    async def push(self, files: list[Path]):
+        try:
+            hashes = await self.remote_hashes() if self.skip_existing \
+                else set()
+        except Exception as e:
+            print(f"Can't tell what the server has: {e}")
+            return False
+        semaphore = asyncio.Semaphore(self.jobs)
+        start = time.monotonic()
+        reporter = asyncio.create_task(self.report(start))
+        try:
+            await asyncio.gather(*(self.push_file(f, hashes, semaphore)
+                                   for f in files))
+        finally:
+            reporter.cancel()
+
+        elapsed = time.monotonic() - start
+        print(f"Pushed {self.done}/{len(files)} files, "
+              f"{self.sent / 2**20:.1f} MiB in {elapsed:.1f}s "
+              f"({self.sent / 2**20 / max(elapsed, 1e-9):.1f} MiB/s)")
+        return not self.failed
+
+
 def get_command_line_args():
     # Validators
     def v_file(path: str):
@@ -997,6 +4670,11 @@ def get_command_line_args():
         assert path.is_file(), f'File not found: {path}'
         return path
 
+    def v_path(path: str):
+        path = Path(path)
+        assert path.exists(), f'Not found: {path}'
+        return path
+
     def v_dir(path: str):
         path = Path(path)
         assert path.is_dir(), f'Dir not found: {path}'
@@ -1011,6 +4689,8 @@ def get_command_line_args():
     ca = common_parser.add_argument
     ca('-k', '--key', help='The 128bit hex key', type=v_key)
     ca('-d', '--root-dir', help='The root dir (default: .)', type=v_dir)
+    ca('--staging-dir', help='The temp dir (default: system temp dir)',
+       type=Path)
 
     # Base parser
     base_parser = ArgumentParser(add_help=False)
@@ -1021,6 +4701,10 @@ def get_command_line_args():
     ba('-t', '--thumbnail', help='The thumbnail image path', type=v_file)
     ba('-F', '--thumbnail-font', help='The thumbnail font path', type=v_file)
     ba('-n', '--no-encryption', help='Disable encryption', action='store_true')
+    ba('--no-compression', help='Never gzip text-like files before encryption',
+       action='store_true')
+    ba('--spool', help='Leave the import to spool workers and wait for it',
+       action='store_true')
 
     # Main parser
     parser = ArgumentParser(description='Import file into the database')
@@ -1031,8 +4715,16 @@ def get_command_line_args():
     video_parser = subparsers.add_parser(
         'video', parents=[common_parser, base_parser], help='Import video')
     va = video_parser.add_argument
-    va('--bitrate', help='The output video bitrate (default: 2000k)')
+    va('--bitrate', help='The output video bitrate or crf=N (default: '
+       'from the calibrate profile, else 2000k)')
     va('--hls-time', help='The segment duration (default: 10)', type=int)
+    va('--hls-type', help='The segment format (default: mpegts)',
+       choices=['mpegts', 'fmp4'])
+    va('--hls-init-time', type=float,
+       help='The first segment duration, doubling up to --hls-time, '
+       '0 for uniform segments (default: 2)')
+    va('--storyboard-interval', type=float,
+       help='Seconds between scrub preview frames, 0 to disable (default: 5)')
 
     # Image
     image_parser = subparsers.add_parser(
@@ -1051,6 +4743,20 @@ def get_command_line_args():
     ba('--language', help='[text] Language of the book (default: en-US)')
     ba('--toc-title', help='[text] TOC title (default: Table of Contents)')
     ba('--max-ctl', help='[text] Max chapter title length (default: 100)')
+    ba('--optimize', action='store_true',
+       help='[epub] Shrink images to WebP, drop unused items, recompress')
+    ba('--resize', help='[epub] Max image geometry (default: 1600x2400>)')
+    ba('--quality', help='[epub] WebP quality (default: 80)', type=int)
+
+    # Gallery
+    gallery_parser = subparsers.add_parser(
+        'gallery', parents=[common_parser, base_parser],
+        conflict_handler='resolve',
+        help='Import gallery/comic [cbz, zip or dir of images]')
+    ga = gallery_parser.add_argument
+    ga('-f', '--file', help='The archive or dir path', type=v_path)
+    ga('--resize', help='The page resize geometry (default: 2560x2560>)')
+    ga('--quality', help='The page quality (default: 80)', type=int)
 
     # Note
     subparsers.add_parser(
@@ -1074,6 +4780,211 @@ def get_command_line_args():
     ra = remove_parser.add_argument
     ra("uid", nargs='+', help="The uid to remove")
 
+    # Restore
+    restore_parser = subparsers.add_parser(
+        'restore', parents=[common_parser], help='Restore removed by uid')
+    ra = restore_parser.add_argument
+    ra("uid", nargs='+', help="The uid to restore")
+
+    # Empty trash
+    empty_trash_parser = subparsers.add_parser(
+        'empty-trash', parents=[common_parser],
+        help='Delete removed resources for good')
+    ea = empty_trash_parser.add_argument
+    ea('--max-age', help='Only older than seconds (default: 0)',
+       type=float, default=0)
+    ea('--rate', help='Max bytes deleted per second', type=int)
+
+    # Verify
+    verify_parser = subparsers.add_parser(
+        'verify', parents=[common_parser],
+        help='Check resources against md5sum.txt and the database')
+    va = verify_parser.add_argument
+    va('--workers', help='Parallel readers (default: 4)', type=int, default=4)
+    va('--rate', help='Max bytes read per second', type=int)
+    va('--incremental', help='Skip resources unchanged since last pass',
+       action='store_true')
+    va('--quarantine', action='store_true',
+       help='Move corrupted and orphaned dirs to .quarantine, marking the '
+            'records of corrupted ones quarantined')
+    va('--repair', help='Remove records whose resource dir is missing',
+       action='store_true')
+
+    # Rekey
+    rekey_parser = subparsers.add_parser(
+        'rekey', parents=[common_parser],
+        help='Re-encrypt the whole library with a new key')
+    ra = rekey_parser.add_argument
+    ra('--new-key', help='The new 128bit hex key', type=v_key, required=True)
+    ra('--workers', help='Parallel files (default: 4)', type=int, default=4)
+
+    # Regenerate
+    regenerate_parser = subparsers.add_parser(
+        'regenerate', parents=[common_parser],
+        help='Rebuild derivatives of existing records with new options')
+    ra = regenerate_parser.add_argument
+    ra('derivative', nargs='+', choices=Regenerator.derivatives,
+       help='What to rebuild, thumbnails users picked are kept unless '
+            '--replace-custom-thumbnails')
+    ra('--kind', nargs='+', dest='kinds', help='Only records of these kinds',
+       choices=[kind.value for kind in MediaKind])
+    ra('--uid', nargs='+', dest='uids', help='Only these records')
+    ra('--where', action='append', metavar='FIELD=GLOB',
+       help='Only records whose field matches, e.g. mime_type=image/*')
+    ra('--workers', help='Parallel records (default: 4)', type=int, default=4)
+    ra('--replace-custom-thumbnails', action='store_true',
+       help='Also rebuild thumbnails that were uploaded or edited')
+    ra('-F', '--thumbnail-font', help='The thumbnail font path', type=v_file)
+    ra('--bitrate', help='[video] The output video bitrate')
+    ra('--hls-time', help='[video] The segment duration', type=int)
+    ra('--hls-type', help='[video] The segment format',
+       choices=['mpegts', 'fmp4'])
+    ra('--hls-init-time', help='[video] The first segment duration',
+       type=float)
+    ra('--storyboard-interval', type=float,
+       help='[video] Seconds between scrub preview frames, 0 to disable')
+    ra('--resize', help='[image, gallery, book] The resize geometry')
+    ra('--quality', help='[image, gallery, book] The output quality',
+       type=int)
+    ra('--optimize', help='[book] Optimize EPUB assets', action='store_true',
+       default=None)
+    ra('--no-compression', help='Never gzip text-like files',
+       action='store_true', default=None)
+
+    # Watch
+    watch_parser = subparsers.add_parser(
+        'watch', parents=[common_parser],
+        help='Keep importing files dropped into dirs')
+    wa = watch_parser.add_argument
+    wa('dir', nargs='+', help='The dirs to watch', type=v_dir)
+    wa('--kind', help='Import as this kind (default: by MIME type)',
+       choices=[kind.value for kind in MediaKind])
+    wa('-j', '--jobs', help='Concurrent imports (default: 2)', type=int,
+       default=2)
+    wa('--settle', help='Seconds a file must be unchanged (default: 5)',
+       type=float, default=5)
+    wa('--batch', help='Seconds between catalog commits (default: 10)',
+       type=float, default=10)
+    wa('--done-dir', help='Move imported files here', type=Path)
+    wa('-F', '--thumbnail-font', help='The thumbnail font path', type=v_file)
+    wa('-n', '--no-encryption', help='Disable encryption', action='store_true')
+
+    # Worker
+    worker_parser = subparsers.add_parser(
+        'worker', parents=[common_parser],
+        help='Run spool jobs, also from other hosts sharing the root dir')
+    wa = worker_parser.add_argument
+    wa('--kind', nargs='+', dest='kinds', help='Only take jobs of these kinds',
+       choices=[kind.value for kind in MediaKind])
+    wa('-j', '--jobs', help='Concurrent jobs (default: 1)', type=int,
+       default=1)
+    wa('--lease-time', type=float, default=300,
+       help='Seconds before jobs of a silent worker are retried '
+       '(default: 300)')
+    wa('--once', help='Exit when the queue is empty', action='store_true')
+    wa('-F', '--thumbnail-font', help='The thumbnail font path', type=v_file)
+
+    # Commit spool
+    subparsers.add_parser(
+        'spool-commit', parents=[common_parser],
+        help='Add records of finished spool jobs nobody committed')
+
+    # Push
+    push_parser = subparsers.add_parser(
+        'push', help='Upload files to a remote server')
+    pa = push_parser.add_argument
+    pa('url', help='The server URL, e.g. http://localhost:8000')
+    pa('file', nargs='+', help='The files to upload', type=v_file)
+    pa('-k', '--key', help='The 128bit hex key', type=v_key)
+    pa('--kind', help='Upload as this kind (default: by MIME type)',
+       choices=[kind.value for kind in MediaKind])
+    pa('-T', '--title', help='The title (default: file name)')
+    pa('-D', '--description', help='The description')
+    pa('-t', '--thumbnail', help='The thumbnail image path', type=v_file)
+    pa('--bitrate', help='[video] The output video bitrate')
+    pa('--hls-time', help='[video] The segment duration', type=int)
+    pa('--hls-type', help='[video] The segment container',
+       choices=['mpegts', 'fmp4'])
+    pa('--hls-init-time', help='[video] Duration of the leading segments',
+       type=float)
+    pa('--storyboard-interval', type=float,
+       help='[video] Seconds between storyboard frames (0 disables)')
+    pa('--resize', help='[image] The resize geometry')
+    pa('--quality', help='[image] The output image quality', type=int)
+    pa('--encoding', help='[book] Encoding of the text file')
+    pa('--author', help='[book] Author of the book')
+    pa('--language', help='[book] Language of the book')
+    pa('--toc-title', help='[book] TOC title')
+    pa('--max-ctl', help='[book] Max chapter title length', type=int)
+    pa('--optimize', help='[book] Optimize EPUB assets', action='store_true',
+       default=None)
+    pa('-j', '--jobs', help='Concurrent uploads (default: 4)', type=int,
+       default=4)
+    pa('--retries', help='Retries per request (default: 5)', type=int,
+       default=5)
+    pa('--skip-existing', help='Skip files already on the server by hash',
+       action='store_true')
+    pa('--chunk-size', type=int, default=32 * 1024 * 1024,
+       help='Larger files are uploaded resumably in chunks of this size')
+
+    # Reindex
+    subparsers.add_parser(
+        'reindex', parents=[common_parser], help='Rebuild the search index')
+
+    # Search
+    search_parser = subparsers.add_parser(
+        'search', parents=[common_parser],
+        help='Print the records whose text contains all words of a query')
+    search_parser.add_argument('query', help='Words to look up')
+
+    # Backup
+    backup_parser = subparsers.add_parser(
+        'backup', parents=[common_parser],
+        help='Write the encrypted library to a tar archive')
+    ba = backup_parser.add_argument
+    ba('path', help='The output archive path, - for stdout')
+    ba('--since', help='Only resources changed since this manifest',
+       type=v_file)
+    ba('--manifest', help='Write the manifest for a later --since here',
+       type=Path)
+    ba('--workers', help='Parallel readers (default: 4)', type=int, default=4)
+
+    # Restore backup
+    restore_backup_parser = subparsers.add_parser(
+        'restore-backup', parents=[common_parser],
+        help='Restore a full backup followed by its incremental ones')
+    ra = restore_backup_parser.add_argument
+    ra('path', nargs='+', help='The archive paths in order, - for stdin')
+    ra('--verify-only', help='Only check the archives', action='store_true')
+
+    # Calibrate
+    calibrate_parser = subparsers.add_parser(
+        'calibrate', parents=[common_parser],
+        help='Measure x264 settings on sample videos for the importer')
+    cla = calibrate_parser.add_argument
+    cla('file', nargs='+', help='Videos typical of the library', type=v_file)
+    cla('--sample-time', help='Seconds encoded per sample (default: 10)',
+        type=float, default=10)
+    cla('--target-speed', type=float, default=1,
+        help='Seconds of video encoded per second per job (default: 1)')
+    cla('--target-ssim', help='Minimum SSIM (default: 0.97)', type=float,
+        default=0.97)
+    cla('--presets', help='Comma separated x264 presets to try',
+        type=lambda s: s.split(','))
+    cla('--rates', help='Comma separated bitrates or crf=N to try',
+        type=lambda s: s.split(','))
+
+    # Publish
+    publish_parser = subparsers.add_parser(
+        'publish', parents=[common_parser],
+        help='Write the library and the UI as a static site')
+    pua = publish_parser.add_argument
+    pua('output', help='The output dir, updated in place', type=Path)
+    pua('--ui', help='The built UI (default: dist)', type=Path,
+        default=Path('dist'))
+    pua('--workers', help='Parallel copies (default: 4)', type=int,
+        default=4)
+
     # Export DB
     export_db_parser = subparsers.add_parser(
         'export-db', parents=[common_parser], help='Export database')
@@ -1095,6 +5006,7 @@ class MediaKind(str, Enum):
     book = "book"
     note = "note"
     file = "file"
+    gallery = "gallery"
 
 
 importer_classes = {
@@ -1103,20 +5015,558 @@ importer_classes = {
     'book': BookImporter,
     'note': NoteImporter,
     'file': FileImporter,
+    'gallery': GalleryImporter,
 }
 
 
-async def import_media(kind: MediaKind = None, **kwargs):
-    await importer_classes[kind](**kwargs).consume()
+async def import_media(kind: MediaKind = None, spool: bool = False,
+                       **kwargs):
+    if spool:
+        # Transcoded by spool workers, possibly on other hosts
+        spool = Spool(kwargs.pop('root_dir', None) or Path('.'))
+        await spool.import_media(kind, **kwargs)
+    else:
+        await importer_classes[kind](**kwargs).consume()
+
+
+def merge_ranges(ranges: list[tuple[int, int]]):
+    """Merges [start, end) ranges into a sorted, non-overlapping list"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class UploadSession:
+    """A resumable upload assembled in place under root_dir/.uploads/<id>
+
+    Chunks are written at their offset straight into a preallocated file, so
+    they may arrive in any order and in parallel, and finalizing needs no
+    extra copy. Received ranges are appended to ranges.txt after the data is
+    synced, so a session survives a server restart. The outcome of the
+    import is kept in result.yaml until the session is collected, so a
+    client can poll for it or retry finalizing after a lost response.
+    """
+
+    max_chunk_size = 64 * 1024 * 1024
+    reserved = ('id', 'kind', 'filename', 'size', 'sha256', 'created')
+
+    def __init__(self, root_dir: Path, id: str):
+        if not re.match('[0-9A-Za-z]+$', id):
+            raise ValueError("Invalid upload id")
+
+        self.dir = root_dir / '.uploads' / id
+        if not self.dir.is_dir():
+            raise FileNotFoundError(f"Upload not found: {id}")
+
+        self.root_dir = root_dir
+        self.info = YAML.loads((self.dir / 'session.yaml').read_text())
+        self.data_file = self.dir / 'data'
+        self.ranges_file = self.dir / 'ranges.txt'
+        self.result_file = self.dir / 'result.yaml'
+        self.thumbnail_dir = self.dir / 'thumbnail'
+
+    @staticmethod
+    def create(
+        root_dir: Path,
+        kind: str,
+        filename: str,
+        size: int,
+        sha256: str = None,
+        **options,
+    ):
+        if size < 0:
+            raise ValueError("Invalid size")
+        ensure_free_space(root_dir, 2 * size)
+
+        id = random_string(16)
+        dir = root_dir / '.uploads' / id
+        dir.mkdir(parents=True)
+
+        with open(dir / 'data', 'wb') as f:
+            f.truncate(size)
+        (dir / 'ranges.txt').touch()
+
+        info = {
+            'id': id,
+            'kind': MediaKind(kind).value,
+            'filename': Path(filename).name or 'file',
+            'size': size,
+            'sha256': sha256,
+            'created': datetime.now().astimezone().isoformat(),
+        }
+        info.update({k: v for k, v in options.items() if v is not None})
+        (dir / 'session.yaml').write_text(YAML.dumps(info))
+
+        return UploadSession(root_dir, id)
+
+    def write_chunk(self, offset: int, data: bytes, sha256: str = None):
+        if len(data) > self.max_chunk_size:
+            raise ValueError("Chunk too large")
+        if offset < 0 or offset + len(data) > self.info['size']:
+            raise ValueError("Chunk out of range")
+        if sha256 and hashlib.sha256(data).hexdigest() != sha256.lower():
+            raise ValueError("Chunk digest mismatch")
+
+        fd = os.open(self.data_file, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, offset)
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+
+        # Small O_APPEND writes don't interleave
+        with open(self.ranges_file, 'a') as f:
+            f.write(f'{offset} {offset + len(data)}\n')
+
+    def write_thumbnail(self, filename: str, data: bytes):
+        if len(data) > self.max_chunk_size:
+            raise ValueError("Thumbnail too large")
+        if self.thumbnail_dir.exists():
+            shutil.rmtree(self.thumbnail_dir)
+        self.thumbnail_dir.mkdir()
+        (self.thumbnail_dir / (Path(filename).name or 'thumbnail')) \
+            .write_bytes(data)
+
+    def result(self):
+        """{'state': 'done' | 'failed', 'error'?} once finalizing ended"""
+        if self.result_file.is_file():
+            return YAML.loads(self.result_file.read_text())
+        return None
+
+    def received(self):
+        ranges = []
+        for line in self.ranges_file.read_text().splitlines():
+            start, end = line.split()
+            ranges.append((int(start), int(end)))
+        return merge_ranges(ranges)
+
+    def is_complete(self):
+        size = self.info['size']
+        return size == 0 or self.received() == [[0, size]]
+
+    def status(self):
+        return {
+            'id': self.info['id'],
+            'size': self.info['size'],
+            'received': self.received(),
+            'complete': self.is_complete(),
+            'result': self.result(),
+        }
+
+    async def finalize(self, key: str, tmp: Tmp, **kwargs):
+        """Imports the upload, recording the outcome in result.yaml"""
+        if (self.result() or {}).get('state') == 'done':
+            return
+        self.result_file.unlink(missing_ok=True)
+        # Not stale while importing, see collect()
+        self.ranges_file.touch()
+        try:
+            await self.import_upload(key, tmp, **kwargs)
+        except Exception as e:
+            self.result_file.write_text(YAML.dumps({
+                'state': 'failed',
+                'error': str(e),
+            }))
+            raise
+
+        # Only the result is left, for clients polling or retrying
+        for path in (self.data_file, self.thumbnail_dir):
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink(missing_ok=True)
+        self.result_file.write_text(YAML.dumps({'state': 'done'}))
+        self.ranges_file.touch()
+
+    async def import_upload(self, key: str, tmp: Tmp, **kwargs):
+        if not self.is_complete():
+            raise ValueError("Upload incomplete")
+
+        if self.info['sha256']:
+            def sha256_file(path: Path):
+                with open(path, 'rb') as f:
+                    return hashlib.file_digest(f, 'sha256').hexdigest()
+
+            digest = await asyncio.to_thread(sha256_file, self.data_file)
+            if digest != self.info['sha256'].lower():
+                raise ValueError("Upload digest mismatch")
+
+        # Fail before touching the data if the key is wrong
+        DB(key, tmp, kwargs.get('root_dir', self.root_dir))
+
+        # Give the importer the original name
+        file = self.dir / 'file' / self.info['filename']
+        tmp.adopt(file.parent).mkdir(exist_ok=True)
+        os.replace(self.data_file, file)
+
+        options = {k: v for k, v in self.info.items()
+                   if k not in self.reserved}
+        if self.thumbnail_dir.is_dir():
+            options['thumbnail'] = next(self.thumbnail_dir.iterdir(), None)
+        options.update(kwargs)
+        try:
+            await import_media(
+                kind=self.info['kind'], file=file, key=key, tmp=tmp, **options)
+        except BaseException:
+            # Keep the session so that finalizing can be retried
+            if file.exists():
+                os.replace(file, self.data_file)
+            raise
+
+    def abort(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    @staticmethod
+    def collect(root_dir: Path, max_age: float):
+        """Removes sessions untouched for max_age seconds"""
+        uploads_dir = root_dir / '.uploads'
+        if not uploads_dir.is_dir():
+            return []
+
+        removed = []
+        now = datetime.now().timestamp()
+        for dir in uploads_dir.iterdir():
+            ranges_file = dir / 'ranges.txt'
+            mtime = (ranges_file if ranges_file.exists() else dir).stat().st_mtime
+            if now - mtime > max_age:
+                shutil.rmtree(dir, ignore_errors=True)
+                removed.append(dir.name)
+        return removed
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Spool:
+    """Import jobs shared with worker processes under root_dir/.spool
+
+    A job is a dir holding the input file and job.yaml, which only ever
+    moves between incoming/, queue/, leased/, done/ and failed/ by rename.
+    That is atomic on one filesystem, so of several workers exactly one
+    wins a job: it holds queue/<id> as leased/<id>@<worker> and keeps
+    touching the lease file in it. Leases untouched for lease_time are put
+    back in the queue, so jobs of crashed workers are picked up again. Ages
+    are measured with the filesystem's clock, not the local one, since the
+    hosts sharing the volume may disagree on the time.
+
+    Workers import into media/<uid> and leave the record in done/<id>,
+    encrypted like the catalog, for the submitter to commit.
+    """
+
+    states = ('incoming', 'queue', 'leased', 'done', 'failed')
+    reserved = ('id', 'kind', 'filename', 'submitted')
+
+    def __init__(self, root_dir: Path, lease_time: float = 300):
+        self.root_dir = root_dir
+        self.dir = root_dir / '.spool'
+        self.lease_time = lease_time
+        for state in self.states:
+            (self.dir / state).mkdir(parents=True, exist_ok=True)
+
+    def submit(self, kind: str, file: Path, move: bool = False, **options):
+        # Ids sort by submission time, so workers take jobs in order
+        id = f'{time.time_ns():016x}{random_string(8)}'
+        job_dir = self.dir / 'incoming' / id
+        (job_dir / 'file').mkdir(parents=True)
+        place_file(file, job_dir / 'file' / file.name, move=move)
+
+        if thumbnail := options.pop('thumbnail', None):
+            (job_dir / 'thumbnail').mkdir()
+            thumbnail = Path(thumbnail)
+            place_file(thumbnail, job_dir / 'thumbnail' / thumbnail.name)
+            options['thumbnail'] = thumbnail.name
+
+        info = {
+            'id': id,
+            'kind': MediaKind(kind).value,
+            'filename': file.name,
+            'submitted': datetime.now().astimezone().isoformat(),
+        }
+        info.update({k: v for k, v in options.items()
+                     if isinstance(v, (str, int, float))})
+        (job_dir / 'job.yaml').write_text(YAML.dumps(info))
+
+        os.rename(job_dir, self.dir / 'queue' / id)
+        return id
+
+    def claim(self, worker: str, kinds: list[str] = None):
+        """Leases the oldest queued job, None if there is none"""
+        for job_dir in sorted((self.dir / 'queue').iterdir()):
+            try:
+                if kinds:
+                    info = YAML.loads((job_dir / 'job.yaml').read_text())
+                    if info['kind'] not in kinds:
+                        continue
+                lease_dir = self.dir / 'leased' / f'{job_dir.name}@{worker}'
+                os.rename(job_dir, lease_dir)
+            except FileNotFoundError:
+                continue  # Taken by another worker
+            (lease_dir / 'lease').touch()
+            return lease_dir
+        return None
+
+    def now(self):
+        """The current time as the filesystem stamps it"""
+        # touch() sets the time to now on the file server, as lease updates
+        clock = self.dir / 'clock'
+        clock.touch()
+        return clock.stat().st_mtime
+
+    def requeue_expired(self):
+        now = self.now()
+        requeued = []
+        for lease_dir in (self.dir / 'leased').iterdir():
+            lease = lease_dir / 'lease'
+            try:
+                # Renaming the dir on claim updates its ctime
+                touched = lease_dir.stat().st_ctime
+                if lease.exists():
+                    touched = max(touched, lease.stat().st_mtime)
+            except FileNotFoundError:
+                continue
+            if now - touched < self.lease_time:
+                continue
+
+            id = lease_dir.name.split('@')[0]
+            try:
+                os.rename(lease_dir, self.dir / 'queue' / id)
+            except OSError:
+                continue  # Requeued by someone else, or just published
+
+            # The import of the lost worker is of no use anymore
+            uid_file = self.dir / 'queue' / id / 'uid'
+            if uid_file.exists():
+                shutil.rmtree(self.root_dir / 'media' / uid_file.read_text(),
+                              ignore_errors=True)
+                uid_file.unlink(missing_ok=True)
+            requeued.append(id)
+        return requeued
+
+    async def publish(self, lease_dir: Path, record: dict, text: str,
+                      key: str, tmp: Tmp):
+        db = DB(key, tmp, self.root_dir)
+        pt_path = tmp.file()
+        pt_path.write_text(YAML.dumps({**record, '_text': text}))
+        await Cmd.encrypt_file(
+            pt_path, lease_dir / 'result.yaml.enc', key, db.iv)
+
+        id = lease_dir.name.split('@')[0]
+        try:
+            os.rename(lease_dir, self.dir / 'done' / id)
+        except FileNotFoundError:
+            raise LeaseLost(id)
+
+    def fail(self, lease_dir: Path, error: str):
+        (lease_dir / 'error.txt').write_text(error)
+        id = lease_dir.name.split('@')[0]
+        os.rename(lease_dir, self.dir / 'failed' / id)
+
+    def cancel(self, id: str):
+        """Withdraws a queued job, running ones end up collected"""
+        with contextlib.suppress(FileNotFoundError):
+            os.rename(self.dir / 'queue' / id, self.dir / 'incoming' / id)
+            shutil.rmtree(self.dir / 'incoming' / id)
+
+    async def wait(self, id: str, poll_interval: float = 1):
+        while True:
+            if (self.dir / 'done' / id).is_dir():
+                return
+            failed_dir = self.dir / 'failed' / id
+            if failed_dir.is_dir():
+                error = (failed_dir / 'error.txt').read_text()
+                shutil.rmtree(failed_dir)
+                raise Exception(f"Spool job {id} failed: {error}")
+            await asyncio.sleep(poll_interval)
+
+    async def commit(self, key: str, tmp: Tmp, ids: list[str] = None):
+        """Adds the records of finished jobs to the catalog"""
+        db = DB(key, tmp, self.root_dir)
+        if ids is None:
+            ids = sorted(dir.name for dir in (self.dir / 'done').iterdir())
+
+        records, texts = [], []
+        for id in ids:
+            pt_path = tmp.file()
+            await Cmd.decrypt_file(self.dir / 'done' / id / 'result.yaml.enc',
+                                   pt_path, key, db.iv)
+            record = YAML.loads(pt_path.read_text())
+            texts.append(record.pop('_text'))
+            records.append(record)
+
+        if records:
+            await db.add(records, texts)
+        for id in ids:
+            shutil.rmtree(self.dir / 'done' / id)
+        return records
+
+    async def import_media(self, kind: str, file: Path, key: str, tmp: Tmp,
+                           poll_interval: float = 1, **options):
+        # Workers render text thumbnails with their own font
+        options.pop('thumbnail_font', None)
+        db = DB(key, tmp, self.root_dir)  # Fail early on a wrong key
+
+        id = self.submit(kind, file, move=tmp.owns(file), **options)
+        try:
+            await self.wait(id, poll_interval)
+        except asyncio.CancelledError:
+            self.cancel(id)
+            raise
+        for record in await self.commit(key, tmp, [id]):
+            db.print_record(record)
+
+    def collect(self, max_age: float):
+        """Drops results nobody committed and failures nobody picked up"""
+        now = self.now()
+        removed = []
+        for state in ('done', 'failed', 'incoming'):
+            for job_dir in (self.dir / state).iterdir():
+                if now - job_dir.stat().st_ctime <= max_age:
+                    continue
+                uid_file = job_dir / 'uid'
+                if state == 'done' and uid_file.exists():
+                    shutil.rmtree(
+                        self.root_dir / 'media' / uid_file.read_text(),
+                        ignore_errors=True)
+                shutil.rmtree(job_dir, ignore_errors=True)
+                removed.append(job_dir.name)
+        return removed
+
+
+class SpoolWorker:
+    """Runs spool jobs, e.g. on another host sharing the data volume"""
+
+    def __init__(
+        self,
+        key: str,
+        tmp: Tmp,
+        root_dir: Path = None,
+        kinds: list[str] = None,
+        jobs: int = 1,
+        lease_time: float = 300,
+        poll_interval: float = 2,
+        once: bool = False,
+        **options,
+    ):
+        self.key = key
+        self.tmp = tmp
+        self.root_dir = root_dir or Path('.')
+        self.kinds = kinds
+        self.jobs = jobs
+        self.poll_interval = poll_interval
+        self.once = once
+        self.options = {k: v for k, v in options.items() if v is not None}
+
+        self.spool = Spool(self.root_dir, lease_time)
+        self.name = re.sub(r'[^0-9A-Za-z.-]', '-',
+                           f'{socket.gethostname()}-{os.getpid()}')
+        DB(key, tmp, self.root_dir)  # Fail early on a wrong key
+
+    async def heartbeat(self, lease_dir: Path):
+        while True:
+            await asyncio.sleep(self.spool.lease_time / 3)
+            try:
+                (lease_dir / 'lease').touch(exist_ok=True)
+            except FileNotFoundError:
+                return  # Lost, publishing will fail
+
+    async def run_job(self, lease_dir: Path):
+        info = YAML.loads((lease_dir / 'job.yaml').read_text())
+        options = {**self.options}
+        options.update({k: v for k, v in info.items()
+                        if k not in Spool.reserved})
+        if 'thumbnail' in options:
+            options['thumbnail'] = \
+                lease_dir / 'thumbnail' / options['thumbnail']
+
+        print(f"Running {info['kind']} job {info['id']}: {info['filename']}")
+        tmp = Tmp(self.tmp.root)
+        heartbeat = asyncio.create_task(self.heartbeat(lease_dir))
+        importer = None
+        try:
+            importer = importer_classes[info['kind']](
+                file=lease_dir / 'file' / info['filename'],
+                key=self.key,
+                tmp=tmp,
+                root_dir=self.root_dir,
+                **options,
+            )
+            (lease_dir / 'uid').write_text(importer.uid)
+            record = await importer.consume(commit=False)
+            await self.spool.publish(
+                lease_dir, record, importer.text, self.key, tmp)
+            print(f"Finished job {info['id']}: {record['uid']}")
+        except Exception as e:
+            if importer and importer.resource_dir.exists():
+                shutil.rmtree(importer.resource_dir, ignore_errors=True)
+            print(f"Job {info['id']} failed: {e}")
+            with contextlib.suppress(FileNotFoundError):
+                self.spool.fail(lease_dir, str(e) or type(e).__name__)
+        finally:
+            heartbeat.cancel()
+            tmp.cleanup()
+
+    async def run(self):
+        tasks = set()
+        try:
+            while True:
+                self.spool.requeue_expired()
+                while len(tasks) < self.jobs:
+                    lease_dir = self.spool.claim(self.name, self.kinds)
+                    if not lease_dir:
+                        break
+                    task = asyncio.create_task(self.run_job(lease_dir))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                if self.once and not tasks:
+                    return
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
 
 
 async def main(tmp: Tmp):
     args = get_command_line_args()
+    tmp.root = getattr(args, 'staging_dir', None)
+
+    if args.command == 'calibrate':
+        rows = await EncodingProfile(args.root_dir or Path('.')).calibrate(
+            args.file, tmp, args.sample_time,
+            args.target_speed, args.target_ssim, args.presets, args.rates)
+        print(f"Measured {len(rows)} settings")
+        return
+
+    # Backups only move ciphertext around
+    if args.command in ('backup', 'restore-backup'):
+        backup = Backup(args.root_dir or Path('.'))
+        if args.command == 'backup':
+            backup.workers = args.workers
+            result = backup.write(args.path, args.since, args.manifest)
+            print(f"Backed up {result['included']} of {result['resources']}"
+                  " resources", file=sys.stderr)
+        else:
+            failed = False
+            for path in args.path:
+                report = backup.restore(path, args.verify_only)
+                for status, uids in report.items():
+                    print(f"{path}: {status}: {' '.join(uids)}")
+                failed = failed or bool(report['corrupted'])
+            if failed:
+                sys.exit(1)
+        return
+
     key = get_encrypt_key(args.key)
 
     if args.command in importer_classes:
         kwargs = vars(args).copy()
         kwargs.pop('command')
+        kwargs.pop('staging_dir')
         kwargs['key'] = key
         kwargs['tmp'] = tmp
         await import_media(kind=args.command, **kwargs)
@@ -1126,6 +5576,110 @@ async def main(tmp: Tmp):
         DB(key, tmp, args.root_dir).clear()
     elif args.command == 'remove':
         await DB(key, tmp, args.root_dir).remove(args.uid)
+    elif args.command == 'restore':
+        await DB(key, tmp, args.root_dir).restore(args.uid)
+    elif args.command == 'empty-trash':
+        db = DB(key, tmp, args.root_dir)
+        await db.settle_trash()
+        collected = await db.trash.collect(args.max_age, args.rate)
+        print(f"Deleted: {' '.join(collected)}")
+    elif args.command == 'verify':
+        report = await Scrubber(
+            DB(key, tmp, args.root_dir),
+            workers=args.workers,
+            rate=args.rate,
+            incremental=args.incremental,
+            quarantine=args.quarantine,
+            repair=args.repair,
+        ).scrub()
+        for status, uids in report.items():
+            print(f"{status}: {len(uids)}")
+            if status not in ('ok', 'skipped'):
+                for uid in uids:
+                    print(f"  {uid}")
+        if report['corrupted'] or report['missing']:
+            sys.exit(1)
+    elif args.command == 'watch':
+        await Watcher(
+            args.dir,
+            key,
+            tmp,
+            root_dir=args.root_dir,
+            kind=args.kind,
+            jobs=args.jobs,
+            settle=args.settle,
+            batch_interval=args.batch,
+            done_dir=args.done_dir,
+            thumbnail_font=args.thumbnail_font,
+            no_encryption=args.no_encryption,
+        ).run()
+    elif args.command == 'worker':
+        await SpoolWorker(
+            key,
+            tmp,
+            args.root_dir,
+            kinds=args.kinds,
+            jobs=args.jobs,
+            lease_time=args.lease_time,
+            once=args.once,
+            thumbnail_font=args.thumbnail_font,
+        ).run()
+    elif args.command == 'spool-commit':
+        spool = Spool(args.root_dir or Path('.'))
+        records = await spool.commit(key, tmp)
+        print(f"Committed {len(records)} records")
+    elif args.command == 'push':
+        options = vars(args).copy()
+        for name in ('command', 'url', 'file', 'key'):
+            options.pop(name)
+        ok = await Pusher(args.url, key, tmp, **options).push(args.file)
+        if not ok:
+            sys.exit(1)
+    elif args.command == 'reindex':
+        db = DB(key, tmp, args.root_dir)
+        async with db as records:
+            records = list(records)
+        await db.index.rebuild(records)
+    elif args.command == 'search':
+        db = DB(key, tmp, args.root_dir)
+        uids = await db.index.search(args.query)
+        async with db as records:
+            by_uid = {record['uid']: record for record in records}
+        for uid in uids:
+            if uid in by_uid:
+                print(f"{uid}  {by_uid[uid].get('title', '')}")
+    elif args.command == 'rekey':
+        try:
+            db = DB(key, tmp, args.root_dir)
+        except ValueError:
+            # key_info.yaml switched over already, only the index is left
+            if not Rekeyer.committing(args.root_dir or Path('.')):
+                raise
+            db = DB(args.new_key, tmp, args.root_dir)
+        await Rekeyer(
+            db,
+            args.new_key,
+            workers=args.workers,
+        ).rekey()
+    elif args.command == 'regenerate':
+        options = vars(args).copy()
+        for name in ('command', 'key', 'root_dir', 'staging_dir',
+                     'derivative'):
+            options.pop(name)
+        result = await Regenerator(
+            DB(key, tmp, args.root_dir), args.derivative, **options,
+        ).regenerate()
+        print(f"Regenerated {len(result['regenerated'])} records")
+        if result['failed']:
+            print(f"Failed: {' '.join(result['failed'])}")
+            sys.exit(1)
+    elif args.command == 'publish':
+        report = await Publisher(DB(key, tmp, args.root_dir), args.ui,
+                                 args.output, args.workers).publish()
+        print(f"Published {len(report['copied']) + len(report['kept'])} "
+              f"resources: {len(report['copied'])} copied, "
+              f"{len(report['removed'])} removed, "
+              f"{report['compressed']} precompressed files")
     elif args.command == 'export-db':
         await DB(key, tmp, args.root_dir).save(args.path)
     elif args.command == 'import-db':
@@ -0,0 +1,485 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import import_media as IM
+import asyncio
+import gzip
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tomllib
+import urllib.parse
+
+
+def percentile(values: list[float], p: float):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # endpoint -> [latencies], endpoint -> {status: count}
+        self.latencies = {}
+        self.statuses = {}
+
+    def add(self, endpoint: str, latency: float, status):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            counts = self.statuses.setdefault(endpoint, {})
+            counts[status] = counts.get(status, 0) + 1
+
+    def report(self, elapsed: float):
+        rows = []
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            errors = sum(count for status, count in
+                         self.statuses[endpoint].items()
+                         if not isinstance(status, int) or status >= 400)
+            rows.append({
+                'endpoint': endpoint,
+                'requests': len(latencies),
+                'errors': errors,
+                'statuses': {str(k): v for k, v in
+                             self.statuses[endpoint].items()},
+                'rps': len(latencies) / elapsed,
+                'p50': percentile(latencies, 50) * 1000,
+                'p95': percentile(latencies, 95) * 1000,
+                'p99': percentile(latencies, 99) * 1000,
+            })
+        return rows
+
+
+class Client:
+    """A blocking keep-alive connection, one per load test thread"""
+
+    def __init__(self, url: urllib.parse.SplitResult, stats: Stats):
+        self.url = url
+        self.stats = stats
+        self.conn = None
+
+    def request(self, endpoint: str, method: str, path: str, body=None,
+                headers: dict = None):
+        start = time.monotonic()
+        try:
+            if not self.conn:
+                cls = http.client.HTTPSConnection \
+                    if self.url.scheme == 'https' else http.client.HTTPConnection
+                self.conn = cls(self.url.hostname, self.url.port, timeout=600)
+            self.conn.request(method, self.url.path.rstrip('/') + path,
+                              body=body, headers=headers or {})
+            response = self.conn.getresponse()
+            status, data = response.status, response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.conn.close()
+            self.conn = None
+            status, data = type(e).__name__, b''
+        self.stats.add(endpoint, time.monotonic() - start, status)
+        return status, data
+
+    def json(self, endpoint: str, method: str, path: str, obj: dict):
+        return self.request(endpoint, method, path, json.dumps(obj).encode(),
+                            {'Content-Type': 'application/json'})
+
+    def form(self, endpoint: str, method: str, path: str, fields: dict,
+             files: dict = None):
+        content_type, size, body = IM.Pusher.multipart(fields, files or {})
+        return self.request(endpoint, method, path, body(), {
+            'Content-Type': content_type,
+            'Content-Length': str(size),
+        })
+
+
+class LoadTest:
+    """Drives server.py with the mixed workloads of a scenario config
+
+    Each edit of a record is tracked with the title (or note content) the
+    server acknowledged. Edits of one record are never concurrent, so after
+    the run the catalog must hold exactly those, and neither deleted
+    records nor lost uploads. Anything else is a lost update.
+    """
+
+    def __init__(self, config: dict, key: str = None, keep: bool = False):
+        self.config = config
+        self.keep = keep
+        server = config.get('server', {})
+        self.key = key or server.get('key') or IM.random_string(32, 'h')
+        self.work_dir = Path(tempfile.mkdtemp(prefix='xtube-load-'))
+        self.media_dir = self.work_dir / 'media'
+        self.media_dir.mkdir()
+        self.server = None
+        if 'url' in server:
+            self.url = urllib.parse.urlsplit(server['url'])
+        else:
+            self.url = urllib.parse.urlsplit(
+                f"http://127.0.0.1:{server.get('port', 8765)}")
+
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.media = {}
+        self.records = {}  # uid -> record, of live seeded records
+        self.busy = set()
+        self.deleted = set()
+        self.uncertain = set()
+        self.titles = {}  # uid -> acknowledged title
+        self.notes = {}  # uid -> acknowledged content
+        self.uploads = set()  # Acknowledged upload titles
+        self.counter = 0
+
+    def start_server(self):
+        data_dir = self.work_dir / 'data'
+        ui_dir = self.work_dir / 'ui'
+        data_dir.mkdir()
+        ui_dir.mkdir()
+        server = self.config.get('server', {})
+        env = {**os.environ, 'DATA_DIR': str(data_dir), 'UI_DIR': str(ui_dir)}
+        self.server = subprocess.Popen([
+            sys.executable, '-m', 'uvicorn',
+            '--app-dir', str(Path(__file__).parent),
+            '--port', str(server.get('port', 8765)),
+            '--workers', str(server.get('workers', 1)),
+            '--log-level', 'warning',
+            'server:app',
+        ], env=env)
+
+        client = Client(self.url, Stats())
+        deadline = time.monotonic() + 60
+        while client.request('', 'GET', '/api/status')[0] != 200:
+            if self.server.poll() is not None or time.monotonic() > deadline:
+                raise Exception("Server didn't start")
+            time.sleep(0.5)
+
+    def stop_server(self):
+        if self.server:
+            self.server.terminate()
+            self.server.wait()
+
+    def generate_media(self):
+        options = self.config.get('media', {})
+        ffmpeg = shutil.which('ffmpeg')
+
+        if ffmpeg:
+            video = self.media_dir / 'video.mp4'
+            subprocess.run([
+                ffmpeg, '-y', '-loglevel', 'error', '-f', 'lavfi',
+                '-i', f"testsrc2=size={options.get('video_size', '1280x720')}"
+                ':rate=25',
+                '-f', 'lavfi', '-i', 'sine=frequency=440',
+                '-t', str(options.get('video_duration', 10)),
+                '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+                video,
+            ], check=True)
+            self.media['video'] = video
+
+            image = self.media_dir / 'image.png'
+            subprocess.run([
+                ffmpeg, '-y', '-loglevel', 'error', '-f', 'lavfi',
+                '-i', f"testsrc2=size={options.get('image_size', '3000x2000')}",
+                '-frames:v', '1', image,
+            ], check=True)
+            self.media['image'] = image
+        else:
+            print("ffmpeg not found, no video and image uploads")
+
+        book = self.media_dir / 'book.txt'
+        with open(book, 'w') as f:
+            for i in range(options.get('book_chapters', 50)):
+                f.write(f'Chapter {i + 1}\n\n')
+                for _ in range(20):
+                    f.write(' '.join(IM.random_string(random.randint(2, 10))
+                                     for _ in range(60)) + '\n\n')
+        self.media['book'] = book
+
+        self.media['note'] = '# Note\n\n' + ' '.join(
+            IM.random_string(8) for _ in range(options.get('note_size', 4096)
+                                               // 9))
+
+        file = self.media_dir / 'file.bin'
+        file.write_bytes(os.urandom(options.get('file_size', 4 * 2**20)))
+        self.media['file'] = file
+
+    def fetch_catalog(self):
+        client = Client(self.url, Stats())
+        status, key_info = client.request('', 'GET', '/data/key_info.yaml')
+        if status != 200:
+            return []
+        status, catalog = client.request('', 'GET', '/data/db.yaml.enc')
+        if status != 200:
+            return []
+        return IM.YAML.loads(self.decrypt(
+            catalog, IM.YAML.loads(key_info.decode())['iv']).decode())
+
+    def decrypt(self, data: bytes, iv: str):
+        async def decrypt():
+            async with IM.Tmp(self.work_dir) as tmp:
+                ct_path, pt_path = tmp.file(), tmp.file()
+                ct_path.write_bytes(data)
+                await IM.Cmd.decrypt_file(ct_path, pt_path, self.key, iv)
+                return pt_path.read_bytes()
+        return asyncio.run(decrypt())
+
+    def next_title(self, prefix: str):
+        with self.lock:
+            self.counter += 1
+            return f'{prefix}-{self.counter}'
+
+    def take(self, kinds: tuple = None):
+        """Reserves a live record for an edit or delete"""
+        with self.lock:
+            uids = [uid for uid, record in self.records.items()
+                    if uid not in self.busy and
+                    (not kinds or record['kind'] in kinds)]
+            if not uids:
+                return None
+            uid = random.choice(uids)
+            self.busy.add(uid)
+            return uid
+
+    def pick(self):
+        """A live record to read, without reserving it"""
+        with self.lock:
+            uids = [uid for uid in self.records if uid not in self.busy]
+            return self.records[random.choice(uids)] if uids else None
+
+    def release(self, uid: str):
+        with self.lock:
+            self.busy.discard(uid)
+
+    # Operations
+
+    def upload(self, client: Client, kind: str, title: str = None):
+        if kind not in self.media:
+            return
+        title = title or self.next_title(f'upload-{kind}')
+        if kind == 'note':
+            status, _ = client.form('PUT /api/note', 'PUT', '/api/note', {
+                'key': self.key,
+                'title': title,
+                'content': self.media['note'],
+            })
+        else:
+            status, _ = client.form(
+                f'PUT /api/media ({kind})', 'PUT', '/api/media',
+                {'key': self.key, 'kind': kind, 'title': title},
+                {'file': self.media[kind]})
+        if status == 200:
+            with self.lock:
+                self.uploads.add(title)
+
+    def edit_media(self, client: Client):
+        if not (uid := self.take()):
+            return
+        try:
+            title = self.next_title(f'edit-{uid}')
+            status, _ = client.form('PATCH /api/media', 'PATCH', '/api/media', {
+                'key': self.key,
+                'uid': uid,
+                'title': title,
+            })
+            with self.lock:
+                if status == 200:
+                    self.titles[uid] = title
+                    self.uncertain.discard(uid)
+                else:
+                    self.uncertain.add(uid)
+        finally:
+            self.release(uid)
+
+    def edit_note(self, client: Client):
+        if not (uid := self.take(('note',))):
+            return
+        try:
+            content = f'# {uid}\n\n' + self.next_title('content')
+            status, _ = client.json('PATCH /api/note', 'PATCH', '/api/note', {
+                'key': self.key,
+                'uid': uid,
+                'content': content,
+            })
+            with self.lock:
+                if status == 200:
+                    self.notes[uid] = content
+                    self.uncertain.discard(uid)
+                else:
+                    self.uncertain.add(uid)
+        finally:
+            self.release(uid)
+
+    def delete(self, client: Client):
+        if not (uid := self.take()):
+            return
+        status, _ = client.json('DELETE /api/media', 'DELETE', '/api/media', {
+            'key': self.key,
+            'uids': [uid],
+        })
+        with self.lock:
+            if status == 200:
+                del self.records[uid]
+                self.deleted.add(uid)
+            self.busy.discard(uid)
+
+    def read(self, client: Client):
+        if not (record := self.pick()):
+            return
+        path = random.choice([record['thumbnail'], record.get('file')
+                              or record['thumbnail']])
+        client.request('GET /data', 'GET', f'/data/{path}')
+
+    def run_operation(self, client: Client, operation: str):
+        if operation.startswith('upload_'):
+            self.upload(client, operation.removeprefix('upload_'))
+        elif operation in ('edit_media', 'edit_note', 'delete', 'read'):
+            getattr(self, operation)(client)
+        else:
+            raise ValueError(f"Unknown operation: {operation}")
+
+    def seed(self):
+        counts = self.config.get('seed', {})
+        jobs = [kind for kind, count in counts.items() for _ in range(count)]
+
+        def worker():
+            client = Client(self.url, self.stats)
+            while True:
+                with self.lock:
+                    if not jobs:
+                        return
+                    kind = jobs.pop()
+                self.upload(client, kind)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.records = {r['uid']: r for r in self.fetch_catalog()}
+        print(f"Seeded {len(self.records)} records")
+
+    def run_scenario(self, scenario: dict):
+        mix = scenario['mix']
+        operations, weights = list(mix), list(mix.values())
+        duration = scenario.get('duration', 30)
+        rate = scenario.get('rate')
+        deadline = time.monotonic() + duration
+        schedule = [time.monotonic()]
+
+        def worker():
+            client = Client(self.url, self.stats)
+            while time.monotonic() < deadline:
+                if rate:
+                    with self.lock:
+                        at = schedule[0] = max(schedule[0], time.monotonic()) \
+                            + 1 / rate
+                    if at > deadline:
+                        return
+                    time.sleep(max(0, at - time.monotonic()))
+                operation = random.choices(operations, weights)[0]
+                self.run_operation(client, operation)
+
+        self.stats = Stats()
+        start = time.monotonic()
+        threads = [threading.Thread(target=worker)
+                   for _ in range(scenario.get('concurrency', 8))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.stats.report(time.monotonic() - start)
+
+    def verify(self):
+        catalog = {r['uid']: r for r in self.fetch_catalog()}
+        titles = {r['title'] for r in catalog.values()}
+        lost_edits = [
+            uid for uid, title in self.titles.items()
+            if uid not in self.uncertain and uid not in self.deleted and
+            catalog.get(uid, {}).get('title') != title
+        ]
+        lost_notes = []
+        for uid, content in self.notes.items():
+            if uid in self.uncertain or uid in self.deleted:
+                continue
+            record = catalog.get(uid)
+            status, data = Client(self.url, Stats()).request(
+                '', 'GET', f"/data/{record['file']}") if record else (404, b'')
+            if status == 200:
+                data = self.decrypt(data, record['iv'])
+                if record.get('compression') == 'gzip':
+                    data = gzip.decompress(data)
+            if status != 200 or data.decode() != content:
+                lost_notes.append(uid)
+        return {
+            'lost_edits': lost_edits,
+            'lost_notes': lost_notes,
+            'resurrected': sorted(self.deleted & catalog.keys()),
+            'lost_uploads': sorted(self.uploads - titles),
+        }
+
+    def run(self):
+        try:
+            self.generate_media()
+            if 'url' not in self.config.get('server', {}):
+                self.start_server()
+            self.seed()
+
+            results = []
+            for scenario in self.config.get('scenario', []):
+                print(f"Running {scenario['name']}...")
+                results.append({
+                    'name': scenario['name'],
+                    'endpoints': self.run_scenario(scenario),
+                })
+            return {'scenarios': results, 'consistency': self.verify()}
+        finally:
+            self.stop_server()
+            if not self.keep:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def print_report(report: dict):
+    header = (f"{'endpoint':<24}{'requests':>9}{'errors':>8}{'req/s':>9}"
+              f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for scenario in report['scenarios']:
+        print(f"\n{scenario['name']}\n{header}\n{'-' * len(header)}")
+        for row in scenario['endpoints']:
+            print(f"{row['endpoint']:<24}{row['requests']:>9}"
+                  f"{row['errors']:>8}{row['rps']:>9.1f}{row['p50']:>9.1f}"
+                  f"{row['p95']:>9.1f}{row['p99']:>9.1f}")
+
+    print()
+    for problem, uids in report['consistency'].items():
+        print(f"{problem}: {len(uids)}")
+
+
+def get_command_line_args():
+    parser = ArgumentParser(description='Load test the server')
+    parser.add_argument('config', help='The scenario config (TOML)', type=Path)
+    parser.add_argument('-k', '--key', help='The 128bit hex key')
+    parser.add_argument('-o', '--output', help='Also write the report as JSON',
+                        type=Path)
+    parser.add_argument('--keep', help='Keep the scratch dir',
+                        action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    args = get_command_line_args()
+    config = tomllib.loads(args.config.read_text())
+
+    report = LoadTest(config, args.key, args.keep).run()
+    print_report(report)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if any(report['consistency'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
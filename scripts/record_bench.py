@@ -0,0 +1,94 @@
+from argparse import ArgumentParser
+import import_media as IM
+import gc
+import random
+import time
+import tracemalloc
+
+
+def synthetic_catalog(count: int):
+    """Catalog YAML with a realistic mix of kinds and field values"""
+    kinds = {
+        'video': ('application/vnd.apple.mpegurl', 'playlist.m3u8'),
+        'image': ('image/webp', 'image.webp.enc'),
+        'book': ('application/epub+zip', 'book.epub.enc'),
+        'note': ('text/markdown', 'note.md.gz.enc'),
+        'file': ('application/pdf', 'file.enc'),
+        'gallery': ('image/webp', 'pages.yaml.enc'),
+    }
+    records = []
+
+    for _ in range(count):
+        uid = IM.random_string(9)
+        kind = random.choice(list(kinds))
+        mime_type, name = kinds[kind]
+        record = {
+            'uid': uid,
+            'original_name': f'{IM.random_string(12)}.bin',
+            'original_size': random.randrange(1 << 30),
+            'original_hash': IM.random_string(32, 'h'),
+            'title': IM.random_string(random.randrange(8, 40)),
+            'description': '',
+            'encrypted': True,
+            'iv': IM.random_string(32, 'h'),
+            'creation_time': '2024-05-01T12:34:56+00:00',
+            'kind': kind,
+            'mime_type': mime_type,
+            'thumbnail': f'media/{uid}/thumbnail.webp.enc',
+            'file': f'media/{uid}/{name}',
+            'hash': f'media/{uid}/md5sum.txt',
+            'size': random.randrange(1 << 30),
+        }
+        if kind == 'video':
+            record['duration'] = random.uniform(10, 7200)
+            record['storyboard'] = f'media/{uid}/storyboard.vtt.enc'
+        elif kind == 'book':
+            record['author'] = 'Anonymous'
+            record['language'] = 'en-US'
+        elif kind == 'note':
+            record['compression'] = 'gzip'
+        elif kind == 'gallery':
+            record['pages'] = random.randrange(1, 300)
+        records.append(record)
+
+    return IM.YAML.dumps(records)
+
+
+def measure(yaml: str, load):
+    """Bytes retained by load(yaml) and seconds it took"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = load(yaml)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return records, size, elapsed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Compares the memory of catalog records as dicts and as '
+                    'Record objects')
+    parser.add_argument('-n', '--count', type=int, default=100000,
+                        help='Number of records (default: 100000)')
+    args = parser.parse_args()
+
+    yaml = synthetic_catalog(args.count)
+    representations = {
+        'dict': IM.YAML.loads,
+        'Record': lambda yaml: [IM.Record.from_dict(r)
+                                for r in IM.YAML.loads(yaml)],
+    }
+
+    print(f"{args.count} records, {len(yaml) / 2**20:.1f} MiB of YAML")
+    print(f"{'':8}{'MiB':>10}{'B/record':>10}{'load s':>10}{'dump s':>10}")
+    for name, load in representations.items():
+        records, size, elapsed = measure(yaml, load)
+        start = time.perf_counter()
+        IM.YAML.dumps(records)
+        dump_time = time.perf_counter() - start
+        print(f"{name:8}{size / 2**20:10.1f}{size / args.count:10.0f}"
+              f"{elapsed:10.2f}{dump_time:10.2f}")
+        del records
@@ -1,15 +1,62 @@
+# Before anything else, for the startup report
+import time
+IMPORT_TIME = time.monotonic()
+
 from fastapi import FastAPI, UploadFile, HTTPException, Form, Request, Body
-from fastapi.responses import Response
+from fastapi.responses import Response, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from http import HTTPStatus
 from pathlib import Path
 import import_media as IM
-from typing import Annotated
+from typing import Annotated, Literal
+from contextlib import asynccontextmanager
 import anyio
+import asyncio
+import base64
+import gzip
+import json
 import os
-import uvicorn
+import sys
+import tempfile
+
+
+def process_age():
+    """Seconds since the process started, or the onefile bootloader that
+    unpacked it, 0 where /proc isn't available
+    """
+    pid = os.getpid()
+    try:
+        # Onefile builds run in a child of the bootloader, same executable.
+        # The parent may be unreadable (another user) or absent (PID 1).
+        parent = os.getppid()
+        if parent and os.readlink(f"/proc/{parent}/exe") == \
+                os.readlink("/proc/self/exe"):
+            pid = parent
+    except OSError:
+        pass
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Fields after the command name, which may contain spaces
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+# Seconds from the process start to each phase, reported on the first
+# response and by /api/status
+START_TIME = IMPORT_TIME - process_age()
+STARTUP = {"unpack_and_interpreter": round(IMPORT_TIME - START_TIME, 3)}
 
 
+def startup_mark(phase: str):
+    STARTUP[phase] = round(time.monotonic() - START_TIME, 3)
+
+
+startup_mark("imports")
+
 app = FastAPI()
 
 
@@ -17,12 +64,34 @@ DATA_DIR = Path(os.environ.get("DATA_DIR", "data"))
 UI_DIR = Path(os.environ.get("UI_DIR", os.path.abspath(
     os.path.join(os.path.dirname(__file__), 'ui'))))
 THUMBNAIL_FONT_FILE = Path(os.environ.get("THUMBNAIL_FONT_FILE", "font.ttf"))
+# Resumable upload sessions idle for longer than this are removed
+UPLOAD_MAX_AGE = float(os.environ.get("UPLOAD_MAX_AGE", 24 * 3600))
+# Removed media can be restored for this many seconds
+TRASH_RETENTION = float(os.environ.get("TRASH_RETENTION", 24 * 3600))
+# Bytes per second the trash collector may delete
+TRASH_RATE = int(os.environ.get("TRASH_RATE", 64 * 1024 * 1024))
+# Library scrub readers and their combined bytes per second
+SCRUB_WORKERS = int(os.environ.get("SCRUB_WORKERS", 4))
+SCRUB_RATE = int(os.environ.get("SCRUB_RATE", 64 * 1024 * 1024))
+# Media kinds left to spool workers (import_media.py worker), e.g. video,image
+SPOOL_KINDS = [k for k in os.environ.get("SPOOL_KINDS", "").split(",") if k]
+# Jobs of workers silent for longer than this are retried
+SPOOL_LEASE_TIME = float(os.environ.get("SPOOL_LEASE_TIME", 300))
+# Same filesystem as DATA_DIR, so imports end with a rename instead of a copy
+STAGING_DIR = Path(os.environ.get("STAGING_DIR", DATA_DIR / ".staging"))
 
 DATA_DIR.mkdir(parents=True, exist_ok=True)
+STAGING_DIR.mkdir(parents=True, exist_ok=True)
+
+# Starlette spools multipart uploads via tempfile, keep them off /tmp too
+tempfile.tempdir = str(STAGING_DIR)
 
 if not THUMBNAIL_FONT_FILE.is_file():
     THUMBNAIL_FONT_FILE = None
 
+# Segment formats of VideoImporter, like --hls-type
+HlsType = Literal["mpegts", "fmp4"]
+
 
 async def save_upload_file(
     file: UploadFile,
@@ -49,7 +118,138 @@ async def save_upload_file(
         await file.close()
 
 
-app = FastAPI()
+async def cancel_on_disconnect(request: Request, coro, interval: float = 1):
+    """Runs coro, cancelling it (and its child processes) if the client leaves"""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise HTTPException(
+                    status_code=HTTPStatus.REQUEST_TIMEOUT,
+                    detail="Client disconnected",
+                )
+    finally:
+        if not task.done():
+            task.cancel()
+        # Wait for the cleanup in the task before Tmp goes away
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def collect_uploads(interval: float = 3600):
+    while True:
+        try:
+            removed = await asyncio.to_thread(
+                IM.UploadSession.collect, DATA_DIR, UPLOAD_MAX_AGE)
+            if removed:
+                print(f"Removed stale uploads: {' '.join(removed)}")
+        except Exception as e:
+            print(f"Collecting uploads failed: {e!r}", file=sys.stderr)
+        await asyncio.sleep(interval)
+
+
+async def collect_spool():
+    spool = IM.Spool(DATA_DIR, SPOOL_LEASE_TIME)
+    while True:
+        try:
+            requeued = await asyncio.to_thread(spool.requeue_expired)
+            if requeued:
+                print(f"Requeued expired spool jobs: {' '.join(requeued)}")
+            removed = await asyncio.to_thread(spool.collect, UPLOAD_MAX_AGE)
+            if removed:
+                print(f"Removed stale spool jobs: {' '.join(removed)}")
+        except Exception as e:
+            print(f"Collecting spool jobs failed: {e!r}", file=sys.stderr)
+        await asyncio.sleep(SPOOL_LEASE_TIME / 3)
+
+
+async def collect_trash(interval: float = 600):
+    trash = IM.Trash(DATA_DIR)
+    while True:
+        try:
+            collected = await trash.collect(TRASH_RETENTION, TRASH_RATE)
+            if collected:
+                print(f"Deleted from trash: {' '.join(collected)}")
+        except Exception as e:
+            # e.g. a tombstone restored while it was being walked
+            print(f"Collecting trash failed: {e!r}", file=sys.stderr)
+        await asyncio.sleep(interval)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = [
+        asyncio.create_task(collect_uploads()),
+        asyncio.create_task(collect_trash()),
+    ]
+    if SPOOL_KINDS:
+        tasks.append(asyncio.create_task(collect_spool()))
+    startup_mark("lifespan")
+    yield
+    # Interrupted imports leave their sessions to be finalized again
+    for task in [*tasks, *finalize_tasks.values()]:
+        task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(IM.GovernorBusy)
+async def governor_busy_handler(request: Request, exc: IM.GovernorBusy):
+    return JSONResponse(
+        status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "30"},
+    )
+
+
+@app.exception_handler(IM.InsufficientSpace)
+async def insufficient_space_handler(
+    request: Request,
+    exc: IM.InsufficientSpace,
+):
+    return JSONResponse(
+        status_code=HTTPStatus.INSUFFICIENT_STORAGE,
+        content={"detail": str(exc)},
+    )
+
+
+@app.middleware("http")
+async def startup_report_middleware(request: Request, call_next):
+    response = await call_next(request)
+    if "first_response" not in STARTUP:
+        startup_mark("first_response")
+        print("Startup: " + ", ".join(
+            f"{phase} {seconds:.3f}s" for phase, seconds in STARTUP.items()),
+            file=sys.stderr)
+    return response
+
+
+@app.middleware("http")
+async def hide_internal_middleware(request: Request, call_next):
+    # Staging and other bookkeeping dirs under DATA_DIR are dot-prefixed
+    if request.url.path.startswith("/data/."):
+        return Response(status_code=HTTPStatus.NOT_FOUND)
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    # Refuse uploads that won't fit before the body is read
+    if request.method == "PUT" and request.url.path.startswith("/api/"):
+        size = int(request.headers.get("content-length", 0))
+        try:
+            # Staged upload plus the imported result
+            IM.ensure_free_space(DATA_DIR, 2 * size)
+        except IM.InsufficientSpace as e:
+            return JSONResponse(
+                status_code=HTTPStatus.INSUFFICIENT_STORAGE,
+                content={"detail": str(e)},
+            )
+    return await call_next(request)
 
 
 @app.middleware("http")
@@ -70,13 +270,35 @@ async def decode_key_middleware(request: Request, call_next):
 async def init(
     key: Annotated[str, Body()],
 ):
-    async with IM.Tmp() as tmp:
+    async with IM.Tmp(STAGING_DIR) as tmp:
         # should be DB.clear(), but clear is dangerous
         await IM.DB(key, tmp, DATA_DIR).print()
 
 
+@app.get("/api/status")
+async def status():
+    return {
+        "queue_depth": IM.Cmd.governor.queue_depth(),
+        "tools": IM.Cmd.governor.stats(),
+        "startup": STARTUP,
+    }
+
+
+@app.get("/api/catalog/changes")
+async def get_catalog_changes(since: int, epoch: str | None = None):
+    # Entries stay encrypted, clients decrypt them like db.yaml.enc.
+    # "changes": null means reload db.yaml.enc instead.
+    result = await asyncio.to_thread(IM.ChangeLog(DATA_DIR).since,
+                                     epoch, since)
+    if result["changes"] is not None:
+        result["changes"] = [base64.b64encode(c).decode()
+                             for c in result["changes"]]
+    return result
+
+
 @app.put("/api/media")
 async def upload_media(
+    request: Request,
     kind: Annotated[IM.MediaKind, Form()],
     file: UploadFile,
     key: Annotated[str, Form()],
@@ -85,6 +307,9 @@ async def upload_media(
     thumbnail: UploadFile | None = None,
     bitrate: Annotated[str | None, Form()] = None,
     hls_time: Annotated[int | None, Form()] = None,
+    hls_type: Annotated[HlsType | None, Form()] = None,
+    hls_init_time: Annotated[float | None, Form()] = None,
+    storyboard_interval: Annotated[float | None, Form()] = None,
     resize: Annotated[str | None, Form()] = None,
     quality: Annotated[int | None, Form()] = None,
     encoding: Annotated[str | None, Form()] = None,
@@ -92,15 +317,17 @@ async def upload_media(
     language: Annotated[str | None, Form()] = None,
     toc_title: Annotated[str | None, Form()] = None,
     max_ctl: Annotated[int | None, Form()] = None,
+    optimize: Annotated[bool | None, Form()] = None,
 ):
-    async with IM.Tmp() as tmp:
+    IM.Cmd.governor.admit()
+    async with IM.Tmp(STAGING_DIR) as tmp:
         dir = tmp.dir()
 
         file_path = await save_upload_file(file, dir / file.filename)
         thumbnail_path = await save_upload_file(
             thumbnail, dir / thumbnail.filename) if thumbnail else None
 
-        await IM.import_media(
+        await cancel_on_disconnect(request, IM.import_media(
             kind=kind,
             file=file_path,
             key=key,
@@ -110,6 +337,9 @@ async def upload_media(
             thumbnail_font=THUMBNAIL_FONT_FILE,
             bitrate=bitrate,
             hls_time=hls_time,
+            hls_type=hls_type,
+            hls_init_time=hls_init_time,
+            storyboard_interval=storyboard_interval,
             resize=resize,
             quality=quality,
             encoding=encoding,
@@ -117,19 +347,314 @@ async def upload_media(
             language=language,
             toc_title=toc_title,
             max_ctl=max_ctl,
+            optimize=optimize,
             # Other options
             root_dir=DATA_DIR,
             tmp=tmp,
+            spool=kind in SPOOL_KINDS,
+        ))
+
+
+def get_upload_session(id: str):
+    try:
+        return IM.UploadSession(DATA_DIR, id)
+    except (ValueError, FileNotFoundError):
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+
+
+@app.post("/api/upload")
+async def create_upload(
+    key: Annotated[str, Body()],
+    kind: Annotated[IM.MediaKind, Body()],
+    filename: Annotated[str, Body()],
+    size: Annotated[int, Body()],
+    sha256: Annotated[str | None, Body()] = None,
+    title: Annotated[str | None, Body()] = None,
+    description: Annotated[str | None, Body()] = None,
+    bitrate: Annotated[str | None, Body()] = None,
+    hls_time: Annotated[int | None, Body()] = None,
+    hls_type: Annotated[HlsType | None, Body()] = None,
+    hls_init_time: Annotated[float | None, Body()] = None,
+    storyboard_interval: Annotated[float | None, Body()] = None,
+    resize: Annotated[str | None, Body()] = None,
+    quality: Annotated[int | None, Body()] = None,
+    encoding: Annotated[str | None, Body()] = None,
+    author: Annotated[str | None, Body()] = None,
+    language: Annotated[str | None, Body()] = None,
+    toc_title: Annotated[str | None, Body()] = None,
+    max_ctl: Annotated[int | None, Body()] = None,
+    optimize: Annotated[bool | None, Body()] = None,
+):
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        # Only holders of the library key may stage data
+        IM.DB(key, tmp, DATA_DIR)
+
+    session = IM.UploadSession.create(
+        DATA_DIR,
+        kind=kind,
+        filename=filename,
+        size=size,
+        sha256=sha256,
+        title=title,
+        description=description,
+        bitrate=bitrate,
+        hls_time=hls_time,
+        hls_type=hls_type,
+        hls_init_time=hls_init_time,
+        storyboard_interval=storyboard_interval,
+        resize=resize,
+        quality=quality,
+        encoding=encoding,
+        author=author,
+        language=language,
+        toc_title=toc_title,
+        max_ctl=max_ctl,
+        optimize=optimize,
+    )
+    return {
+        **session.status(),
+        "max_chunk_size": IM.UploadSession.max_chunk_size,
+    }
+
+
+@app.get("/api/upload/{id}")
+async def get_upload(id: str):
+    return upload_status(get_upload_session(id))
+
+
+@app.put("/api/upload/{id}")
+async def upload_chunk(
+    request: Request,
+    id: str,
+    offset: int,
+    sha256: str | None = None,
+):
+    session = get_upload_session(id)
+    data = await request.body()
+    try:
+        await asyncio.to_thread(session.write_chunk, offset, data, sha256)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    return session.status()
+
+
+# Imports of finalized uploads by session id, they outlive the request
+finalize_tasks: dict[str, asyncio.Task] = {}
+
+
+def upload_status(session: IM.UploadSession):
+    task = finalize_tasks.get(session.info["id"])
+    return {**session.status(), "importing": bool(task and not task.done())}
+
+
+async def run_finalize(session: IM.UploadSession, key: str):
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        try:
+            await session.finalize(
+                key, tmp, thumbnail_font=THUMBNAIL_FONT_FILE,
+                root_dir=DATA_DIR, spool=session.info["kind"] in SPOOL_KINDS)
+        except Exception as e:
+            # Kept in result.yaml for the client
+            print(f"Finalizing {session.info['id']} failed: {e!r}",
+                  file=sys.stderr)
+
+
+@app.put("/api/upload/{id}/thumbnail")
+async def upload_thumbnail(request: Request, id: str, filename: str):
+    session = get_upload_session(id)
+    data = await request.body()
+    try:
+        await asyncio.to_thread(session.write_thumbnail, filename, data)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+
+
+@app.post("/api/upload/{id}/finalize")
+async def finalize_upload(
+    id: str,
+    key: Annotated[str, Body(embed=True)],
+):
+    """Starts the import and answers 202, poll GET /api/upload/{id} for the
+    result. Retrying is safe, a finished import is only reported.
+    """
+    session = get_upload_session(id)
+    task = finalize_tasks.get(id)
+    if (session.result() or {}).get("state") == "done" or \
+            task and not task.done():
+        return JSONResponse(
+            status_code=HTTPStatus.OK if session.result()
+            else HTTPStatus.ACCEPTED,
+            content=upload_status(session),
         )
 
+    if not session.is_complete():
+        raise HTTPException(
+            status_code=HTTPStatus.CONFLICT, detail=session.status())
+
+    IM.Cmd.governor.admit()
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        try:
+            IM.DB(key, tmp, DATA_DIR)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+
+    finalize_tasks[id] = asyncio.create_task(run_finalize(session, key))
+    finalize_tasks[id].add_done_callback(
+        lambda _: finalize_tasks.pop(id, None))
+    return JSONResponse(
+        status_code=HTTPStatus.ACCEPTED, content=upload_status(session))
+
+
+@app.delete("/api/upload/{id}")
+async def abort_upload(id: str):
+    get_upload_session(id).abort()
+
 
 @app.delete("/api/media")
 async def delete_media(
     key: Annotated[str, Body()],
     uids: Annotated[list[str], Body()],
 ):
-    async with IM.Tmp() as tmp:
-        await IM.DB(key, tmp, DATA_DIR).remove(uids)
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        return await IM.DB(key, tmp, DATA_DIR).remove(uids)
+
+
+@app.post("/api/media/restore")
+async def restore_media(
+    key: Annotated[str, Body()],
+    uids: Annotated[list[str], Body()],
+):
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        restored = await IM.DB(key, tmp, DATA_DIR).restore(uids)
+    return {"restored": restored}
+
+
+scrubber: IM.Scrubber | None = None
+scrub_task: asyncio.Task | None = None
+
+
+async def run_scrub(scrubber: IM.Scrubber):
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        scrubber.db.tmp = tmp
+        return await scrubber.scrub()
+
+
+@app.post("/api/scrub")
+async def start_scrub(
+    key: Annotated[str, Body()],
+    incremental: Annotated[bool, Body()] = True,
+    quarantine: Annotated[bool, Body()] = False,
+    repair: Annotated[bool, Body()] = False,
+):
+    global scrubber, scrub_task
+
+    if scrub_task and not scrub_task.done():
+        raise HTTPException(status_code=HTTPStatus.CONFLICT)
+
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        db = IM.DB(key, tmp, DATA_DIR)
+
+    scrubber = IM.Scrubber(
+        db,
+        workers=SCRUB_WORKERS,
+        rate=SCRUB_RATE,
+        incremental=incremental,
+        quarantine=quarantine,
+        repair=repair,
+    )
+    scrub_task = asyncio.create_task(run_scrub(scrubber))
+    return scrubber.progress()
+
+
+@app.get("/api/scrub")
+async def get_scrub():
+    if scrubber is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+    return {
+        "running": not scrub_task.done(),
+        "error": str(scrub_task.exception())
+        if scrub_task.done() and scrub_task.exception() else None,
+        **scrubber.progress(),
+    }
+
+
+regenerator: IM.Regenerator | None = None
+regenerate_task: asyncio.Task | None = None
+
+
+async def run_regenerate(regenerator: IM.Regenerator):
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        regenerator.db.tmp = tmp
+        return await regenerator.regenerate()
+
+
+@app.post("/api/regenerate")
+async def start_regenerate(
+    key: Annotated[str, Body()],
+    derivatives: Annotated[list[str], Body()],
+    kinds: Annotated[list[IM.MediaKind] | None, Body()] = None,
+    uids: Annotated[list[str] | None, Body()] = None,
+    where: Annotated[list[str] | None, Body()] = None,
+    replace_custom_thumbnails: Annotated[bool, Body()] = False,
+    bitrate: Annotated[str | None, Body()] = None,
+    hls_time: Annotated[int | None, Body()] = None,
+    hls_type: Annotated[HlsType | None, Body()] = None,
+    hls_init_time: Annotated[float | None, Body()] = None,
+    storyboard_interval: Annotated[float | None, Body()] = None,
+    resize: Annotated[str | None, Body()] = None,
+    quality: Annotated[int | None, Body()] = None,
+    optimize: Annotated[bool | None, Body()] = None,
+):
+    """Rebuilds derivatives of the selected records in the background
+
+    Thumbnails users uploaded or edited are kept unless
+    replace_custom_thumbnails is set.
+    """
+    global regenerator, regenerate_task
+
+    if regenerate_task and not regenerate_task.done():
+        raise HTTPException(status_code=HTTPStatus.CONFLICT)
+    IM.Cmd.governor.admit()
+
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        db = IM.DB(key, tmp, DATA_DIR)
+
+    try:
+        regenerator = IM.Regenerator(
+            db,
+            derivatives,
+            kinds=kinds,
+            uids=uids,
+            where=where,
+            workers=SCRUB_WORKERS,
+            replace_custom_thumbnails=replace_custom_thumbnails,
+            thumbnail_font=THUMBNAIL_FONT_FILE,
+            bitrate=bitrate,
+            hls_time=hls_time,
+            hls_type=hls_type,
+            hls_init_time=hls_init_time,
+            storyboard_interval=storyboard_interval,
+            resize=resize,
+            quality=quality,
+            optimize=optimize,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    regenerate_task = asyncio.create_task(run_regenerate(regenerator))
+    return regenerator.progress()
+
+
+@app.get("/api/regenerate")
+async def get_regenerate():
+    if regenerator is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+    return {
+        "running": not regenerate_task.done(),
+        "error": str(regenerate_task.exception())
+        if regenerate_task.done() and regenerate_task.exception() else None,
+        **regenerator.progress(),
+    }
 
 
 @app.patch("/api/media")
@@ -140,8 +665,11 @@ async def update_media(
     description: Annotated[str | None, Form()] = None,
     thumbnail: UploadFile | None = None,
 ):
-    async with IM.Tmp() as tmp:
-        async with IM.DB(key, tmp, DATA_DIR) as db:
+    if thumbnail:
+        IM.Cmd.governor.admit()
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        catalog = IM.DB(key, tmp, DATA_DIR)
+        async with catalog as db:
             record = next((r for r in db if r['uid'] == uid), None)
 
             if record is None:
@@ -160,6 +688,139 @@ async def update_media(
                 await IM.Cmd.image_to_thumbnail(path_1, path_2)
                 path_3 = DATA_DIR / record['thumbnail']
                 await IM.Cmd.encrypt_file(path_2, path_3, key, record['iv'])
+                record['size'] = await IM.refresh_md5sum(path_3.parent)
+                record['custom_thumbnail'] = True
+
+        # Once the catalog has the change
+        await catalog.index.update({
+            (uid, 'meta'): IM.SearchIndex.meta_text(record),
+        })
+
+
+@app.patch("/api/media/batch")
+async def update_media_batch(
+    key: Annotated[str, Form()],
+    patches: Annotated[str, Form()],
+    thumbnails: list[UploadFile] = [],
+):
+    """Edits many records with a single catalog write
+
+    patches is a JSON list of {uid, title?, description?, thumbnail?}, where
+    thumbnail is an index into thumbnails. The patches are applied all
+    together or not at all: if any uid is unknown or repeated, or any
+    thumbnail can't be made, it answers 422 with the result of each patch
+    and changes nothing.
+    """
+    try:
+        patches = json.loads(patches)
+        assert isinstance(patches, list)
+        assert all(isinstance(p, dict) and "uid" in p for p in patches)
+    except (ValueError, AssertionError):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST,
+                            detail="patches must be a list of {uid, ...}")
+
+    def check(records: dict):
+        """The result of each patch against the catalog"""
+        results = []
+        seen = set()
+        for patch in patches:
+            uid = patch["uid"]
+            index = patch.get("thumbnail")
+            if uid not in records:
+                result = {"uid": uid, "status": "not_found"}
+            elif uid in seen:
+                result = {"uid": uid, "status": "failed",
+                          "error": "Duplicate uid"}
+            elif index is not None and not (
+                    isinstance(index, int) and 0 <= index < len(thumbnails)):
+                result = {"uid": uid, "status": "failed",
+                          "error": "No such thumbnail"}
+            else:
+                result = {"uid": uid, "status": "updated"}
+            seen.add(uid)
+            results.append(result)
+        return results
+
+    def reject(results: list[dict]):
+        if any(r["status"] != "updated" for r in results):
+            raise HTTPException(status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+                                detail=results)
+
+    if thumbnails:
+        IM.Cmd.governor.admit()
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        catalog = IM.DB(key, tmp, DATA_DIR)
+        async with catalog as db:
+            # None for records stored unencrypted
+            ivs = {r["uid"]: r.get("iv") for r in db}
+        reject(check(ivs))
+
+        paths = [await save_upload_file(file, tmp.file(file.filename))
+                 for file in thumbnails]
+
+        async def make_thumbnail(patch: dict):
+            path = tmp.file(".webp")
+            await IM.Cmd.image_to_thumbnail(paths[patch["thumbnail"]], path)
+            if ivs[patch["uid"]] is None:
+                return path
+            ct_path = tmp.file(".enc")
+            await IM.Cmd.encrypt_file(path, ct_path, key, ivs[patch["uid"]])
+            return ct_path
+
+        # Made in the staging dir, outside the catalog lock. The governor
+        # bounds how many at once.
+        wanted = [(i, p) for i, p in enumerate(patches)
+                  if p.get("thumbnail") is not None]
+        made = await asyncio.gather(*(make_thumbnail(p) for _, p in wanted),
+                                    return_exceptions=True)
+        results = check(ivs)
+        made_paths = {}
+        for (i, patch), path in zip(wanted, made):
+            if isinstance(path, BaseException):
+                results[i] = {"uid": patch["uid"], "status": "failed",
+                              "error": str(path)}
+            else:
+                made_paths[patch["uid"]] = path
+        reject(results)
+
+        # Records aren't touched until everything is ready, the catalog is
+        # written back on the way out of the block even after an error
+        async with catalog as db:
+            records = {r["uid"]: r for r in db}
+            # Removed or rekeyed meanwhile
+            reject(check({uid: r for uid, r in records.items()
+                          if r.get("iv") == ivs.get(uid)}))
+
+            # Next to the current thumbnails, to be renamed over them
+            new_paths = {}
+            try:
+                for uid, path in made_paths.items():
+                    dst = DATA_DIR / records[uid]["thumbnail"]
+                    new_paths[uid] = dst.with_name(dst.name + ".new")
+                    IM.place_file(path, new_paths[uid], move=True)
+            except BaseException:
+                for path in new_paths.values():
+                    path.unlink(missing_ok=True)
+                raise
+
+            for patch in patches:
+                record = records[patch["uid"]]
+                if patch["uid"] in new_paths:
+                    record["size"] += IM.replace_resource_file(
+                        new_paths[patch["uid"]],
+                        DATA_DIR / record["thumbnail"])
+                    record["custom_thumbnail"] = True
+                if patch.get("title"):
+                    record["title"] = patch["title"]
+                if patch.get("description"):
+                    record["description"] = patch["description"]
+
+        await catalog.index.update({
+            (p["uid"], "meta"): IM.SearchIndex.meta_text(records[p["uid"]])
+            for p in patches
+        })
+
+    return results
 
 
 @app.patch("/api/note")
@@ -168,35 +829,44 @@ async def update_note(
     uid: Annotated[str, Body()],
     content: Annotated[str, Body()],
 ):
-    async with IM.Tmp() as tmp:
-        async with IM.DB(key, tmp, DATA_DIR) as db:
+    async with IM.Tmp(STAGING_DIR) as tmp:
+        catalog = IM.DB(key, tmp, DATA_DIR)
+        async with catalog as db:
             record = next((r for r in db if r['uid'] == uid), None)
 
             if record is None:
                 raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
 
             pt_path = tmp.file()
-            pt_path.write_text(content)
-            await IM.Cmd.encrypt_file(
-                pt_path, DATA_DIR / record['file'], key, record['iv'])
+            if record.get('compression') == 'gzip':
+                pt_path.write_bytes(gzip.compress(content.encode()))
+            else:
+                pt_path.write_text(content)
+            ct_path = DATA_DIR / record['file']
+            await IM.Cmd.encrypt_file(pt_path, ct_path, key, record['iv'])
+            record['size'] = await IM.refresh_md5sum(ct_path.parent)
+
+        await catalog.index.update({(uid, 'body'): content})
 
 
 @app.put("/api/note")
 async def create_note(
+    request: Request,
     key: Annotated[str, Form()],
     title: Annotated[str, Form()],
     content: Annotated[str, Form()],
     description: Annotated[str | None, Form()] = None,
     thumbnail: UploadFile | None = None,
 ):
-    async with IM.Tmp() as tmp:
+    IM.Cmd.governor.admit()
+    async with IM.Tmp(STAGING_DIR) as tmp:
         pt_path = tmp.file('.md')
         pt_path.write_text(content)
 
         thumbnail_path = await save_upload_file(
             thumbnail, tmp.file(thumbnail.filename)) if thumbnail else None
 
-        await IM.NoteImporter(
+        await cancel_on_disconnect(request, IM.NoteImporter(
             file=pt_path,
             key=key,
             tmp=tmp,
@@ -205,12 +875,14 @@ async def create_note(
             thumbnail=thumbnail_path,
             thumbnail_font=THUMBNAIL_FONT_FILE,
             root_dir=DATA_DIR,
-        ).consume()
+        ).consume())
 
 
 # Serve static files at last
 app.mount("/data", StaticFiles(directory=DATA_DIR), name="data")
 app.mount("/", StaticFiles(directory=UI_DIR, html=True), name="ui")
+startup_mark("app")
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app)
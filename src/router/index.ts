@@ -29,6 +29,11 @@ const routes = [
     name: "image",
     component: () => import("@/views/Image.vue"),
   },
+  {
+    path: "/gallery/:uid",
+    name: "gallery",
+    component: () => import("@/views/Gallery.vue"),
+  },
   {
     path: "/book/:uid",
     name: "book",
@@ -1,7 +1,7 @@
 import { defineStore } from "pinia";
 import { ref } from "vue";
 import YAML from "yaml";
-import { hexToBytes, getBytesHash } from "./utils";
+import { hexToBytes, bytesToHex, getBytesHash } from "./utils";
 import axios from "axios";
 
 export const useApiStore = defineStore("api", () => {
@@ -10,6 +10,14 @@ export const useApiStore = defineStore("api", () => {
   let dbKeyHex: string | null = null;
   let dbKey: CryptoKey | null = null;
   let dbIv: Uint8Array | null = null;
+  // Hashes search terms like SearchIndex.term_id in import_media.py
+  let termKey: CryptoKey | null = null;
+  // Catalog generation the records are at, see ChangeLog in import_media.py
+  let catalogEpoch: string | null = null;
+  let catalogGeneration = -1;
+  // Published libraries have content-addressed media URLs
+  let mediaCache: RequestCache = "no-cache";
+  let keyUrl: string | null = null;
 
   // reactive data
   const records = ref<AnyRecord[]>([]);
@@ -27,7 +35,11 @@ export const useApiStore = defineStore("api", () => {
     }
 
     const yamlText = await response.text();
-    const keyInfo = YAML.parse(yamlText) as { key_hash: string; iv: string };
+    const keyInfo = YAML.parse(yamlText) as {
+      key_hash: string;
+      iv: string;
+      immutable_media?: boolean;
+    };
 
     const key_bytes = hexToBytes(key);
     const keyHashFull = await getBytesHash(key_bytes, "SHA-256");
@@ -44,7 +56,15 @@ export const useApiStore = defineStore("api", () => {
         false,
         ["decrypt"],
       );
+      termKey = await crypto.subtle.importKey(
+        "raw",
+        key_bytes,
+        { name: "HMAC", hash: "SHA-256" },
+        false,
+        ["sign"],
+      );
       dbIv = hexToBytes(keyInfo.iv);
+      mediaCache = keyInfo.immutable_media ? "default" : "no-cache";
 
       return true;
     } else {
@@ -52,23 +72,82 @@ export const useApiStore = defineStore("api", () => {
     }
   }
 
-  async function fetchRecords() {
-    if (dbKey === null || dbIv === null) {
-      throw new Error("Key or IV for database is not set");
-    }
-
-    const response = await fetch("/data/db.yaml.enc", { cache: "no-cache" });
-    const responseBuffer = await response.arrayBuffer();
+  async function decryptCatalog(buffer: BufferSource) {
     const yamlBuffer = await window.crypto.subtle.decrypt(
       {
         name: dbEncAlgo,
-        iv: dbIv,
+        iv: dbIv!,
       },
-      dbKey,
-      responseBuffer,
+      dbKey!,
+      buffer,
     );
     const yamlText = new TextDecoder().decode(yamlBuffer);
-    records.value = (YAML.parse(yamlText) || []) as AnyRecord[];
+    return YAML.parse(yamlText) || [];
+  }
+
+  async function fetchChanges() {
+    const params = new URLSearchParams({ since: String(catalogGeneration) });
+    if (catalogEpoch) params.set("epoch", catalogEpoch);
+
+    const response = await fetch(`/api/catalog/changes?${params}`, {
+      cache: "no-cache",
+    });
+    if (!response.ok) return null;
+    try {
+      return (await response.json()) as {
+        epoch: string | null;
+        generation: number;
+        changes: string[] | null;
+      };
+    } catch {
+      // A static host without the API, answering with index.html
+      return null;
+    }
+  }
+
+  async function fetchRecords() {
+    if (dbKey === null || dbIv === null) {
+      throw new Error("Key or IV for database is not set");
+    }
+
+    // Only what changed since the last fetch, if the server still has it
+    const delta = await fetchChanges();
+
+    if (delta?.changes) {
+      const updated = [...records.value];
+      for (const change of delta.changes) {
+        const bytes = Uint8Array.from(atob(change), (c) => c.charCodeAt(0));
+        const entries = (await decryptCatalog(bytes)) as (AnyRecord & {
+          _removed?: boolean;
+        })[];
+
+        for (const entry of entries) {
+          const index = updated.findIndex((r) => r.uid === entry.uid);
+          if (entry._removed) {
+            if (index >= 0) updated.splice(index, 1);
+          } else if (index >= 0) {
+            updated[index] = entry;
+          } else {
+            updated.push(entry);
+          }
+        }
+      }
+      records.value = updated;
+    } else {
+      const response = await fetch("/data/db.yaml.enc", { cache: "no-cache" });
+      records.value = (await decryptCatalog(
+        await response.arrayBuffer(),
+      )) as AnyRecord[];
+    }
+
+    // Their resources were moved away by a scrub
+    records.value = records.value.filter((r) => !r.quarantined);
+
+    if (delta) {
+      catalogEpoch = delta.epoch;
+      catalogGeneration = delta.generation;
+    }
+
     // recreate recordByUid
     const newRecordByUid: Record<string, AnyRecord> = {};
     records.value.forEach((r) => {
@@ -89,8 +168,13 @@ export const useApiStore = defineStore("api", () => {
     return record;
   }
 
-  async function fetchAndDecrypt(path: string, decrypt = false, iv?: string) {
-    const response = await fetch(`/data/${path}`, { cache: "no-cache" });
+  async function fetchAndDecrypt(
+    path: string,
+    decrypt = false,
+    iv?: string,
+    cache: RequestCache = mediaCache,
+  ) {
+    const response = await fetch(`/data/${path}`, { cache });
     const responseBuffer = await response.arrayBuffer();
 
     if (decrypt) {
@@ -113,12 +197,117 @@ export const useApiStore = defineStore("api", () => {
     }
   }
 
+  // Same terms as SearchIndex.tokenize in import_media.py
+  const cjkRun = /[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+/g;
+
+  function tokenize(text: string) {
+    const terms = new Set<string>();
+    for (const word of text.toLowerCase().match(/[\p{L}\p{N}_]+/gu) ?? []) {
+      // No spaces between CJK words, the index has character bigrams
+      for (const run of word.match(cjkRun) ?? []) {
+        if (run.length === 1) terms.add(run);
+        for (let i = 0; i < run.length - 1; i++) {
+          terms.add(run.substring(i, i + 2));
+        }
+      }
+      for (const part of word.split(cjkRun)) {
+        if (part.length > 1) terms.add(part);
+      }
+    }
+    return terms;
+  }
+
+  // uids of the records containing every word of query, in their title,
+  // description or text; null if there's no index to ask
+  async function searchRecords(query: string) {
+    if (!termKey || !dbKey) {
+      throw new Error("Key is not set");
+    }
+
+    const ids = new Set<string>();
+    for (const term of tokenize(query)) {
+      const mac = await crypto.subtle.sign(
+        "HMAC",
+        termKey,
+        new TextEncoder().encode(term),
+      );
+      ids.add(bytesToHex(new Uint8Array(mac)).substring(0, 16));
+    }
+    if (ids.size === 0) return null;
+
+    const response = await fetch("/data/index/manifest.yaml", {
+      cache: "no-cache",
+    });
+    if (!response.ok) return null;
+    // All strings, shard names like 05 aren't numbers
+    const manifest = YAML.parse(await response.text(), {
+      schema: "failsafe",
+    }) as Record<string, string> | null;
+    if (typeof manifest !== "object" || manifest === null) return null;
+
+    let matches: Set<string> | null = null;
+    const shards = new Set([...ids].map((id) => id.substring(0, 2)));
+    for (const shard of shards) {
+      if (!(shard in manifest)) return new Set<string>();
+
+      // Named after their IV, never changed in place, so cacheable
+      const iv = manifest[shard];
+      const buffer = await fetchAndDecrypt(
+        `index/${shard}-${iv.substring(0, 12)}.yaml.enc`,
+        true,
+        iv,
+        "default",
+      );
+      const entries = (YAML.parse(new TextDecoder().decode(buffer), {
+        schema: "failsafe",
+      }) || []) as { term: string; uids: string }[];
+      const postings = new Map(entries.map((e) => [e.term, e.uids]));
+
+      for (const id of ids) {
+        if (!id.startsWith(shard)) continue;
+        const uids = new Set(postings.get(id)?.split(" ") ?? []);
+        matches =
+          matches === null
+            ? uids
+            : new Set([...matches].filter((uid) => uids.has(uid)));
+      }
+    }
+    return matches;
+  }
+
+  // The HLS key for players, without the server's key.bin route
+  function getKeyUrl() {
+    if (!dbKeyHex) {
+      throw new Error("Key is not set");
+    }
+    if (!keyUrl) {
+      const blob = new Blob([hexToBytes(dbKeyHex)], {
+        type: "application/octet-stream",
+      });
+      keyUrl = URL.createObjectURL(blob);
+    }
+    return keyUrl;
+  }
+
   async function fetchThumbnail(record: AnyRecord) {
     return fetchAndDecrypt(record.thumbnail, record.encrypted, record.iv);
   }
 
   async function fetchFile(record: AnyRecord) {
-    return fetchAndDecrypt(record.file, record.encrypted, record.iv);
+    const buffer = await fetchAndDecrypt(
+      record.file,
+      record.encrypted,
+      record.iv,
+    );
+
+    if (record.compression === "gzip") {
+      const stream = new Blob([buffer])
+        .stream()
+        .pipeThrough(new DecompressionStream("gzip"));
+      return new Response(stream).arrayBuffer();
+    } else {
+      return buffer;
+    }
   }
 
   async function uploadMedia(data: {
@@ -134,6 +323,7 @@ export const useApiStore = defineStore("api", () => {
     language?: string;
     toc_title?: string;
     max_ctl?: number;
+    optimize?: boolean;
   }) {
     if (!dbKeyHex) {
       throw new Error("Key is not set");
@@ -175,6 +365,42 @@ export const useApiStore = defineStore("api", () => {
     await axios.patch("/api/media", formData);
   }
 
+  async function updateMediaBatch(
+    patches: {
+      uid: string;
+      title?: string;
+      description?: string;
+      thumbnail?: File;
+    }[],
+  ) {
+    if (!dbKeyHex) {
+      throw new Error("Key is not set");
+    }
+
+    const formData = new FormData();
+    const thumbnails: File[] = [];
+
+    formData.append("key", dbKeyHex);
+    formData.append(
+      "patches",
+      JSON.stringify(
+        patches.map(({ thumbnail, ...patch }) => {
+          if (!thumbnail) return patch;
+          thumbnails.push(thumbnail);
+          return { ...patch, thumbnail: thumbnails.length - 1 };
+        }),
+      ),
+    );
+    thumbnails.forEach((file) => formData.append("thumbnails", file));
+
+    // All or nothing, a 422 carries the status of each patch in its detail
+    const response = await axios.patch("/api/media/batch", formData);
+    return response.data as {
+      uid: string;
+      status: "updated";
+    }[];
+  }
+
   async function deleteMedia(uids: string[]) {
     if (!dbKeyHex) {
       throw new Error("Key is not set");
@@ -232,10 +458,13 @@ export const useApiStore = defineStore("api", () => {
     fetchRecords,
     getRecord,
     fetchAndDecrypt,
+    searchRecords,
+    getKeyUrl,
     fetchThumbnail,
     fetchFile,
     uploadMedia,
     updateMedia,
+    updateMediaBatch,
     deleteMedia,
     createNote,
     updateNote,
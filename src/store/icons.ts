@@ -4,6 +4,7 @@ import {
   faImage,
   faBookOpen,
   faFileCircleQuestion,
+  faImages,
 } from "@fortawesome/free-solid-svg-icons";
 
 export const MediaIconMap = {
@@ -12,4 +13,5 @@ export const MediaIconMap = {
   image: faImage,
   book: faBookOpen,
   file: faFileCircleQuestion,
+  gallery: faImages,
 };
@@ -19,11 +19,13 @@ export async function getBytesHash(
   algorithm: AlgorithmIdentifier,
 ) {
   const hashBuffer = await crypto.subtle.digest(algorithm, bytes);
-  const hashArray = new Uint8Array(hashBuffer);
-  const hashHex = Array.from(hashArray)
+  return bytesToHex(new Uint8Array(hashBuffer));
+}
+
+export function bytesToHex(bytes: Uint8Array) {
+  return Array.from(bytes)
     .map((b) => b.toString(16).padStart(2, "0"))
     .join("");
-  return hashHex;
 }
 
 export function trimRecord<T extends Record<string, unknown>>(obj: T): T {
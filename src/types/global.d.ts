@@ -14,11 +14,17 @@ interface BaseRecord {
   file: string;
   hash: string;
   size: number;
+  compression?: "gzip";
+  // Problems found by a scrub that moved the resource to .quarantine
+  quarantined?: string;
 }
 
 interface VideoRecord extends BaseRecord {
   kind: "video";
   duration: number;
+  // WebVTT cues pointing into sprite sheets, see VideoImporter. Encrypted
+  // like the sheets when the path ends in .enc
+  storyboard?: string;
 }
 
 interface ImageRecord extends BaseRecord {
@@ -39,9 +45,24 @@ interface FileRecord extends BaseRecord {
   kind: "file";
 }
 
+interface GalleryRecord extends BaseRecord {
+  kind: "gallery";
+  pages: number;
+}
+
+interface GalleryPage {
+  page: number;
+  name: string;
+  width: number;
+  height: number;
+  file: string;
+  thumbnail: string;
+}
+
 type AnyRecord =
   | VideoRecord
   | ImageRecord
   | BookRecord
   | NoteRecord
-  | FileRecord;
+  | FileRecord
+  | GalleryRecord;